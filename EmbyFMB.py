@@ -15,14 +15,40 @@ import os
 import time
 import logging
 import threading
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+import queue
+import atexit
 import requests
 from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+from watchdog.events import (FileSystemEventHandler, FileCreatedEvent, FileDeletedEvent, FileMovedEvent,
+                             DirCreatedEvent, DirDeletedEvent)
+try:
+    # inotify 后端（仅 Linux），用于在内核层面跳过排除的目录
+    from watchdog.observers.api import BaseObserver
+    from watchdog.observers.inotify import InotifyEmitter
+    from watchdog.observers.inotify_buffer import InotifyBuffer
+    from watchdog.observers.inotify_c import Inotify
+    from watchdog.utils import BaseThread
+    from watchdog.utils.delayed_queue import DelayedQueue
+except ImportError:
+    Inotify = None
 import sys
+import errno
 import fcntl
 import traceback
-from collections import defaultdict
+import functools
+import json
+import sqlite3
+import re
+import fnmatch
+import random
+import bisect
+import signal
+import socket
+import hmac
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict, deque
 
 # --- 您需要在此处进行配置 ---
 
@@ -33,13 +59,40 @@ EMBY_API_KEY = "888888888888888888888"           # 替换为您的 Emby API 密
 # Telegram Bot 配置
 TELEGRAM_BOT_TOKEN = "99999999999999:88888888888888888"  # 替换为您的 Telegram Bot Token
 TELEGRAM_CHAT_ID = "88888888888888"      # 替换为您的 Telegram Chat ID
+TELEGRAM_API_URL = "https://api.telegram.org"  # Telegram Bot API 地址，使用反向代理时可修改
 
 # 扫描触发周期（秒）
-SCAN_INTERVAL_SECONDS = 600  # 每隔10分钟检查一次文件变动
+SCAN_INTERVAL_SECONDS = 600  # 每隔10分钟检查一次文件变动（启用自适应调度时为统计日志的输出周期）
+
+# 自适应扫描调度（每个媒体库独立调度，互不影响）
+# 媒体库最后一次文件变动后等待该时长再扫描（秒），0 表示使用固定周期 SCAN_INTERVAL_SECONDS
+SCAN_DEBOUNCE_SECONDS = 60
+# 从首次变动到扫描的最长等待时间（秒），持续有文件变动时也保证按时扫描
+SCAN_MAX_LATENCY_SECONDS = 600
+# 同一媒体库两次扫描之间的最小间隔（秒）
+SCAN_MIN_INTERVAL_SECONDS = 120
+
+# Emby 扫描状态跟踪：Emby 正在扫描时暂缓发送新的扫描请求，扫描结束后合并为一次请求发送
+EMBY_SCAN_TRACKING = True
+# 查询 Emby 扫描状态的最小间隔（秒）
+EMBY_STATUS_POLL_SECONDS = 15
+# 发送请求后在该时长内未观察到 Emby 开始扫描，则视为已完成（秒）
+EMBY_SCAN_START_GRACE_SECONDS = 60
+# 最长暂缓时间（秒），Emby 扫描状态长时间不结束时仍然发送请求
+EMBY_BUSY_MAX_HOLD_SECONDS = 3600
 # 日志文件配置
 LOG_FILE_PATH = "/volume5/docker/EmbyFMB/EmbyFMB.log"  # 日志文件存放路径，请确保该目录存在
 LOG_MAX_BYTES = 1 * 1024 * 1024  # 1 MB
 LOG_BACKUP_COUNT = 2  # 最多保留3个日志文件 (monitor.log, monitor.log.1, monitor.log.2)
+# 异步日志：日志先进入内存队列，由后台线程写入文件和控制台，避免磁盘延迟拖慢文件事件处理
+LOG_ASYNC = True
+# 异步日志队列容量，队列满时丢弃新日志并计数
+LOG_QUEUE_SIZE = 10000
+# 额外输出紧凑的 JSON Lines 格式日志，便于程序分析，留空表示关闭
+LOG_JSON_FILE_PATH = ""
+# 高频日志限流：{日志类别: 每分钟最多输出条数}，超出部分只计数，并在下一条输出时汇总
+# 类别 "event" 为每个文件事件的详细日志
+LOG_RATE_LIMITS = {"event": 600}
 
 # NAS路径到Emby容器内部路径的映射
 # 格式: {"NAS上的绝对路径": "Emby容器内部看到的路径"}
@@ -64,37 +117,1165 @@ LIBRARY_ID_TO_NAME = {
     # 添加更多映射...
 }
 
+# 媒体库自动发现：启动时从 Emby 的 /Library/VirtualFolders 读取媒体库 ID、名称和容器内部路径，
+# 按下方的前缀改写规则推导出 NAS 路径，与上面三个手动配置的映射表合并（同一路径或 ID 以手动配置为准）
+EMBY_LIBRARY_DISCOVERY = False
+# 容器路径到 NAS 路径的前缀改写规则，格式: {"Emby容器内部路径前缀": "NAS上的绝对路径前缀"}
+# 无法改写的媒体库路径不会被监控
+LIBRARY_PATH_REWRITE_RULES = {
+    "/Nas1/Video": "/volume1/Video",
+    # 添加更多规则...
+}
+# 自动发现结果的缓存文件，Emby 暂时不可用时使用缓存启动，留空表示不缓存
+LIBRARY_DISCOVERY_CACHE_PATH = "/volume5/docker/EmbyFMB/EmbyFMB_libraries.json"
+# 缓存有效期，也是后台重新读取媒体库配置的间隔（秒）
+LIBRARY_DISCOVERY_TTL_SECONDS = 3600
+
 # 要监控的视频文件扩展名（小写）
 VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.avi', '.mov', '.wmv', '.mpg', '.mpeg', '.flv', '.webm', '.ts', '.rmvb', '.iso', '.vob')
 
+# 忽略的目录名称：这些目录及其子目录不会被监控（不添加 inotify 监控），可显著减少监控数量和启动时间
+IGNORED_DIR_NAMES = ("@eaDir", "#recycle", "#snapshot", "@tmp", ".@__thumb", "@Recycle", ".Trash-1000")
+# 需要处理的文件名通配符（不区分大小写），留空表示按 VIDEO_EXTENSIONS 判断
+INCLUDE_PATTERNS = ()
+# 忽略的文件名通配符（不区分大小写），优先于上面的规则
+EXCLUDE_PATTERNS = ("*.part", "*.!qb", "*.tmp", "*.crdownload", ".DS_Store", "._*", "*.nfo", "*.jpg", "*.png")
+
 # Telegram通知页脚
 TELEGRAM_NOTIFICATION_FOOTER = "👤 Emby File Monitor with TG BOT by Leo"
 
 # 通知聚合时间窗口（秒）
 NOTIFICATION_WINDOW_SECONDS = 5
+# Telegram 发送速率限制（令牌桶）：每分钟最多发送的消息数和允许的突发数量
+# Telegram 对同一群组限制约每分钟 20 条，对同一私聊限制约每秒 1 条
+TELEGRAM_MESSAGES_PER_MINUTE = 20
+TELEGRAM_BURST = 3
+# 待发送的 Telegram 消息数量上限，超出后丢弃最早的消息
+TELEGRAM_OUTBOX_SIZE = 100
+# 通知中每个媒体库每种变动最多显示的文件名数量，其余只计数
+NOTIFICATION_SAMPLE_SIZE = 5
+# 变动汇总中文件名样本的内存上限（字节），超出后新的变动只计数、不再保存文件名
+CHANGE_STORE_MAX_BYTES = 1024 * 1024
+
+# 文件稳定检测：新文件的大小和修改时间在该时长内保持不变后才加入扫描队列（秒），0 表示关闭
+# 用于避免 SMB 拷贝大文件或下载器写入未完成时 Emby 扫描到半成品文件
+FILE_STABLE_SECONDS = 30
+# 稳定检测的检查间隔（秒）
+FILE_STABLE_CHECK_INTERVAL_SECONDS = 5
+# 文件持续变化时的最长等待时间（秒），超过后无论是否稳定都加入扫描队列
+FILE_STABLE_MAX_WAIT_SECONDS = 3600
+# 整个文件夹被移入或创建时，在后台线程中遍历其中的视频文件用于通知计数，
+# 并向 Emby 发送一个文件夹级别的路径更新；单个文件夹最多遍历的条目数量
+DIRECTORY_SCAN_MAX_ENTRIES = 100000
+
+# HTTP 请求：复用连接，失败时按指数退避（带随机抖动）重试，连续失败后熔断
+HTTP_MAX_RETRIES = 3
+# 重试退避基数（秒），第 n 次重试最多等待 基数 * 2^n 秒
+HTTP_RETRY_BACKOFF_SECONDS = 1
+# 同时发送的 Emby 请求数量上限
+EMBY_MAX_CONCURRENT_REQUESTS = 4
+# 连续失败达到该次数后熔断，熔断期间请求直接失败，不再连接服务器
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = 5
+# 熔断持续时间（秒），之后允许一次试探请求
+CIRCUIT_BREAKER_RESET_SECONDS = 60
+# 扫描请求因网络错误、5xx 或熔断发送失败时放回队列，重试间隔从该值开始逐次翻倍（秒）；
+# 被拒绝（4xx）或路径无法映射的请求重试也不会成功，直接放弃
+SCAN_RETRY_BACKOFF_SECONDS = 30
+# 扫描请求重试间隔的上限（秒）
+SCAN_RETRY_MAX_BACKOFF_SECONDS = 1800
+
+# Emby 更新模式
+# "path": 将变动文件路径精确发送给 Emby（推荐，大型媒体库无需整库扫描）
+# "library": 按媒体库根目录扫描（旧版行为）
+EMBY_UPDATE_MODE = "path"
+# 单次 POST 请求中包含的最大路径数量，超过会自动分批发送
+PATH_UPDATE_CHUNK_SIZE = 100
+# 同一文件夹下变动文件数达到该值时，合并为一条文件夹更新
+PATH_UPDATE_COLLAPSE_THRESHOLD = 5
+# 单个媒体库在一个周期内的路径更新数超过该值时，回退为媒体库根目录扫描
+PATH_UPDATE_LIBRARY_FALLBACK_THRESHOLD = 500
+# 一个周期内所有媒体库的路径更新总数超过该值时，回退为全部媒体库扫描（/Library/Refresh）
+PATH_UPDATE_FULL_REFRESH_THRESHOLD = 5000
+# 删除的文件和移走的文件/文件夹以 UpdateType=Deleted 通知 Emby，及时清除失效的媒体条目；False 表示删除不刷新
+EMBY_SEND_DELETIONS = True
+# 删除安全阈值：单个媒体库一个周期内的删除路径数超过该值，或媒体库根目录不可访问（如挂载断开）时，
+# 不发送删除更新，只在日志和通知中告警，避免误删整个媒体库
+DELETION_SAFETY_THRESHOLD = 200
+
+# 轮询监控（适用于 inotify 无法感知远端变动的 CIFS/rclone 等网络挂载点）
+# 列出的根目录必须同时配置在 MONITORED_FOLDERS_TO_LIBRARY_ID_MAP 中，这些目录改为增量快照轮询，不再使用 inotify
+POLLING_FOLDERS = [
+    # "/volume1/Video/网盘电影",
+]
+# 轮询间隔（秒）
+POLLING_INTERVAL_SECONDS = 60
+# 并行列目录的工作线程数
+POLLING_WORKERS = 8
+# 单次轮询的最长耗时（秒），超出后剩余目录在下次轮询继续
+POLLING_BUDGET_SECONDS = 30
+# 目录索引持久化文件，重启后可发现停机期间的变动
+POLLING_INDEX_PATH = "/volume5/docker/EmbyFMB/EmbyFMB_poll_index.json"
+
+# inotify 监控预算：每个被监控的目录占用一个内核监控，上限为 /proc/sys/fs/inotify/max_user_watches（同一用户的所有进程共享）
+# 达到预算后，尚未监控的子目录改为增量快照轮询。0 表示使用内核上限的 90%
+INOTIFY_WATCH_BUDGET = 0
+# 启动时并行添加监控的线程数（每个监控根目录一个任务）
+WATCH_SETUP_WORKERS = 4
+
+# 变动日志（SQLite WAL 模式），记录尚未成功发送给 Emby 的扫描请求
+# 脚本崩溃或 NAS 重启后会重新加入队列，并检查停机期间发生变动的目录。留空表示关闭
+JOURNAL_PATH = "/volume5/docker/EmbyFMB/EmbyFMB_journal.db"
+# 变动日志的批量提交间隔（秒）
+JOURNAL_COMMIT_INTERVAL_SECONDS = 1
+
+# 监控指标：在该端口提供 Prometheus 格式的 /metrics 接口（仅使用标准库），0 表示关闭
+METRICS_PORT = 0
+METRICS_BIND_ADDRESS = "0.0.0.0"
+
+# 多主机模式：多台 NAS 共用一个 Emby 服务器时，避免同一媒体库被重复扫描、同一批变动被分别通知
+# "standalone": 单机运行（默认）
+# "agent": 只监控本机目录，把扫描请求（已转换为容器内部路径）和变动汇总转发给汇总端，不直接请求 Emby 和 Telegram；
+#          汇总端不可用时变动保留在本机队列（及变动日志）中，恢复后补发。建议调小本机的 SCAN_DEBOUNCE_SECONDS
+#          和 SCAN_MIN_INTERVAL_SECONDS，由汇总端统一防抖
+# "aggregator": 接收各代理转发的变动，与本机的变动一起去重、调度扫描和发送通知
+CLUSTER_MODE = "standalone"
+# 汇总端监听的地址和端口（aggregator 模式）
+AGGREGATOR_BIND_ADDRESS = "0.0.0.0"
+AGGREGATOR_PORT = 8097
+# 代理连接的汇总端地址（agent 模式）
+AGGREGATOR_URL = "http://10.0.0.3:8097"
+# 代理与汇总端之间的共享密钥，两端需一致。汇总端接口可以发送删除更新，agent/aggregator 模式下必须设置
+CLUSTER_TOKEN = ""
+# 代理名称，显示在汇总端日志中，留空时使用主机名
+AGENT_NAME = ""
+
+# 外部配置文件（JSON），其中的同名配置项会覆盖本节中的值，格式如 {"EMBY_API_KEY": "...", "SCAN_DEBOUNCE_SECONDS": 30}
+# 文件不存在时只使用本节的配置。修改后发送 SIGHUP 信号（kill -HUP <进程号>）或等待自动检测即可重新加载，
+# 媒体库映射、过滤规则、扫描调度、Emby/Telegram 连接等配置立即生效，日志、轮询、变动日志等其余配置需要重启
+CONFIG_FILE_PATH = "/volume5/docker/EmbyFMB/EmbyFMB.json"
+# 检查配置文件是否被修改的间隔（秒），0 表示只在收到 SIGHUP 时重新加载
+CONFIG_CHECK_INTERVAL_SECONDS = 10
 
 # --- 配置结束 ---
 
-# 单实例锁检查
+# 可以由配置文件覆盖的配置项（上方配置部分定义的全部常量）
+CONFIG_NAMES = frozenset(name for name in globals() if name.isupper()) - {"CONFIG_FILE_PATH"}
+# 重新加载时可以立即生效的配置项，其余配置项修改后需要重启
+RELOADABLE_CONFIG_NAMES = frozenset({
+    "EMBY_SERVER_URL", "EMBY_API_KEY", "TELEGRAM_BOT_TOKEN", "TELEGRAM_CHAT_ID", "TELEGRAM_API_URL",
+    "SCAN_INTERVAL_SECONDS", "SCAN_DEBOUNCE_SECONDS", "SCAN_MAX_LATENCY_SECONDS", "SCAN_MIN_INTERVAL_SECONDS",
+    "EMBY_SCAN_TRACKING", "EMBY_STATUS_POLL_SECONDS", "EMBY_SCAN_START_GRACE_SECONDS", "EMBY_BUSY_MAX_HOLD_SECONDS",
+    "NAS_TO_CONTAINER_PATH_MAP", "MONITORED_FOLDERS_TO_LIBRARY_ID_MAP", "LIBRARY_ID_TO_NAME",
+    "LIBRARY_PATH_REWRITE_RULES", "VIDEO_EXTENSIONS", "IGNORED_DIR_NAMES", "INCLUDE_PATTERNS", "EXCLUDE_PATTERNS",
+    "TELEGRAM_NOTIFICATION_FOOTER", "NOTIFICATION_WINDOW_SECONDS", "TELEGRAM_MESSAGES_PER_MINUTE",
+    "TELEGRAM_BURST", "TELEGRAM_OUTBOX_SIZE", "FILE_STABLE_SECONDS", "FILE_STABLE_CHECK_INTERVAL_SECONDS",
+    "FILE_STABLE_MAX_WAIT_SECONDS", "DIRECTORY_SCAN_MAX_ENTRIES", "HTTP_MAX_RETRIES", "HTTP_RETRY_BACKOFF_SECONDS",
+    "CIRCUIT_BREAKER_FAILURE_THRESHOLD", "CIRCUIT_BREAKER_RESET_SECONDS", "SCAN_RETRY_BACKOFF_SECONDS",
+    "SCAN_RETRY_MAX_BACKOFF_SECONDS", "EMBY_UPDATE_MODE",
+    "PATH_UPDATE_CHUNK_SIZE", "PATH_UPDATE_COLLAPSE_THRESHOLD", "PATH_UPDATE_LIBRARY_FALLBACK_THRESHOLD",
+    "PATH_UPDATE_FULL_REFRESH_THRESHOLD", "EMBY_SEND_DELETIONS", "DELETION_SAFETY_THRESHOLD",
+})
+# 在 0（关闭）和非 0 之间切换时需要重启的配置项（对应的线程只在启动时创建）
+RESTART_ON_TOGGLE_CONFIG_NAMES = frozenset({"SCAN_DEBOUNCE_SECONDS", "FILE_STABLE_SECONDS"})
+# 数值配置项的下限（令牌桶的速率和容量小于 1 时发送线程会除零或永远等待）
+CONFIG_MINIMUMS = {"TELEGRAM_MESSAGES_PER_MINUTE": 1, "TELEGRAM_BURST": 1}
+
+# 单实例锁检查（只能防止同一主机上重复运行，多主机之间由汇总端统一调度）
+instance_lock_file = None  # 锁文件需要在进程运行期间保持打开，关闭后锁即被释放
+
 def single_instance_lock(lockfile):
+    global instance_lock_file
     try:
         lock_file = open(lockfile, 'w')
         fcntl.lockf(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        instance_lock_file = lock_file
         return True
     except IOError:
         return False
 
 # 全局变量，用于在线程间共享待处理的扫描请求
 scan_requests = set()
-file_changes = []  # 存储文件变动信息
+scan_paths = defaultdict(dict)  # 媒体库ID -> {NAS路径: Emby更新类型}，用于路径精确更新
+file_changes = None  # 本统计周期的文件变动汇总，在下方 ChangeAggregate 定义后初始化
 FULL_SCAN_MARKER = "full_scan"
-log_lock = threading.Lock()
-notification_queue = []  # 存储待通知的文件变动信息
+REMOTE_PATH_PREFIX = "emby:"  # 汇总端队列中代理转发的路径（已是容器内部路径）的前缀
+agent_library_roots = defaultdict(set)  # 媒体库ID -> 代理上报的容器内部根目录，用于回退为媒体库扫描
+log_lock = None  # 全局锁，在下方 TimedLock 定义后初始化
+notification_queue = None  # 待通知的文件变动汇总，在下方 ChangeAggregate 定义后初始化
 last_notification_time = 0  # 上次通知时间（时间戳）
 notification_thread_running = True  # 通知线程运行标志
 
+class Metrics:
+    """
+    线程安全的计数器、直方图和实时指标，按 Prometheus 文本格式输出。
+    未启用 /metrics 接口时 inc() 和 observe() 直接返回，不产生额外开销。
+    """
+    LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+    DELAY_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._families = {}  # 指标名 -> [类型, 说明, 标签名, 直方图区间, {标签值: 数值或直方图}]
+        self._gauges = {}  # 指标名 -> (说明, 标签名, 回调函数)
+
+    def counter(self, name, help_text, labels=()):
+        self._families[name] = ["counter", help_text, labels, None, {}]
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self._families[name] = ["histogram", help_text, labels, buckets, {}]
+
+    def gauge(self, name, help_text, callback, labels=()):
+        """注册实时指标，回调返回数值，或有标签时返回 {标签值元组: 数值}"""
+        self._gauges[name] = (help_text, labels, callback)
+
+    def inc(self, name, labels=(), value=1):
+        if not self.enabled:
+            return
+        values = self._families[name][4]
+        with self._lock:
+            values[labels] = values.get(labels, 0) + value
+
+    def observe(self, name, value, labels=()):
+        if not self.enabled:
+            return
+        family = self._families[name]
+        buckets = family[3]
+        index = bisect.bisect_left(buckets, value)
+        with self._lock:
+            series = family[4].get(labels)
+            if series is None:
+                # 各区间的计数、总和、次数
+                series = family[4][labels] = [0] * len(buckets) + [0.0, 0]
+            if index < len(buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @staticmethod
+    def _labels(names, values, le=None):
+        """格式化标签，如 {library="电影",le="0.5"}"""
+        pairs = []
+        for name, value in zip(names, values):
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+            pairs.append(f'{name}="{value}"')
+        if le is not None:
+            pairs.append(f'le="{le}"')
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self):
+        """按 Prometheus 文本格式输出所有指标"""
+        lines = []
+        with self._lock:
+            # 锁内只复制数值，格式化在锁外进行
+            families = [(name, kind, help_text, labels, buckets,
+                         {key: list(value) if kind == "histogram" else value for key, value in values.items()})
+                        for name, (kind, help_text, labels, buckets, values) in self._families.items()]
+        for name, kind, help_text, labels, buckets, values in families:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in values.items():
+                if kind == "counter":
+                    lines.append(f"{name}{self._labels(labels, key)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets, value):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels(labels, key, bound)} {cumulative}")
+                lines.append(f"{name}_bucket{self._labels(labels, key, '+Inf')} {value[-1]}")
+                lines.append(f"{name}_sum{self._labels(labels, key)} {value[-2]}")
+                lines.append(f"{name}_count{self._labels(labels, key)} {value[-1]}")
+        for name, (help_text, labels, callback) in self._gauges.items():
+            try:
+                value = callback()
+            except Exception:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            if isinstance(value, dict):
+                for key, item in value.items():
+                    lines.append(f"{name}{self._labels(labels, key)} {item}")
+            else:
+                lines.append(f"{name} {value}")
+        lines.append("")
+        return "\n".join(lines)
+
+metrics = Metrics()
+metrics.counter("embyfmb_events_total", "加入队列的视频文件变动数", ("event_type", "library"))
+metrics.counter("embyfmb_ignored_events_total", "被过滤规则忽略的事件数", ("reason",))
+metrics.histogram("embyfmb_lock_wait_seconds", "全局锁等待时间")
+metrics.histogram("embyfmb_lock_hold_seconds", "全局锁持有时间")
+metrics.histogram("embyfmb_handler_seconds", "文件事件回调的处理耗时", ("handler",))
+metrics.histogram("embyfmb_http_request_seconds", "Emby/Telegram 请求耗时（每次尝试）", ("service",))
+metrics.counter("embyfmb_http_responses_total", "Emby/Telegram 请求结果（状态码或错误）", ("service", "code"))
+metrics.counter("embyfmb_scans_total", "发送给 Emby 的扫描请求数", ("library", "result"))
+metrics.histogram("embyfmb_change_to_scan_seconds", "从首次文件变动到发送 Emby 扫描的时间", ("library",),
+                  buckets=Metrics.DELAY_BUCKETS)
+
+class LatencyStats:
+    """线程安全的耗时统计（次数、总耗时、最大耗时），用于观察锁竞争和处理延迟"""
+    __slots__ = ('_lock', 'count', 'total', 'max', 'metric')
+
+    def __init__(self, metric=None):
+        """:param metric: 同时记录到该直方图指标"""
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.metric = metric
+
+    def record(self, seconds):
+        if self.metric:
+            metrics.observe(self.metric, seconds)
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def snapshot(self, reset=False):
+        """返回 (次数, 平均耗时, 最大耗时)，单位为秒"""
+        with self._lock:
+            result = (self.count, self.total / self.count if self.count else 0.0, self.max)
+            if reset:
+                self.count = 0
+                self.total = 0.0
+                self.max = 0.0
+        return result
+
+class TimedLock:
+    """带等待时间和持有时间统计的互斥锁，用法与 threading.Lock 相同"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._acquired_at = 0.0
+        self.wait_stats = LatencyStats("embyfmb_lock_wait_seconds")
+        self.hold_stats = LatencyStats("embyfmb_lock_hold_seconds")
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self._lock.acquire()
+        self._acquired_at = time.perf_counter()
+        self.wait_stats.record(self._acquired_at - start)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        held = time.perf_counter() - self._acquired_at
+        self._lock.release()
+        self.hold_stats.record(held)
+        return False
+
+log_lock = TimedLock()
+handler_latency = LatencyStats()  # 文件事件回调的处理耗时
+
+class ChangeGroup:
+    """同一种变动、同一媒体库的汇总：变动次数和少量文件名样本"""
+    __slots__ = ('count', 'samples')
+
+    def __init__(self):
+        self.count = 0
+        self.samples = []
+
+class ChangeAggregate:
+    """
+    按 (变动类型, 媒体库ID) 增量汇总的文件变动，内存占用与事件数量无关。
+    每组最多保存 sample_size 个文件名样本，所有样本合计不超过 max_bytes，
+    超出上限的文件名只计数不保存，并计入 dropped。调用方需持有 log_lock。
+    未指定的上限在使用时读取 NOTIFICATION_SAMPLE_SIZE / CHANGE_STORE_MAX_BYTES（可能来自配置文件）。
+    """
+    __slots__ = ('_groups', '_sample_size', '_max_bytes', '_bytes', 'total', 'dropped')
+
+    def __init__(self, sample_size=None, max_bytes=None):
+        self._groups = {}  # (变动类型, 媒体库ID) -> ChangeGroup
+        self._sample_size = sample_size
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self.total = 0
+        self.dropped = 0
+
+    @property
+    def sample_size(self):
+        return NOTIFICATION_SAMPLE_SIZE if self._sample_size is None else self._sample_size
+
+    @property
+    def max_bytes(self):
+        return CHANGE_STORE_MAX_BYTES if self._max_bytes is None else self._max_bytes
+
+    def __len__(self):
+        return self.total
+
+    def __bool__(self):
+        return self.total > 0
+
+    def add(self, event_type, library_id, path):
+        """记录一次变动"""
+        self.add_many(event_type, library_id, (path,))
+
+    def add_many(self, event_type, library_id, paths):
+        """记录同一种变动、同一媒体库的多个文件（如整个文件夹移入）"""
+        group = self._groups.get((event_type, library_id))
+        if group is None:
+            group = self._groups[(event_type, library_id)] = ChangeGroup()
+        group.count += len(paths)
+        self.total += len(paths)
+        for path in paths[:max(self.sample_size - len(group.samples), 0)]:
+            # 只保存用于显示的文件名，过长的文件名截断后保存
+            filename = os.path.basename(path)
+            if len(filename) > 50:
+                filename = filename[:47] + "..."
+            size = sys.getsizeof(filename)
+            if self._bytes + size > self.max_bytes:
+                self.dropped += 1
+                continue
+            self._bytes += size
+            group.samples.append(filename)
+
+    def merge(self, other):
+        """把另一个汇总合并到当前汇总之后（用于发送失败时放回队列）"""
+        for (event_type, library_id), other_group in other._groups.items():
+            group = self._groups.get((event_type, library_id))
+            if group is None:
+                group = self._groups[(event_type, library_id)] = ChangeGroup()
+            group.count += other_group.count
+            for filename in other_group.samples:
+                size = sys.getsizeof(filename)
+                if len(group.samples) >= self.sample_size or self._bytes + size > self.max_bytes:
+                    break
+                self._bytes += size
+                group.samples.append(filename)
+        self.total += other.total
+        self.dropped += other.dropped
+
+    @classmethod
+    def from_groups(cls, groups):
+        """由 groups() 的结果重建汇总（用于汇总端接收代理转发的变动）"""
+        aggregate = cls()
+        for event_type, libraries in groups:
+            for library_id, count, samples in libraries:
+                other = cls()
+                group = other._groups[(str(event_type), str(library_id))] = ChangeGroup()
+                group.count = int(count)
+                group.samples = [str(filename) for filename in samples]
+                other.total = group.count
+                aggregate.merge(other)
+        return aggregate
+
+    def groups(self):
+        """按首次出现的顺序返回 [(变动类型, [(媒体库ID, 次数, 文件名样本), ...]), ...]"""
+        by_event_type = {}
+        for (event_type, library_id), group in self._groups.items():
+            by_event_type.setdefault(event_type, []).append((library_id, group.count, group.samples))
+        return list(by_event_type.items())
+
+file_changes = ChangeAggregate(sample_size=0)
+notification_queue = ChangeAggregate()
+
+def measure_latency(stats):
+    """装饰器：记录函数的执行耗时"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                stats.record(elapsed)
+                metrics.observe("embyfmb_handler_seconds", elapsed, (func.__name__,))
+        return wrapper
+    return decorator
+
+def log_performance_stats():
+    """输出本周期的锁竞争和事件处理耗时统计，并重置计数"""
+    wait_count, wait_avg, wait_max = log_lock.wait_stats.snapshot(reset=True)
+    _, hold_avg, hold_max = log_lock.hold_stats.snapshot(reset=True)
+    event_count, event_avg, event_max = handler_latency.snapshot(reset=True)
+    logger.info(f"📊 全局锁: {wait_count} 次, 等待 平均 {wait_avg * 1000:.2f} ms / 最大 {wait_max * 1000:.2f} ms, "
+                f"持有 平均 {hold_avg * 1000:.2f} ms / 最大 {hold_max * 1000:.2f} ms")
+    logger.info(f"📊 事件处理: {event_count} 次, 平均 {event_avg * 1000:.2f} ms / 最大 {event_max * 1000:.2f} ms")
+    if log_queue_handler is not None and log_queue_handler.dropped:
+        logger.warning(f"⚠️ 日志队列已满，累计丢弃 {log_queue_handler.dropped} 条日志")
+    ignored = path_filter.snapshot(reset=True)
+    if ignored:
+        logger.info("📊 已忽略事件: " + ", ".join(f"{reason} {count} 次" for reason, count in ignored.items()))
+    for library_id, stats in list(scan_tracker.durations.items()):
+        scan_count, scan_avg, scan_max = stats.snapshot()
+        library_name = "全部媒体库" if library_id == FULL_SCAN_MARKER else \
+            LIBRARY_ID_TO_NAME.get(library_id, f"未知({library_id})")
+        logger.info(f"📊 【{library_name}】Emby 扫描耗时: {scan_count} 次, 平均 {scan_avg:.0f} 秒 / 最长 {scan_max:.0f} 秒")
+
+class PathFilter:
+    """
+    预编译的路径过滤器：忽略目录、包含/排除通配符和视频扩展名。
+    被忽略的事件只做计数，不再逐条写日志。
+    """
+
+    def __init__(self, ignored_dir_names, include_patterns, exclude_patterns, extensions):
+        self.ignored_dir_names = frozenset(ignored_dir_names)
+        self._dir_regex = None
+        if self.ignored_dir_names:
+            names = '|'.join(re.escape(name) for name in self.ignored_dir_names)
+            self._dir_regex = re.compile(f"(?:^|/)(?:{names})(?:/|$)")
+        self._include = self._compile(include_patterns)
+        self._exclude = self._compile(exclude_patterns)
+        self._extensions = tuple(ext.lower() for ext in extensions)
+        self._counts = defaultdict(int)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _compile(patterns):
+        if not patterns:
+            return None
+        return re.compile('|'.join(fnmatch.translate(pattern) for pattern in patterns), re.IGNORECASE)
+
+    def is_ignored_dir(self, path):
+        """路径是否位于忽略的目录中"""
+        return self._dir_regex is not None and self._dir_regex.search(path) is not None
+
+    def reject_reason(self, path):
+        """返回路径被忽略的原因，需要处理时返回 None"""
+        if self.is_ignored_dir(os.path.dirname(path)):
+            return "忽略目录"
+        name = os.path.basename(path)
+        if self._exclude is not None and self._exclude.match(name):
+            return "排除规则"
+        if self._include is not None:
+            return None if self._include.match(name) else "非视频文件"
+        return None if name.lower().endswith(self._extensions) else "非视频文件"
+
+    def matches(self, path):
+        """路径是否需要处理（不计数）"""
+        return self.reject_reason(path) is None
+
+    def accept(self, *paths):
+        """任一路径需要处理时返回 True，否则按第一个路径的忽略原因计数"""
+        reason = None
+        for path in paths:
+            reason = self.reject_reason(path)
+            if reason is None:
+                return True
+        self.count_ignored(reason)
+        return False
+
+    def count_ignored(self, reason):
+        """记录一次被忽略的事件"""
+        with self._lock:
+            self._counts[reason] += 1
+        metrics.inc("embyfmb_ignored_events_total", (reason,))
+
+    def snapshot(self, reset=False):
+        """返回 {忽略原因: 次数}"""
+        with self._lock:
+            counts = dict(self._counts)
+            if reset:
+                self._counts.clear()
+        return counts
+
+path_filter = PathFilter(IGNORED_DIR_NAMES, INCLUDE_PATTERNS, EXCLUDE_PATTERNS, VIDEO_EXTENSIONS)
+
+if Inotify is not None:
+    class FilteredInotify(Inotify):
+        """
+        不为忽略目录添加内核监控的 inotify 封装。
+        监控数达到预算后，尚未监控的目录只登记占位描述符，整棵子树交给轮询（on_cold_dir 回调）。
+        """
+        watch_count = 0  # 当前占用的 inotify 监控数量
+        skipped_count = 0  # 跳过的忽略目录数量
+        watch_budget = float('inf')  # 监控数预算，由 create_observer 设置
+        cold_dirs = set()  # 超出预算、改为轮询的目录（其子目录不再单独记录）
+        on_cold_dir = None  # 回调 (目录路径)，有目录改为轮询时调用
+        on_cold_dir_removed = None  # 回调 (目录路径)，改为轮询的目录被删除或移走时调用
+        _lock = threading.Lock()
+        _fake_wd = -1
+
+        def __init__(self, path, *, recursive=False, event_mask=None):
+            self._own_watch_count = 0
+            start = time.monotonic()
+            try:
+                super().__init__(path, recursive=recursive, event_mask=event_mask)
+            except OSError:
+                # 遍历中途失败（如超出 max_user_instances）时关闭已创建的实例，内核随之移除已添加的监控，并归还预算
+                if hasattr(self, "_kill_w"):
+                    self._is_reading = False  # 读取线程还未启动，由 close() 直接释放描述符
+                    self.close()
+                elif hasattr(self, "_inotify_fd"):
+                    os.close(self._inotify_fd)
+                raise
+            logger.info(f"📊 {os.fsdecode(path)}: 添加 {self._own_watch_count} 个 inotify 监控，"
+                        f"耗时 {time.monotonic() - start:.2f} 秒")
+
+        def close(self):
+            super().close()
+            # 释放本实例占用的预算（移除监控时内核会回收对应的监控）
+            with FilteredInotify._lock:
+                FilteredInotify.watch_count -= self._own_watch_count
+                self._own_watch_count = 0
+
+        def read_events(self, *args, **kwargs):
+            events = super().read_events(*args, **kwargs)
+            released = 0
+            gone = []
+            moved_in = []
+            for event in events:
+                if event.is_ignored:
+                    # 目录被删除后内核自动移除监控（IN_IGNORED），归还预算名额；占位描述符不会产生内核事件
+                    released += 1
+                elif event.is_directory and (event.is_delete or event.is_moved_from):
+                    gone.append(os.fsdecode(event.src_path))
+                elif event.is_directory and event.is_moved_to:
+                    moved_in.append(event.src_path)
+            if released:
+                self._release_watch(released)
+            if gone and FilteredInotify.cold_dirs:
+                FilteredInotify.forget_cold_dirs(gone)
+            for path in moved_in:
+                if path in self._wd_for_path:
+                    self._mark_moved_cold_dirs(path)
+                elif self.is_recursive:
+                    self._watch_moved_in_dir(path)
+            return events
+
+        def _watch_moved_in_dir(self, path):
+            # 从监控范围外移入的目录没有对应的 moved_from，watchdog 不会为其添加监控，
+            # 这里遍历整棵子树补上（同样受预算限制，超出时改为轮询）
+            try:
+                with self._lock:
+                    if not self._closed:
+                        self._add_dir_watch(path, self._event_mask, recursive=True)
+            except OSError as e:
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    logger.warning(f"⚠️ 无法监控移入的目录 {os.fsdecode(path)}: {e}")
+
+        def _mark_moved_cold_dirs(self, path):
+            # 目录在监控范围内移动时，watchdog 把占位描述符一并改到新路径下，其中原本轮询的子树按新路径重新轮询
+            prefix = path + os.sep.encode()
+            moved = sorted(moved_path for moved_path, wd in self._wd_for_path.items()
+                           if wd < 0 and (moved_path == path or moved_path.startswith(prefix)))
+            for moved_path in moved:
+                if not path_filter.is_ignored_dir(os.fsdecode(moved_path)):
+                    self.mark_cold(moved_path)
+
+        def _add_dir_watch(self, path, mask, *, recursive):
+            # 与 watchdog 的实现相同，但遍历时不进入忽略的目录和改为轮询的目录
+            if not os.path.isdir(path):
+                raise OSError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), path)
+            if self._add_watch(path, mask) < 0 or not recursive:
+                return
+            for root, dirnames, _ in os.walk(path):
+                kept = []
+                for dirname in dirnames:
+                    if os.fsdecode(dirname) in path_filter.ignored_dir_names:
+                        FilteredInotify.skipped_count += 1
+                        continue
+                    full_path = os.path.join(root, dirname)
+                    if os.path.islink(full_path):
+                        continue
+                    try:
+                        wd = self._add_watch(full_path, mask)
+                    except OSError as e:
+                        # 遍历期间被删除或替换为文件的子目录直接跳过
+                        if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                            raise
+                        continue
+                    if wd >= 0:
+                        kept.append(dirname)
+                dirnames[:] = kept
+
+        def _add_placeholder(self, path):
+            # 只登记占位描述符（内核不会产生负数描述符），保持 watchdog 内部记录一致
+            with FilteredInotify._lock:
+                FilteredInotify._fake_wd -= 1
+                wd = FilteredInotify._fake_wd
+            self._wd_for_path[path] = wd
+            self._path_for_wd[wd] = path
+            return wd
+
+        def _reserve_watch(self):
+            """占用一个监控名额，超出预算时返回 False"""
+            with FilteredInotify._lock:
+                if FilteredInotify.watch_count >= FilteredInotify.watch_budget:
+                    return False
+                FilteredInotify.watch_count += 1
+                self._own_watch_count += 1
+                return True
+
+        def _release_watch(self, count=1):
+            with FilteredInotify._lock:
+                FilteredInotify.watch_count -= count
+                self._own_watch_count -= count
+
+        def _add_watch(self, path, mask):
+            if path_filter.is_ignored_dir(os.fsdecode(path)):
+                # 运行中新建的忽略目录同样不添加内核监控
+                FilteredInotify.skipped_count += 1
+                return self._add_placeholder(path)
+            known_wd = self._wd_for_path.get(path)
+            if known_wd is not None and known_wd >= 0:
+                # 已监控的目录（如重复的创建事件），内核返回相同的描述符，不占用新的名额
+                return super()._add_watch(path, mask)
+            if not self._reserve_watch():
+                self.mark_cold(path)
+                return self._add_placeholder(path)
+            try:
+                return super()._add_watch(path, mask)
+            except OSError as e:
+                self._release_watch()
+                if e.errno != errno.ENOSPC:
+                    raise
+                # 其他进程也在使用 inotify，实际可用的监控数少于预算，以当前占用数作为新的预算
+                with FilteredInotify._lock:
+                    first = FilteredInotify.watch_budget > FilteredInotify.watch_count
+                    FilteredInotify.watch_budget = FilteredInotify.watch_count
+                if first:
+                    logger.error(f"🔴 inotify 监控数达到内核上限（fs.inotify.max_user_watches="
+                                 f"{inotify_watch_limit()}），可调大该内核参数")
+                self.mark_cold(path)
+                return self._add_placeholder(path)
+
+        @classmethod
+        def mark_cold(cls, path):
+            """将目录（及其子树）改为轮询，已在轮询子树内的目录忽略"""
+            path = os.fsdecode(path)
+            with cls._lock:
+                parent = path
+                while parent not in ('/', ''):
+                    if parent in cls.cold_dirs:
+                        return
+                    parent = os.path.dirname(parent)
+                first = not cls.cold_dirs
+                cls.cold_dirs.add(path)
+                callback = cls.on_cold_dir
+            if first:
+                logger.warning(f"⚠️ inotify 监控数已达到预算 {cls.watch_budget}，尚未监控的子目录改为轮询")
+            if callback:
+                callback(path)
+
+        @classmethod
+        def forget_cold_dirs(cls, paths):
+            """被删除或移走的目录（及其子目录）不再轮询"""
+            prefixes = tuple(path.rstrip('/') + '/' for path in paths)
+            with cls._lock:
+                removed = [cold for cold in cls.cold_dirs if cold in paths or cold.startswith(prefixes)]
+                cls.cold_dirs.difference_update(removed)
+                callback = cls.on_cold_dir_removed
+            if callback:
+                for path in removed:
+                    callback(path)
+
+    class FilteredInotifyBuffer(InotifyBuffer):
+        """使用 FilteredInotify 的事件缓冲区"""
+
+        def __init__(self, path, *, recursive=False, event_mask=None):
+            BaseThread.__init__(self)
+            self._queue = DelayedQueue(self.delay)
+            self._inotify = FilteredInotify(path, recursive=recursive, event_mask=event_mask)
+            self.start()
+
+    class FilteredInotifyEmitter(InotifyEmitter):
+        """使用 FilteredInotifyBuffer 的事件发射器"""
+
+        def on_thread_start(self):
+            path = os.fsencode(self.watch.path)
+            event_mask = self.get_event_mask_from_filter()
+            self._inotify = FilteredInotifyBuffer(path, recursive=self.watch.is_recursive, event_mask=event_mask)
+
+    class FilteredObserver(BaseObserver):
+        """跳过忽略目录的 inotify 观察者"""
+
+        def __init__(self, timeout=1):
+            super().__init__(FilteredInotifyEmitter, timeout=timeout)
+            self.failed_watches = []  # 启动时无法添加监控的根目录
+
+        @staticmethod
+        def _start_emitter(emitter):
+            try:
+                emitter.start()
+            except OSError as e:
+                return e
+            return None
+
+        def start(self):
+            # 与 BaseObserver.start 相同，但各根目录并行遍历目录树、添加监控；
+            # 单个根目录失败（如超出 max_user_instances）时移除该监控并记录，而不是中止启动
+            emitters = list(self._emitters)
+            with ThreadPoolExecutor(max_workers=max(1, WATCH_SETUP_WORKERS),
+                                    thread_name_prefix="WatchSetup") as executor:
+                errors = list(executor.map(self._start_emitter, emitters))
+            for emitter, error in zip(emitters, errors):
+                if error is None:
+                    continue
+                logger.error(f"🔴 无法监控 {emitter.watch.path}: {error}")
+                self.unschedule(emitter.watch)
+                self.failed_watches.append(emitter.watch.path)
+            super(BaseObserver, self).start()
+
+def inotify_watch_limit():
+    """读取内核的 inotify 监控数上限，无法读取时返回 None"""
+    try:
+        with open("/proc/sys/fs/inotify/max_user_watches") as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+def create_observer():
+    """创建文件系统观察者：Linux 上使用跳过忽略目录的 inotify 观察者，其他平台使用 watchdog 默认实现"""
+    if Inotify is not None:
+        if INOTIFY_WATCH_BUDGET > 0:
+            FilteredInotify.watch_budget = INOTIFY_WATCH_BUDGET
+        else:
+            limit = inotify_watch_limit()
+            FilteredInotify.watch_budget = int(limit * 0.9) if limit else float('inf')
+        return FilteredObserver()
+    return Observer()
+
+class ScanScheduler:
+    """
+    按媒体库独立调度扫描（尾沿防抖）：
+    媒体库最后一次变动 SCAN_DEBOUNCE_SECONDS 秒后扫描，
+    首次变动后最迟 SCAN_MAX_LATENCY_SECONDS 秒扫描，
+    并保证同一媒体库两次扫描间隔不少于 SCAN_MIN_INTERVAL_SECONDS 秒。
+    非线程安全，调用方需持有 log_lock。
+    """
+    __slots__ = ('_first_change', '_last_change', '_last_scan', '_unscanned_since')
+
+    def __init__(self):
+        self._first_change = {}
+        self._last_change = {}
+        self._last_scan = {}
+        self._unscanned_since = {}  # 媒体库ID -> 最早一次尚未发送扫描的变动时间
+
+    def note_change(self, library_id, now):
+        """记录媒体库的一次文件变动"""
+        self._first_change.setdefault(library_id, now)
+        self._last_change[library_id] = now
+        self._unscanned_since.setdefault(library_id, now)
+
+    def take_unscanned_since(self, library_ids):
+        """取出并清除这些媒体库最早一次尚未发送扫描的变动时间，返回 {媒体库ID: 时间戳}"""
+        return {library_id: self._unscanned_since.pop(library_id)
+                for library_id in library_ids if library_id in self._unscanned_since}
+
+    def ready_at(self, library_id):
+        """返回媒体库的计划扫描时间，没有待处理变动时返回 None"""
+        first_change = self._first_change.get(library_id)
+        if first_change is None:
+            return None
+        ready = min(self._last_change[library_id] + SCAN_DEBOUNCE_SECONDS,
+                    first_change + SCAN_MAX_LATENCY_SECONDS)
+        last_scan = self._last_scan.get(library_id)
+        if last_scan is not None:
+            ready = max(ready, last_scan + SCAN_MIN_INTERVAL_SECONDS)
+        return ready
+
+    def due(self, now, everything=False):
+        """
+        返回所有已到扫描时间的媒体库
+        :param everything: 为 True 时返回所有有待处理变动的媒体库
+        """
+        return {library_id for library_id in self._first_change
+                if everything or self.ready_at(library_id) <= now}
+
+    def mark_scanned(self, library_ids, now):
+        """记录媒体库已发送扫描，清除其待处理状态"""
+        for library_id in library_ids:
+            self._first_change.pop(library_id, None)
+            self._last_change.pop(library_id, None)
+            self._last_scan[library_id] = now
+
+scan_scheduler = ScanScheduler()
+
+class EmbyScanTracker:
+    """
+    跟踪 Emby 扫描进度。
+    /Library/Media/Updated 和 /Library/Refresh 返回 204 只表示 Emby 已接受请求，
+    这里通过 /Library/VirtualFolders 的 RefreshStatus 和计划任务 RefreshLibrary 的状态
+    判断扫描是否仍在进行，并记录每个媒体库的实际扫描耗时。
+    只在扫描主循环线程中使用。
+    """
+
+    def __init__(self):
+        self._in_flight = {}  # 媒体库ID -> [发送时间, 是否观察到扫描开始]
+        self._library_status = {}  # 媒体库ID -> RefreshStatus
+        self._refresh_task_running = False
+        self._last_poll = 0.0
+        self._held_since = {}  # 媒体库ID -> 开始暂缓的时间
+        self._last_held = set()
+        self.durations = defaultdict(LatencyStats)  # 媒体库ID -> 扫描耗时统计
+
+    def mark_started(self, library_ids, now):
+        """记录已发送扫描请求的媒体库"""
+        for library_id in library_ids:
+            self._in_flight[library_id] = [now, False]
+            self._held_since.pop(library_id, None)
+
+    def _fetch_status(self):
+        """查询 Emby 各媒体库的扫描状态，失败时返回 False"""
+        headers = {'X-Emby-Token': EMBY_API_KEY}
+        try:
+            response = emby_client.get(f"{EMBY_SERVER_URL}/emby/Library/VirtualFolders", headers=headers, timeout=10)
+            response.raise_for_status()
+            self._library_status = {
+                folder.get("ItemId"): folder.get("RefreshStatus")
+                for folder in response.json()
+            }
+            response = emby_client.get(f"{EMBY_SERVER_URL}/emby/ScheduledTasks", headers=headers, timeout=10)
+            response.raise_for_status()
+            self._refresh_task_running = any(
+                task.get("Key") == "RefreshLibrary" and task.get("State") in ("Running", "Cancelling")
+                for task in response.json()
+            )
+            return True
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.warning(f"⚠️ 查询 Emby 扫描状态失败: {e}")
+            self._library_status = {}
+            self._refresh_task_running = False
+            return False
+
+    def _is_active(self, library_id):
+        if library_id == FULL_SCAN_MARKER:
+            return self._refresh_task_running
+        return self._refresh_task_running or self._library_status.get(library_id) == "Active"
+
+    def poll(self, now, needed=False):
+        """
+        按 EMBY_STATUS_POLL_SECONDS 间隔刷新扫描状态，并处理已完成的扫描
+        :param needed: 有待发送的扫描请求时为 True；没有待发送请求且没有进行中的扫描时不查询
+        """
+        if not needed and not self._in_flight:
+            return
+        if now - self._last_poll < EMBY_STATUS_POLL_SECONDS:
+            return
+        self._last_poll = now
+        if not self._fetch_status():
+            return
+
+        for library_id, state in list(self._in_flight.items()):
+            started_at, seen_active = state
+            library_name = "全部媒体库" if library_id == FULL_SCAN_MARKER else \
+                LIBRARY_ID_TO_NAME.get(library_id, f"未知({library_id})")
+            if self._is_active(library_id):
+                state[1] = True
+            elif seen_active:
+                duration = now - started_at
+                self.durations[library_id].record(duration)
+                del self._in_flight[library_id]
+                logger.info(f"🟢 Emby【{library_name}】扫描已完成，耗时 {duration:.0f} 秒")
+            elif now - started_at >= EMBY_SCAN_START_GRACE_SECONDS:
+                # 未观察到扫描开始（路径更新通常很快完成），视为已完成
+                del self._in_flight[library_id]
+
+    def _is_busy(self, library_id):
+        if FULL_SCAN_MARKER in self._in_flight or self._refresh_task_running:
+            return True
+        if library_id == FULL_SCAN_MARKER:
+            return bool(self._in_flight) or "Active" in self._library_status.values()
+        return library_id in self._in_flight or self._library_status.get(library_id) == "Active"
+
+    def held_libraries(self, library_ids, now):
+        """返回因 Emby 正在扫描而需要暂缓的媒体库（超过最长暂缓时间的除外）"""
+        held = set()
+        for library_id in library_ids:
+            if not self._is_busy(library_id):
+                self._held_since.pop(library_id, None)
+                continue
+            held_since = self._held_since.setdefault(library_id, now)
+            if now - held_since < EMBY_BUSY_MAX_HOLD_SECONDS:
+                held.add(library_id)
+            else:
+                logger.warning(f"⚠️ 媒体库 {library_id} 已暂缓超过 {EMBY_BUSY_MAX_HOLD_SECONDS} 秒，仍发送扫描请求")
+        newly_held = held - self._last_held
+        if newly_held:
+            names = ["全部媒体库" if library_id == FULL_SCAN_MARKER else
+                     LIBRARY_ID_TO_NAME.get(library_id, f"未知({library_id})") for library_id in newly_held]
+            logger.info(f"🟡 Emby 正在扫描，暂缓并合并以下媒体库的请求:【{', '.join(names)}】")
+        self._last_held = held
+        return held
+
+scan_tracker = EmbyScanTracker()
+
+class ScanRetryBackoff:
+    """
+    发送失败的扫描请求的重试退避：暂时性失败（网络错误、5xx、熔断）的媒体库放回队列后，
+    按 SCAN_RETRY_BACKOFF_SECONDS 起逐次翻倍的间隔重试，发送成功或放弃后清除。
+    只在扫描主循环线程中使用。
+    """
+    __slots__ = ('_failures', '_retry_at')
+
+    def __init__(self):
+        self._failures = {}  # 媒体库ID -> 连续失败次数
+        self._retry_at = {}  # 媒体库ID -> 下次允许重试的时间
+
+    def record_failure(self, library_ids, now):
+        """记录一次发送失败，返回本次的重试间隔（秒，取其中最长的）"""
+        delay = 0
+        for library_id in library_ids:
+            failures = self._failures.get(library_id, 0) + 1
+            self._failures[library_id] = failures
+            library_delay = min(SCAN_RETRY_BACKOFF_SECONDS * 2 ** (failures - 1), SCAN_RETRY_MAX_BACKOFF_SECONDS)
+            self._retry_at[library_id] = now + library_delay
+            delay = max(delay, library_delay)
+        return delay
+
+    def clear(self, library_ids):
+        """发送成功或放弃后清除失败记录"""
+        for library_id in library_ids:
+            self._failures.pop(library_id, None)
+            self._retry_at.pop(library_id, None)
+
+    def failing(self):
+        """返回上次发送仍失败的媒体库"""
+        return set(self._failures)
+
+    def held_libraries(self, library_ids, now):
+        """返回还未到重试时间的媒体库"""
+        return {library_id for library_id in library_ids if self._retry_at.get(library_id, 0) > now}
+
+scan_retry = ScanRetryBackoff()
+
+class PathPrefixIndex:
+    """
+    按路径分量（而非字符）构建的前缀树，用于最长前缀匹配。
+    查询复杂度只与路径深度有关，与配置的根目录数量无关，
+    并且 /volume1/Video/电影2 不会被误匹配到 /volume1/Video/电影。
+    """
+    __slots__ = ('_root', '_size')
+
+    # 节点中存放匹配结果的键（不会与路径分量冲突）
+    _VALUE = object()
+
+    def __init__(self, mapping=None):
+        self._root = {}
+        self._size = 0
+        for prefix, value in (mapping or {}).items():
+            self.add(prefix, value)
+
+    def __len__(self):
+        return self._size
+
+    @staticmethod
+    def _split(path):
+        return [part for part in path.split('/') if part]
+
+    def add(self, prefix, value):
+        """添加一个前缀及其对应的值"""
+        node = self._root
+        for part in self._split(prefix):
+            node = node.setdefault(part, {})
+        if self._VALUE not in node:
+            self._size += 1
+        node[self._VALUE] = (prefix, value)
+
+    def longest_match(self, path):
+        """
+        查找与路径匹配的最长前缀
+        :return: (前缀, 值)，未匹配时返回 (None, None)
+        """
+        node = self._root
+        match = node.get(self._VALUE, (None, None))
+        for part in self._split(path):
+            node = node.get(part)
+            if node is None:
+                break
+            match = node.get(self._VALUE, match)
+        return match
+
+class PathLookup:
+    """由配置构建的路径查询表：路径->媒体库ID、媒体库ID->根目录、NAS路径->容器路径"""
+    __slots__ = ('folders', 'library_index', 'container_index', 'library_roots')
+
+    def __init__(self, folders_to_library_id, nas_to_container):
+        self.folders = dict(folders_to_library_id)
+        self.library_index = PathPrefixIndex(folders_to_library_id)
+        self.container_index = PathPrefixIndex(nas_to_container)
+        self.library_roots = defaultdict(list)
+        for folder, library_id in folders_to_library_id.items():
+            self.library_roots[library_id].append(folder)
+
+    def library_for(self, path):
+        """返回路径所属的媒体库ID，未匹配时返回 None"""
+        return self.library_index.longest_match(path)[1]
+
+    def roots_for(self, library_id):
+        """返回媒体库对应的全部 NAS 根目录"""
+        return self.library_roots.get(library_id, [])
+
+    def to_container(self, nas_path):
+        """将 NAS 路径转换为 Emby 容器内部路径，找不到映射时返回 None"""
+        nas_prefix, container_prefix = self.container_index.longest_match(nas_path)
+        if nas_prefix is None:
+            return None
+        relative = nas_path.rstrip('/')[len(nas_prefix.rstrip('/')):]
+        return (container_prefix.rstrip('/') + relative) or '/'
+
+# 启动时根据配置一次性构建路径索引
+path_lookup = PathLookup(MONITORED_FOLDERS_TO_LIBRARY_ID_MAP, NAS_TO_CONTAINER_PATH_MAP)
+
+def library_display_name(library_id):
+    """返回媒体库的显示名称"""
+    if library_id == FULL_SCAN_MARKER:
+        return "全部媒体库"
+    return LIBRARY_ID_TO_NAME.get(library_id, f"未知({library_id})")
+
+class RateLimitFilter(logging.Filter):
+    """按日志类别限流：每个时间窗口内最多输出指定条数，超出部分计数后在下一个窗口汇总"""
+
+    def __init__(self, limits, window=60):
+        super().__init__()
+        self._limits = {f"EmbyFMB.{category}": limit for category, limit in limits.items()}
+        self._window = window
+        self._state = {}  # 类别 -> [窗口开始时间, 已输出条数, 已省略条数]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        limit = self._limits.get(record.name)
+        if limit is None:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            state = self._state.setdefault(record.name, [now, 0, 0])
+            if now - state[0] >= self._window:
+                if state[2]:
+                    record.msg = f"{record.getMessage()}（前 {self._window} 秒内省略了 {state[2]} 条同类日志）"
+                    record.args = None
+                state[:] = [now, 0, 0]
+            if state[1] < limit:
+                state[1] += 1
+                return True
+            state[2] += 1
+            return False
+
+class JsonLinesFormatter(logging.Formatter):
+    """紧凑的 JSON Lines 日志格式"""
+
+    def format(self, record):
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "cat": record.name.rpartition('.')[2] if '.' in record.name else "main",
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+class DroppingQueueHandler(QueueHandler):
+    """队列满时丢弃日志并计数，不阻塞调用线程"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+log_queue_handler = None  # 异步日志的队列处理器，用于统计丢弃的日志
+
 def setup_logging():
     """配置日志记录器"""
+    global log_queue_handler
     logger = logging.getLogger("EmbyFMB")
     logger.setLevel(logging.INFO)
 
@@ -114,112 +1295,533 @@ def setup_logging():
         encoding='utf-8'
     )
     handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    handlers = [handler]
 
     # 同时输出到控制台，方便调试
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(formatter)
-    logger.addHandler(console_handler)
+    handlers.append(console_handler)
+
+    # 可选的 JSON Lines 日志
+    if LOG_JSON_FILE_PATH:
+        json_handler = RotatingFileHandler(
+            LOG_JSON_FILE_PATH,
+            maxBytes=LOG_MAX_BYTES,
+            backupCount=LOG_BACKUP_COUNT,
+            encoding='utf-8'
+        )
+        json_handler.setFormatter(JsonLinesFormatter())
+        handlers.append(json_handler)
+
+    # 限流过滤器加在各类别的日志记录器上，每条日志只计数一次，各处理器输出相同的内容
+    rate_limit_filter = RateLimitFilter(LOG_RATE_LIMITS)
+    for category in LOG_RATE_LIMITS:
+        category_logger = logging.getLogger(f"EmbyFMB.{category}")
+        for old_filter in [f for f in category_logger.filters if isinstance(f, RateLimitFilter)]:
+            category_logger.removeFilter(old_filter)
+        category_logger.addFilter(rate_limit_filter)
+
+    if LOG_ASYNC:
+        # 文件和控制台写入在后台线程完成
+        log_queue_handler = DroppingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+        logger.addHandler(log_queue_handler)
+        listener = QueueListener(log_queue_handler.queue, *handlers, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+    else:
+        for h in handlers:
+            logger.addHandler(h)
 
     return logger
 
-# 在全局范围内初始化日志
-try:
-    logger = setup_logging()
-    logger.info("🟢 日志系统初始化成功")
-except Exception as e:
-    print(f"🔴 日志系统初始化失败: {str(e)}")
-    sys.exit(1)
+# 全局日志记录器，处理器在脚本启动时由 setup_logging() 配置
+logger = logging.getLogger("EmbyFMB")
+# 文件事件的详细日志（高频，受 LOG_RATE_LIMITS 限流）
+event_logger = logging.getLogger("EmbyFMB.event")
 
-def send_telegram_notification(message):
-    """通过Telegram Bot发送通知"""
-    if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
-        logger.warning("⚠️ Telegram 未配置，通知发送被跳过")
-        return False
-    
-    # 添加时间戳到页脚
-    current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-    message_with_timestamp_and_footer = f"{message}\n⏰ 时间: {current_time}\n\n{TELEGRAM_NOTIFICATION_FOOTER}"
-
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-    payload = {
-        "chat_id": TELEGRAM_CHAT_ID,
-        "text": message_with_timestamp_and_footer,
-        "parse_mode": "HTML",
-        "disable_web_page_preview": True
-    }
-    
-    try:
-        logger.info("🟣 正在发送 Telegram 通知...")
-        response = requests.post(url, json=payload, timeout=10)
-        if response.status_code == 200:
-            logger.info("🟢 Telegram 通知发送成功")
-            return True
-        else:
-            logger.error(f"🔴 Telegram 通知发送失败，状态码: {response.status_code}")
-            logger.error(f"🔴 响应内容: {response.text}")
-            return False
-    except Exception as e:
-        logger.error(f"🔴 发送 Telegram 通知时出错: {str(e)}")
-        return False
+class CircuitOpenError(requests.exceptions.RequestException):
+    """熔断期间直接失败的请求"""
 
-def trigger_emby_scan(library_id=None):
+class HttpClient:
     """
-    向 Emby API 发送媒体库扫描请求
-    :param library_id: 要扫描的媒体库编号。如果为空，则触发全库扫描。
+    复用连接的 HTTP 客户端：requests.Session 连接池 + 指数退避重试 + 熔断。
+    连接错误、超时和 5xx 响应会重试；连续 CIRCUIT_BREAKER_FAILURE_THRESHOLD 次请求最终失败后熔断，
+    CIRCUIT_BREAKER_RESET_SECONDS 秒内的请求直接抛出 CircuitOpenError。
     """
-    headers = {
-        'X-Emby-Token': EMBY_API_KEY,
-        'Content-Type': 'application/json',
-    }
-    
-    if library_id:
-        url = f"{EMBY_SERVER_URL}/emby/Library/Media/Updated"
-        
-        # 获取媒体库名称
-        library_name = LIBRARY_ID_TO_NAME.get(library_id, f"未知({library_id})")
-        endpoint_desc = f"【{library_name}媒体库】扫描"
-        
-        # 使用映射表获取对应的NAS路径
-        nas_paths = [path for path, lid in MONITORED_FOLDERS_TO_LIBRARY_ID_MAP.items() if lid == library_id]
-        
-        if not nas_paths:
-            logger.error(f"🔴 找不到【{library_name}媒体库】对应的路径")
-            logger.error("🔴 请检查配置部分映射表内容")
-            return False
-        
-        # 获取第一个NAS路径对应的容器内部路径
-        nas_path = nas_paths[0]
-        container_path = NAS_TO_CONTAINER_PATH_MAP.get(nas_path)
-        
-        if not container_path:
-            logger.error(f"🔴 找不到【{nas_path}】对应的容器内部路径")
-            logger.error("🔴 请检查配置部分映射表内容")
+    RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+    def __init__(self, name, pool_size=None):
+        if pool_size is None:
+            pool_size = EMBY_MAX_CONCURRENT_REQUESTS
+        self.name = name
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._open_until = 0.0
+
+    def _check_circuit(self):
+        with self._lock:
+            if self._failures >= CIRCUIT_BREAKER_FAILURE_THRESHOLD and time.time() < self._open_until:
+                metrics.inc("embyfmb_http_responses_total", (self.name, "circuit_open"))
+                raise CircuitOpenError(f"{self.name} 服务连续失败，熔断中，"
+                                       f"{self._open_until - time.time():.0f} 秒后重试")
+
+    def _record_result(self, ok):
+        with self._lock:
+            if ok:
+                if self._failures >= CIRCUIT_BREAKER_FAILURE_THRESHOLD:
+                    logger.info(f"🟢 {self.name} 服务已恢复，解除熔断")
+                self._failures = 0
+                return
+            self._failures += 1
+            if self._failures >= CIRCUIT_BREAKER_FAILURE_THRESHOLD:
+                if self._failures == CIRCUIT_BREAKER_FAILURE_THRESHOLD:
+                    logger.error(f"🔴 {self.name} 服务连续 {self._failures} 次请求失败，"
+                                 f"熔断 {CIRCUIT_BREAKER_RESET_SECONDS} 秒")
+                self._open_until = time.time() + CIRCUIT_BREAKER_RESET_SECONDS
+
+    def request(self, method, url, **kwargs):
+        """发送请求，必要时重试；返回最后一次响应，网络错误时抛出 requests 异常"""
+        self._check_circuit()
+        response = error = None
+        for attempt in range(HTTP_MAX_RETRIES + 1):
+            if attempt:
+                delay = random.uniform(0, HTTP_RETRY_BACKOFF_SECONDS * (2 ** attempt))
+                logger.warning(f"⚠️ {self.name} 请求失败，{delay:.1f} 秒后第 {attempt} 次重试")
+                time.sleep(delay)
+            start = time.perf_counter()
+            try:
+                response = self._session.request(method, url, **kwargs)
+                error = None
+            except requests.exceptions.RequestException as e:
+                response, error = None, e
+                metrics.inc("embyfmb_http_responses_total", (self.name, "error"))
+                continue
+            finally:
+                metrics.observe("embyfmb_http_request_seconds", time.perf_counter() - start, (self.name,))
+            metrics.inc("embyfmb_http_responses_total", (self.name, str(response.status_code)))
+            if response.status_code not in self.RETRY_STATUS_CODES:
+                self._record_result(True)
+                return response
+        self._record_result(False)
+        if error is not None:
+            raise error
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+telegram_client = HttpClient("Telegram", pool_size=1)
+aggregator_client = HttpClient("Aggregator", pool_size=1)
+
+def create_emby_clients():
+    """
+    按 EMBY_MAX_CONCURRENT_REQUESTS 创建 Emby 连接池和并发发送请求的线程池。
+    导入时先按默认配置创建，main() 在加载配置文件后重新创建
+    """
+    global emby_client, emby_executor
+    emby_client = HttpClient("Emby")
+    emby_executor = ThreadPoolExecutor(max_workers=EMBY_MAX_CONCURRENT_REQUESTS, thread_name_prefix="EmbyRequest")
+
+create_emby_clients()
+
+class LibraryDiscovery:
+    """
+    从 Emby 的 /Library/VirtualFolders 自动发现媒体库，按前缀改写规则推导 NAS 路径，并与手动配置合并。
+    结果缓存到磁盘，缓存未过期或 Emby 不可用时直接使用缓存；后台线程定期重新读取，
+    媒体库配置变化时整体替换 path_lookup 和媒体库名称表。
+    """
+    # 读取失败后的重试间隔（秒）
+    RETRY_SECONDS = 300
+
+    def __init__(self, on_update=None):
+        """
+        :param on_update: 路径查询表被替换后的回调，参数为 (旧查询表, 新查询表)
+        """
+        self._on_update = on_update
+        self.libraries = []  # [{"id": 媒体库ID, "name": 名称, "locations": [容器内部路径]}]
+        self.fetched_at = 0.0
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.configure()
+
+    def configure(self):
+        """读取手动配置的映射表和改写规则（启动时和配置重新加载后调用）"""
+        # 从配置中读取，而不是从已被 apply() 替换为合并结果的模块变量中读取
+        values = config_reloader.values
+        self._manual = (dict(values["MONITORED_FOLDERS_TO_LIBRARY_ID_MAP"]), dict(values["NAS_TO_CONTAINER_PATH_MAP"]),
+                        dict(values["LIBRARY_ID_TO_NAME"]))
+        self._rules = PathPrefixIndex(values["LIBRARY_PATH_REWRITE_RULES"])
+
+    def rewrite(self, container_path):
+        """按改写规则将容器内部路径转换为 NAS 路径，没有匹配的规则时返回 None"""
+        container_prefix, nas_prefix = self._rules.longest_match(container_path)
+        if container_prefix is None:
+            return None
+        relative = container_path.rstrip('/')[len(container_prefix.rstrip('/')):]
+        return (nas_prefix.rstrip('/') + relative) or '/'
+
+    def fetch(self):
+        """从 Emby 读取媒体库列表，失败时返回 None"""
+        headers = {'X-Emby-Token': EMBY_API_KEY}
+        try:
+            response = emby_client.get(f"{EMBY_SERVER_URL}/emby/Library/VirtualFolders", headers=headers, timeout=10)
+            response.raise_for_status()
+            folders = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.warning(f"⚠️ 读取 Emby 媒体库配置失败: {e}")
+            return None
+        libraries = []
+        for folder in folders:
+            library_id = folder.get("ItemId")
+            if not library_id:
+                continue
+            libraries.append({
+                "id": str(library_id),
+                "name": folder.get("Name") or str(library_id),
+                "locations": list(folder.get("Locations") or []),
+            })
+        return libraries
+
+    def load_cache(self):
+        """读取缓存文件，成功时返回 True"""
+        if not LIBRARY_DISCOVERY_CACHE_PATH:
             return False
-        
-        json_data = {
-            "Updates": [{
-                "Path": container_path,
-                "UpdateType": "scan"
-            }]
-        }
-        
         try:
-            logger.info("🟣 正在发送 Emby API 请求")
-            logger.info(f"🟣 请求内容: {endpoint_desc}")
-            response = requests.post(url, headers=headers, json=json_data, timeout=30)
-            
-            if response.status_code == 204:
-                logger.info("🟢 成功发送请求")
-                logger.info(f"🟢 Emby 已开始{endpoint_desc}")
-                return True
+            with open(LIBRARY_DISCOVERY_CACHE_PATH, encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ 媒体库缓存读取失败: {e}")
+            return False
+        self.libraries = data.get("libraries", [])
+        self.fetched_at = data.get("fetched_at", 0.0)
+        return True
+
+    def _store(self, libraries):
+        """保存读取结果并原子地写入缓存文件，返回媒体库配置是否发生变化"""
+        changed = libraries != self.libraries
+        self.libraries = libraries
+        self.fetched_at = time.time()
+        if LIBRARY_DISCOVERY_CACHE_PATH:
+            tmp_path = LIBRARY_DISCOVERY_CACHE_PATH + ".tmp"
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump({"version": 1, "fetched_at": self.fetched_at, "libraries": libraries},
+                              f, ensure_ascii=False)
+                os.replace(tmp_path, LIBRARY_DISCOVERY_CACHE_PATH)
+            except OSError as e:
+                logger.error(f"🔴 媒体库缓存保存失败: {e}")
+        return changed
+
+    def build(self):
+        """合并自动发现的媒体库和手动配置，返回 (路径查询表, 媒体库名称表)"""
+        manual_folders, manual_containers, manual_names = self._manual
+        folders, containers, names = {}, {}, {}
+        for library in self.libraries:
+            names[library["id"]] = library["name"]
+            for location in library["locations"]:
+                nas_path = self.rewrite(location)
+                if nas_path is None:
+                    logger.warning(f"⚠️ 媒体库【{library['name']}】的路径 {location} 没有匹配的改写规则，将不会被监控")
+                    continue
+                folders[nas_path] = library["id"]
+                containers[nas_path] = location
+        folders.update(manual_folders)
+        containers.update(manual_containers)
+        names.update(manual_names)
+        return PathLookup(folders, containers), names
+
+    def apply(self):
+        """用当前的媒体库配置替换全局路径查询表和名称表"""
+        global path_lookup, LIBRARY_ID_TO_NAME
+        lookup, names = self.build()
+        old_lookup = path_lookup
+        # 整体替换引用，其他线程读到的总是完整的查询表
+        path_lookup = lookup
+        LIBRARY_ID_TO_NAME = names
+        logger.info(f"🟢 已加载 {len(self.libraries)} 个 Emby 媒体库，共 {len(lookup.folders)} 个监控目录")
+        if self._on_update:
+            self._on_update(old_lookup, lookup)
+
+    def load(self):
+        """启动时加载媒体库配置：缓存未过期时直接使用，否则从 Emby 读取，读取失败时退回到缓存或手动配置"""
+        cached = self.load_cache()
+        if cached and time.time() - self.fetched_at < LIBRARY_DISCOVERY_TTL_SECONDS:
+            logger.info("🟢 使用缓存的 Emby 媒体库配置")
+        else:
+            libraries = self.fetch()
+            if libraries is not None:
+                self._store(libraries)
+            elif cached:
+                logger.warning("⚠️ 无法连接 Emby，使用已过期的媒体库缓存")
+            else:
+                logger.warning("⚠️ 无法连接 Emby 且没有媒体库缓存，仅使用手动配置的映射")
+        self.apply()
+
+    def _run(self):
+        delay = max(self.fetched_at + LIBRARY_DISCOVERY_TTL_SECONDS - time.time(), 0)
+        while not self._stop_event.wait(delay):
+            libraries = self.fetch()
+            if libraries is None:
+                delay = min(LIBRARY_DISCOVERY_TTL_SECONDS, self.RETRY_SECONDS)
+                continue
+            delay = LIBRARY_DISCOVERY_TTL_SECONDS
+            if self._store(libraries):
+                logger.info("🟣 Emby 媒体库配置已变化，正在更新路径映射")
+                self.apply()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="LibraryDiscovery", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+class TelegramSender:
+    """
+    Telegram 消息发送线程：消息先进入有序的发件箱，由后台线程按令牌桶限速逐条发送。
+    超过 4096 字符的消息按行拆分；遇到 429 时等待 Telegram 返回的 retry_after 后重发同一条消息，
+    网络错误时指数退避重试，发送成功后才取出下一条，保证通知按顺序送达。
+    """
+    MESSAGE_LIMIT = 4096
+    MAX_BACKOFF_SECONDS = 300
+
+    def __init__(self):
+        self._outbox = deque()
+        self._condition = threading.Condition()
+        self._tokens = 0.0  # 令牌桶在发送线程启动时按 TELEGRAM_BURST 装满
+        self._refilled_at = time.monotonic()
+        self._thread = None
+        self._running = False
+        self.dropped = 0
+
+    def pending(self):
+        """返回发件箱中尚未发送的消息数量"""
+        with self._condition:
+            return len(self._outbox)
+
+    def send(self, message):
+        """把消息（必要时拆分为多条）加入发件箱，立即返回"""
+        current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        parts = self.split(message, self.MESSAGE_LIMIT - 100 - len(TELEGRAM_NOTIFICATION_FOOTER))
+        with self._condition:
+            for index, part in enumerate(parts, 1):
+                page = f" ({index}/{len(parts)})" if len(parts) > 1 else ""
+                self._outbox.append(f"{part}\n⏰ 时间: {current_time}{page}\n\n{TELEGRAM_NOTIFICATION_FOOTER}")
+            overflow = len(self._outbox) - TELEGRAM_OUTBOX_SIZE
+            if overflow > 0:
+                for _ in range(overflow):
+                    self._outbox.popleft()
+                self.dropped += overflow
+                logger.warning(f"⚠️ Telegram 发件箱已满，丢弃了最早的 {overflow} 条通知")
+            if not self._running:
+                self._running = True
+                self._tokens = float(TELEGRAM_BURST)
+                self._refilled_at = time.monotonic()
+                self._thread = threading.Thread(target=self._run, name="TelegramSender", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    @staticmethod
+    def split(message, limit):
+        """按行拆分消息，每段不超过 limit 个字符（单行超长时强制截断）"""
+        parts, lines, size = [], [], 0
+        for line in message.rstrip("\n").split("\n"):
+            while len(line) > limit:
+                if lines:
+                    parts.append("\n".join(lines))
+                    lines, size = [], 0
+                parts.append(line[:limit])
+                line = line[limit:]
+            if lines and size + len(line) + 1 > limit:
+                parts.append("\n".join(lines))
+                lines, size = [], 0
+            lines.append(line)
+            size += len(line) + 1
+        if lines:
+            parts.append("\n".join(lines))
+        return parts
+
+    def _take_token(self):
+        """令牌桶限速：没有可用令牌时等待，停止时返回 False"""
+        rate = TELEGRAM_MESSAGES_PER_MINUTE / 60.0
+        with self._condition:
+            while self._running:
+                now = time.monotonic()
+                self._tokens = min(float(TELEGRAM_BURST), self._tokens + (now - self._refilled_at) * rate)
+                self._refilled_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                self._condition.wait((1 - self._tokens) / rate)
+        return False
+
+    def _deliver(self, text):
+        """
+        发送一条消息
+        :return: (是否从发件箱移除, 重发前需要等待的秒数)
+        """
+        url = f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+        payload = {
+            "chat_id": TELEGRAM_CHAT_ID,
+            "text": text,
+            "parse_mode": "HTML",
+            "disable_web_page_preview": True
+        }
+        try:
+            logger.info("🟣 正在发送 Telegram 通知...")
+            response = telegram_client.post(url, json=payload, timeout=10)
+        except requests.exceptions.RequestException as e:
+            logger.error(f"🔴 发送 Telegram 通知时出错: {str(e)}")
+            return False, None
+        if response.status_code == 200:
+            logger.info("🟢 Telegram 通知发送成功")
+            return True, 0
+        if response.status_code == 429:
+            try:
+                retry_after = float(response.json().get("parameters", {}).get("retry_after", 1))
+            except ValueError:
+                retry_after = 1
+            logger.warning(f"⚠️ Telegram 发送过于频繁，{retry_after:.0f} 秒后重试")
+            return False, retry_after
+        logger.error(f"🔴 Telegram 通知发送失败，状态码: {response.status_code}")
+        logger.error(f"🔴 响应内容: {response.text}")
+        if 400 <= response.status_code < 500:
+            # 消息本身有问题（如格式错误），重发也不会成功
+            return True, 0
+        return False, None
+
+    def _run(self):
+        backoff = 1
+        while True:
+            with self._condition:
+                while self._running and not self._outbox:
+                    self._condition.wait()
+                if not self._outbox:
+                    return
+                text = self._outbox[0]
+            if not self._take_token():
+                return
+            done, delay = self._deliver(text)
+            if done:
+                backoff = 1
+                with self._condition:
+                    if self._outbox and self._outbox[0] is text:
+                        self._outbox.popleft()
+                continue
+            if delay is None:
+                delay, backoff = backoff, min(backoff * 2, self.MAX_BACKOFF_SECONDS)
+            with self._condition:
+                if self._running:
+                    self._condition.wait(delay)
+
+    def stop(self, timeout=10):
+        """停止发送线程，最多等待 timeout 秒把发件箱中的消息发完"""
+        deadline = time.monotonic() + timeout
+        while self.pending() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        if self.pending():
+            logger.warning(f"⚠️ 仍有 {self.pending()} 条 Telegram 通知未发送")
+
+telegram_sender = TelegramSender()
+
+def send_telegram_notification(message):
+    """通过Telegram Bot发送通知（加入发件箱后立即返回），未配置时返回 False"""
+    if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
+        logger.warning("⚠️ Telegram 未配置，通知发送被跳过")
+        return False
+    telegram_sender.send(message)
+    return True
+
+# 请求发送结果：成功、暂时性失败（放回队列重试）、无法完成（放弃）
+SEND_OK = "ok"
+SEND_RETRY = "retry"
+SEND_DROP = "drop"
+
+def failure_outcome(status_code=None):
+    """网络错误、熔断、429 和 5xx 属于暂时性失败，可以重试；其他状态码（如 4xx）重试也不会成功"""
+    if status_code is None or status_code == 429 or status_code >= 500:
+        return SEND_RETRY
+    return SEND_DROP
+
+def trigger_emby_scan(library_id=None):
+    """
+    向 Emby API 发送媒体库扫描请求
+    :param library_id: 要扫描的媒体库编号。如果为空，则触发全库扫描。
+    :return: SEND_OK、SEND_RETRY 或 SEND_DROP
+    """
+    headers = {
+        'X-Emby-Token': EMBY_API_KEY,
+        'Content-Type': 'application/json',
+    }
+    
+    if library_id:
+        url = f"{EMBY_SERVER_URL}/emby/Library/Media/Updated"
+        
+        # 获取媒体库名称
+        library_name = LIBRARY_ID_TO_NAME.get(library_id, f"未知({library_id})")
+        endpoint_desc = f"【{library_name}媒体库】扫描"
+        
+        # 使用路径索引获取媒体库对应的全部NAS路径
+        nas_paths = path_lookup.roots_for(library_id)
+        remote_roots = sorted(agent_library_roots.get(library_id, ()))
+        
+        if not nas_paths and not remote_roots:
+            logger.error(f"🔴 找不到【{library_name}媒体库】对应的路径")
+            logger.error("🔴 请检查配置部分映射表内容")
+            return SEND_DROP
+        
+        # 获取每个NAS路径对应的容器内部路径
+        updates = []
+        for nas_path in nas_paths:
+            container_path = path_lookup.to_container(nas_path)
+            if not container_path:
+                logger.error(f"🔴 找不到【{nas_path}】对应的容器内部路径")
+                logger.error("🔴 请检查配置部分映射表内容")
+                return SEND_DROP
+            updates.append({
+                "Path": container_path,
+                "UpdateType": "scan"
+            })
+        # 代理上报的根目录（已是容器内部路径）
+        local_roots = {update["Path"] for update in updates}
+        updates.extend({"Path": root, "UpdateType": "scan"} for root in remote_roots if root not in local_roots)
+        
+        json_data = {
+            "Updates": updates
+        }
+        
+        try:
+            logger.info("🟣 正在发送 Emby API 请求")
+            logger.info(f"🟣 请求内容: {endpoint_desc}")
+            response = emby_client.post(url, headers=headers, json=json_data, timeout=30)
+            
+            if response.status_code == 204:
+                logger.info("🟢 成功发送请求")
+                logger.info(f"🟢 Emby 已开始{endpoint_desc}")
+                return SEND_OK
             else:
                 logger.error(f"🔴 发送请求失败，状态码: {response.status_code}, 响应: {response.text}")
-                return False
+                return failure_outcome(response.status_code)
                 
         except requests.exceptions.RequestException as e:
             logger.error(f"🔴 连接服务器时发生网络错误: {e}")
-            return False
+            return failure_outcome()
             
     else:
         url = f"{EMBY_SERVER_URL}/emby/Library/Refresh"
@@ -228,269 +1830,2070 @@ def trigger_emby_scan(library_id=None):
         try:
             logger.info("🟣 正在发送 Emby API 请求")
             logger.info(f"🟣 请求内容: {endpoint_desc}")
-            response = requests.post(url, headers=headers, timeout=30)
+            response = emby_client.post(url, headers=headers, timeout=30)
             
             if response.status_code == 204:
                 logger.info("🟢 成功发送请求")
                 logger.info(f"🟢 Emby 已开始{endpoint_desc}")
-                return True
+                return SEND_OK
             else:
                 logger.error(f"🔴 发送请求失败，状态码: {response.status_code}, 响应: {response.text}")
-                return False
+                return failure_outcome(response.status_code)
                 
         except requests.exceptions.RequestException as e:
             logger.error(f"🔴 连接服务器时发生网络错误: {e}")
+            return failure_outcome()
+
+# 事件类型到 Emby 更新类型的映射
+EVENT_TYPE_TO_UPDATE_TYPE = {
+    "创建": "Created",
+    "移动(目标)": "Created",
+    "移动(源)": "Deleted",
+    "删除": "Deleted",
+}
+
+def nas_to_container_path(nas_path):
+    """将 NAS 路径转换为 Emby 容器内部路径，找不到映射时返回 None；代理转发的路径本身就是容器内部路径"""
+    if nas_path.startswith(REMOTE_PATH_PREFIX):
+        return nas_path[len(REMOTE_PATH_PREFIX):]
+    return path_lookup.to_container(nas_path)
+
+def collapse_update_paths(paths):
+    """
+    合并同一文件夹下的大量变动，并去掉已被上级文件夹覆盖的路径
+    :param paths: {NAS路径: Emby更新类型}
+    :return: 合并后的 {NAS路径: Emby更新类型}
+    """
+    by_parent = defaultdict(list)
+    for path in paths:
+        by_parent[os.path.dirname(path)].append(path)
+
+    collapsed = {}
+    for parent, children in by_parent.items():
+        if len(children) >= PATH_UPDATE_COLLAPSE_THRESHOLD:
+            # 整个文件夹已被删除时发送文件夹删除，否则让 Emby 重新扫描该文件夹。
+            # 代理转发的路径无法在本机确认文件夹是否还存在（由代理在转发前合并），只重新扫描
+            if (all(paths[child] == "Deleted" for child in children)
+                    and not parent.startswith(REMOTE_PATH_PREFIX) and not os.path.lexists(parent)):
+                collapsed[parent] = "Deleted"
+            else:
+                collapsed[parent] = "Modified"
+        else:
+            for child in children:
+                collapsed[child] = paths[child]
+
+    # 已有上级文件夹更新的路径无需重复发送（包括合并出的文件夹和整个移入的文件夹）
+    folders = set(collapsed)
+    result = {}
+    for path, update_type in collapsed.items():
+        parent = os.path.dirname(path)
+        covered = False
+        while parent and parent != os.path.dirname(parent):
+            if parent in folders:
+                covered = True
+                break
+            parent = os.path.dirname(parent)
+        if not covered:
+            result[path] = update_type
+    return result
+
+def library_roots_available(library_id):
+    """媒体库的所有根目录都存在且非空时返回 True（挂载断开时根目录通常为空或不可访问）"""
+    for root in path_lookup.roots_for(library_id):
+        try:
+            with os.scandir(root) as entries:
+                if next(entries, None) is None:
+                    return False
+        except OSError:
             return False
+    return True
+
+def guard_deletions(library_id, paths):
+    """
+    删除更新的安全检查
+    :param paths: {NAS路径: Emby更新类型}
+    :return: (可以发送的 {NAS路径: Emby更新类型}, 被拦截的删除数量)
+    """
+    deleted = [path for path, update_type in paths.items() if update_type == "Deleted"]
+    if not deleted:
+        return paths, 0
+    checked = dict(paths)
+    if not EMBY_SEND_DELETIONS:
+        # 删除不刷新时，移走的源路径按旧方式让 Emby 重新检查
+        for path in deleted:
+            checked[path] = "Modified"
+        return checked, 0
+
+    # 路径又出现了（如文件被替换），改为普通更新。代理转发的路径已在代理所在的主机上确认不存在，
+    # 但各代理每次只检查自己转发的一批，这里仍按本周期该媒体库的删除总数检查安全阈值
+    missing = []
+    for path in deleted:
+        if not path.startswith(REMOTE_PATH_PREFIX) and os.path.lexists(path):
+            checked[path] = "Modified"
+        else:
+            missing.append(path)
+    if not missing:
+        return checked, 0
+
+    library_name = LIBRARY_ID_TO_NAME.get(library_id, f"未知({library_id})")
+    local_missing = any(not path.startswith(REMOTE_PATH_PREFIX) for path in missing)
+    if local_missing and not library_roots_available(library_id):
+        logger.error(f"🔴 【{library_name}媒体库】根目录不可访问或为空，可能是挂载断开，"
+                     f"已拦截 {len(missing)} 个删除更新")
+    elif len(missing) > DELETION_SAFETY_THRESHOLD:
+        logger.error(f"🔴 【{library_name}媒体库】本周期删除 {len(missing)} 个路径，超过安全阈值 "
+                     f"{DELETION_SAFETY_THRESHOLD}，已拦截删除更新，请确认后手动扫描媒体库")
+    else:
+        return checked, 0
+    for path in missing:
+        del checked[path]
+    return checked, len(missing)
+
+def library_scan_blocked(library_id, blocked):
+    """
+    媒体库扫描同样会删除挂载断开的目录中的条目，发送前再检查一次
+    :return: 不能发送媒体库扫描时返回原因，否则返回 None
+    """
+    if blocked:
+        return f"已拦截 {blocked} 个删除更新（超过安全阈值或根目录不可访问），未发送媒体库扫描"
+    if not library_roots_available(library_id):
+        logger.error(f"🔴 【{library_display_name(library_id)}媒体库】根目录不可访问或为空，"
+                     f"可能是挂载断开，未发送媒体库扫描")
+        return "根目录不可访问，未发送媒体库扫描"
+    return None
+
+def full_scan_blocked(guarded):
+    """有删除更新被拦截或任一媒体库根目录不可访问时，不发送【全部媒体库】扫描"""
+    if any(blocked for _, blocked in guarded.values()) or \
+            not all(library_roots_available(library_id) for library_id in list(path_lookup.library_roots)):
+        logger.error("🔴 有媒体库根目录不可访问或删除更新被拦截，不发送【全部媒体库】扫描")
+        return True
+    return False
+
+def trigger_emby_path_updates(updates):
+    """
+    通过 /Library/Media/Updated 批量发送路径精确更新，各批次并发发送
+    :param updates: [(媒体库ID, {"Path": 容器路径, "UpdateType": 更新类型}), ...]
+    :return: {发送失败的批次中包含的媒体库ID: SEND_RETRY 或 SEND_DROP}
+    """
+    url = f"{EMBY_SERVER_URL}/emby/Library/Media/Updated"
+    headers = {
+        'X-Emby-Token': EMBY_API_KEY,
+        'Content-Type': 'application/json',
+    }
+    chunks = [updates[index:index + PATH_UPDATE_CHUNK_SIZE]
+              for index in range(0, len(updates), PATH_UPDATE_CHUNK_SIZE)]
+
+    def send_chunk(chunk_no):
+        chunk = chunks[chunk_no - 1]
+        try:
+            logger.info(f"🟣 正在发送 Emby 路径更新请求 ({chunk_no}/{len(chunks)})，共 {len(chunk)} 个路径")
+            response = emby_client.post(url, headers=headers, json={"Updates": [update for _, update in chunk]},
+                                        timeout=30)
+            if response.status_code == 204:
+                logger.info(f"🟢 路径更新请求 ({chunk_no}/{len(chunks)}) 发送成功")
+                return {}
+            logger.error(f"🔴 发送请求失败，状态码: {response.status_code}, 响应: {response.text}")
+            outcome = failure_outcome(response.status_code)
+        except requests.exceptions.RequestException as e:
+            logger.error(f"🔴 连接服务器时发生网络错误: {e}")
+            outcome = failure_outcome()
+        return {library_id: outcome for library_id, _ in chunk}
+
+    failed = {}
+    for chunk_failed in emby_executor.map(send_chunk, range(1, len(chunks) + 1)):
+        for library_id, outcome in chunk_failed.items():
+            # 同一媒体库的其他批次可以重试时，整个媒体库放回队列
+            if failed.get(library_id) != SEND_RETRY:
+                failed[library_id] = outcome
+    return failed
+
+def dispatch_scan_requests(requested_libraries, requested_paths):
+    """
+    根据本周期的扫描请求选择合适的 Emby 更新方式并发送
+    :param requested_libraries: 待扫描的媒体库ID集合（可能包含 FULL_SCAN_MARKER）
+    :param requested_paths: {媒体库ID: {NAS路径: Emby更新类型}}
+    :return: {媒体库ID 或 FULL_SCAN_MARKER: 执行结果描述}
+    """
+    # 删除安全检查在选择更新方式之前进行：媒体库扫描和全库扫描同样会删除挂载断开的目录中的条目
+    guarded = {library_id: guard_deletions(library_id, requested_paths.get(library_id, {}))
+               for library_id in requested_libraries if library_id != FULL_SCAN_MARKER}
+    results = {}
+
+    # 优先级判断：如果全库扫描在请求中，则只执行全库扫描
+    if FULL_SCAN_MARKER in requested_libraries:
+        if not full_scan_blocked(guarded):
+            logger.info("🟣 检测到【全部媒体库】扫描请求")
+            logger.info("🟣 将优先执行并忽略其他扫描。")
+            return trigger_full_scan()
+        results[FULL_SCAN_MARKER] = "已拦截【全部媒体库】扫描（根目录不可访问或删除更新被拦截）"
+
+    if EMBY_UPDATE_MODE != "path":
+        scan_ids = []
+        for library_id, (_, blocked) in guarded.items():
+            reason = library_scan_blocked(library_id, blocked)
+            if reason:
+                results[library_id] = reason
+            else:
+                scan_ids.append(library_id)
+        if scan_ids:
+            logger.info("🟣 正在对【特定媒体库】发送扫描请求")
+            results.update(scan_libraries(scan_ids))
+        return results
+
+    updates = []
+    root_scan_libraries = []
+    for library_id, (paths, blocked) in guarded.items():
+        library_name = LIBRARY_ID_TO_NAME.get(library_id, f"未知({library_id})")
+        blocked_note = f"已拦截 {blocked} 个删除更新（超过安全阈值或根目录不可访问）" if blocked else ""
+        if blocked and not paths:
+            results[library_id] = blocked_note
+            continue
+        paths = collapse_update_paths(paths)
+        if blocked and len(paths) > PATH_UPDATE_LIBRARY_FALLBACK_THRESHOLD:
+            # 拦截删除时不回退为媒体库扫描，媒体库扫描同样会删除条目
+            results[library_id] = f"变动路径过多且{blocked_note}，未发送更新"
+            continue
+        if not paths or len(paths) > PATH_UPDATE_LIBRARY_FALLBACK_THRESHOLD:
+            reason = library_scan_blocked(library_id, 0)
+            if reason:
+                results[library_id] = reason
+                continue
+            logger.info(f"🟡 【{library_name}媒体库】变动路径数为 {len(paths)}，回退为媒体库扫描")
+            root_scan_libraries.append(library_id)
+            continue
+
+        library_updates = []
+        for nas_path, update_type in paths.items():
+            container_path = nas_to_container_path(nas_path)
+            if not container_path:
+                logger.error(f"🔴 找不到【{nas_path}】对应的容器内部路径")
+                library_updates = None
+                break
+            library_updates.append((library_id, {"Path": container_path, "UpdateType": update_type}))
+
+        if library_updates is None:
+            if blocked:
+                results[library_id] = f"存在无法映射的路径且{blocked_note}，未发送更新"
+                continue
+            reason = library_scan_blocked(library_id, 0)
+            if reason:
+                results[library_id] = reason
+                continue
+            logger.info(f"🟡 【{library_name}媒体库】存在无法映射的路径，回退为媒体库扫描")
+            root_scan_libraries.append(library_id)
+            continue
+
+        updates.extend(library_updates)
+        results[library_id] = f"已提交 {len(library_updates)} 个路径更新"
+        if blocked:
+            results[library_id] += f"，{blocked_note}"
+
+    if len(updates) > PATH_UPDATE_FULL_REFRESH_THRESHOLD and not full_scan_blocked(guarded):
+        logger.info(f"🟡 本周期路径更新总数 {len(updates)} 超过阈值，回退为【全部媒体库】扫描")
+        return trigger_full_scan()
+
+    if updates:
+        logger.info(f"🟣 正在对【特定媒体库】发送路径更新，共 {len(updates)} 个路径")
+        for library_id, outcome in trigger_emby_path_updates(updates).items():
+            results[library_id] = "路径更新发送失败" if outcome == SEND_RETRY else "路径更新被 Emby 拒绝，已放弃"
+
+    results.update(scan_libraries(root_scan_libraries))
+    return results
+
+# 扫描请求的发送结果描述（结果中包含“失败”的请求会放回队列重试，包含“放弃”的不再重试）
+LIBRARY_SCAN_RESULTS = {
+    SEND_OK: "已提交扫描",
+    SEND_RETRY: "扫描请求发送失败",
+    SEND_DROP: "扫描请求被拒绝或路径无法映射，已放弃",
+}
+FULL_SCAN_RESULTS = {
+    SEND_OK: "已触发【全部媒体库】扫描",
+    SEND_RETRY: "【全部媒体库】扫描请求发送失败",
+    SEND_DROP: "【全部媒体库】扫描请求被拒绝，已放弃",
+}
+
+def trigger_full_scan():
+    """发送【全部媒体库】扫描请求，返回 {FULL_SCAN_MARKER: 执行结果描述}"""
+    return {FULL_SCAN_MARKER: FULL_SCAN_RESULTS[trigger_emby_scan()]}
+
+def scan_libraries(library_ids):
+    """并发发送多个媒体库的根目录扫描请求，返回 {媒体库ID: 执行结果描述}"""
+    library_ids = list(library_ids)
+    return {library_id: LIBRARY_SCAN_RESULTS[outcome]
+            for library_id, outcome in zip(library_ids, emby_executor.map(trigger_emby_scan, library_ids))}
+
+def agent_name():
+    """代理名称，未配置时使用主机名"""
+    return AGENT_NAME or socket.gethostname()
+
+def send_to_aggregator(payload):
+    """代理模式：把变动发送给汇总端，返回 SEND_OK、SEND_RETRY 或 SEND_DROP"""
+    headers = {'X-EmbyFMB-Token': CLUSTER_TOKEN}
+    payload = dict(payload, agent=agent_name())
+    try:
+        response = aggregator_client.post(f"{AGGREGATOR_URL}/api/changes", headers=headers, json=payload, timeout=30)
+        if response.status_code == 204:
+            return SEND_OK
+        logger.error(f"🔴 汇总端拒绝了转发的变动，状态码: {response.status_code}, 响应: {response.text}")
+        return failure_outcome(response.status_code)
+    except requests.exceptions.RequestException as e:
+        logger.error(f"🔴 连接汇总端时发生网络错误: {e}")
+        return failure_outcome()
+
+def forward_scan_requests(requested_libraries, requested_paths):
+    """
+    代理模式：在本机完成删除安全检查并转换为容器内部路径后，把扫描请求转发给汇总端统一调度
+    :param requested_libraries: 待扫描的媒体库ID集合（可能包含 FULL_SCAN_MARKER）
+    :param requested_paths: {媒体库ID: {NAS路径: Emby更新类型}}
+    :return: {媒体库ID 或 FULL_SCAN_MARKER: 执行结果描述}
+    """
+    results = {}
+    updates = {}
+    roots = {}
+    for library_id in requested_libraries:
+        if library_id == FULL_SCAN_MARKER:
+            updates[library_id] = {}
+            results[library_id] = "已转发【全部媒体库】扫描请求到汇总端"
+            continue
+        paths, blocked = guard_deletions(library_id, requested_paths.get(library_id, {}))
+        blocked_note = f"已拦截 {blocked} 个删除更新（超过安全阈值或根目录不可访问）" if blocked else ""
+        if blocked and not paths:
+            results[library_id] = blocked_note
+            continue
+        # 只有代理能看到本机磁盘，在这里合并路径（判断整个文件夹是否已被删除）
+        paths = collapse_update_paths(paths)
+        container_paths = {}
+        for nas_path, update_type in paths.items():
+            container_path = nas_to_container_path(nas_path)
+            if not container_path:
+                logger.error(f"🔴 找不到【{nas_path}】对应的容器内部路径")
+                # 不发送路径，由汇总端扫描整个媒体库
+                container_paths = {}
+                break
+            container_paths[container_path] = update_type
+        updates[library_id] = container_paths
+        roots[library_id] = [root for root in map(nas_to_container_path, path_lookup.roots_for(library_id)) if root]
+        results[library_id] = f"已转发 {len(container_paths)} 个路径更新到汇总端"
+        if blocked:
+            results[library_id] += f"，{blocked_note}"
+
+    if not updates:
+        return results
+    logger.info(f"🟣 正在把 {len(updates)} 个媒体库的扫描请求转发到汇总端")
+    outcome = send_to_aggregator({"updates": updates, "roots": roots})
+    if outcome == SEND_OK:
+        return results
+    for library_id in updates:
+        results[library_id] = "转发到汇总端失败" if outcome == SEND_RETRY else "汇总端拒绝了转发的请求，已放弃"
+    return results
+
+def build_notification_message(changes):
+    """根据文件变动汇总构建 Telegram 通知消息"""
+    # 事件类型图标
+    event_icons = {
+        "创建": "🟢",
+        "删除": "🔴",
+        "移动(源)": "🟡",
+        "移动(目标)": "🔵"
+    }
+    
+    # 逐行收集后一次性拼接
+    lines = ["⭐️ 文件变动实时通知 ⭐️", "", f"📢 检测到 {changes.total} 个视频文件变动", "—————————"]
+    for event_type, libraries in changes.groups():
+        icon = event_icons.get(event_type, "⚪️")
+        lines.append(f"{icon} {event_type}")
+        
+        for library_id, count, filenames in libraries:
+            library_name = LIBRARY_ID_TO_NAME.get(library_id, f"未知({library_id})")
+            lines.append(f"🎬 {library_name} ({count})")
+            
+            # 只显示保存的文件名样本，其余的用省略号表示
+            lines.extend(f"🍬 <code>{filename}</code>" for filename in filenames)
+            
+            if count > len(filenames):
+                lines.append(f"└ ...等 {count - len(filenames)} 个文件")
+        
+        lines.append("—————————")
+    lines.append("")
+    return "\n".join(lines)
 
 def notification_worker():
-    """通知工作线程，定期检查并发送通知"""
+    """通知工作线程，定期把变动汇总交给 Telegram 发送线程"""
     global last_notification_time, notification_queue
     while notification_thread_running:
         try:
             time.sleep(NOTIFICATION_WINDOW_SECONDS)
             
+            # 计算距离上次通知的时间
+            current_time = time.time()
+            time_since_last_notification = current_time - last_notification_time
+            
+            # 如果距离上次通知不足5秒，继续等待
+            if time_since_last_notification < NOTIFICATION_WINDOW_SECONDS:
+                continue
+            
+            # 上一条通知还未送达（Telegram 限速或不可用）时，新的变动继续在汇总中合并，
+            # 送达后再一次性发送，避免发件箱中堆积大量消息
+            if telegram_sender.pending():
+                continue
+            
+            # 在锁内取出整个通知队列，消息构建和发送在锁外进行，避免阻塞文件事件回调
             with log_lock:
                 if not notification_queue:
                     continue
-                
-                # 计算距离上次通知的时间
-                current_time = time.time()
-                time_since_last_notification = current_time - last_notification_time
-                
-                # 如果距离上次通知不足5秒，继续等待
-                if time_since_last_notification < NOTIFICATION_WINDOW_SECONDS:
-                    continue
-                
-                # 按事件类型和媒体库分组
-                grouped_changes = defaultdict(lambda: defaultdict(list))
-                
-                for change in notification_queue:
-                    # 获取文件名（不含路径）
-                    filename = os.path.basename(change['path'])
-                    # 获取媒体库名称
-                    library_name = LIBRARY_ID_TO_NAME.get(change['library_id'], f"未知({change['library_id']})")
-                    
-                    # 添加到对应事件类型的列表
-                    grouped_changes[change['event_type']][library_name].append(filename)
-                
-                # 构建通知消息
-                message = "⭐️ 文件变动实时通知 ⭐️\n\n"
-                message += f"📢 检测到 {len(notification_queue)} 个视频文件变动\n"
-                message += "—————————\n"
-                
-                # 事件类型图标
-                event_icons = {
-                    "创建": "🟢",
-                    "删除": "🔴",
-                    "移动(源)": "🟡",
-                    "移动(目标)": "🔵"
-                }
-                
-                for event_type, libraries in grouped_changes.items():
-                    icon = event_icons.get(event_type, "⚪️")
-                    message += f"{icon} {event_type}\n"
-                    
-                    for library_name, filenames in libraries.items():
-                        message += f"🎬 {library_name} ({len(filenames)})\n"
-                        
-                        # 只显示前5个文件名，其余的用省略号表示
-                        for filename in filenames[:5]:
-                            # 缩短过长的文件名（超过50字符）
-                            display_name = filename if len(filename) <= 50 else filename[:47] + "..."
-                            message += f"🍬 <code>{display_name}</code>\n"
-                        
-                        if len(filenames) > 5:
-                            message += f"└ ...等 {len(filenames) - 5} 个文件\n"
-                    
-                    message += "—————————\n"
-                
-                # 发送通知
-                if send_telegram_notification(message):
-                    # 清空通知队列
-                    notification_queue = []
+                pending_changes, notification_queue = notification_queue, ChangeAggregate()
+            
+            if pending_changes.dropped:
+                logger.warning(f"⚠️ 变动汇总超出内存上限，{pending_changes.dropped} 个文件名未保存，仅计入数量")
+
+            # 代理模式：变动汇总转发给汇总端统一通知，暂时性失败时放回队列，与之后的变动合并后重试
+            if CLUSTER_MODE == "agent":
+                outcome = send_to_aggregator({"changes": pending_changes.groups()})
+                if outcome == SEND_OK:
                     last_notification_time = current_time
-                    logger.info("🟢 批量通知发送完成，队列已清空")
+                    logger.info("🟢 变动汇总已转发到汇总端")
+                elif outcome == SEND_DROP:
+                    last_notification_time = current_time
+                    logger.warning("⚠️ 汇总端拒绝了变动汇总，已放弃本次通知")
+                else:
+                    with log_lock:
+                        pending_changes.merge(notification_queue)
+                        notification_queue = pending_changes
+                continue
+            
+            # 加入 Telegram 发件箱
+            if send_telegram_notification(build_notification_message(pending_changes)):
+                last_notification_time = current_time
+                logger.info("🟢 批量通知已加入发送队列，队列已清空")
                 
         except Exception as e:
             logger.error(f"🔴 通知工作线程发生错误: {str(e)}")
             logger.error(traceback.format_exc())
 
+class ChangeJournal:
+    """
+    持久化的待处理变动日志（SQLite WAL 模式）。
+    record() 只把记录追加到内存缓冲区，由后台线程每 JOURNAL_COMMIT_INTERVAL_SECONDS 秒批量提交一次；
+    记录在 Emby 请求成功后才由 acknowledge() 删除。同时定期写入心跳时间，
+    异常退出后重启时据此判断停机期间发生变动的目录；正常退出时记录标记，重启后跳过该检查。
+    """
+    HEARTBEAT_SECONDS = 60
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS changes ("
+                         "seq INTEGER PRIMARY KEY, path TEXT, library_id TEXT, update_type TEXT, created_at REAL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._db.commit()
+        self._db_lock = threading.Lock()
+        self._buffer = []
+        self._buffer_lock = threading.Lock()
+        self._seq = (self._db.execute("SELECT MAX(seq) FROM changes").fetchone()[0] or 0)
+        self._last_heartbeat = 0.0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def record(self, path, library_id, update_type):
+        """追加一条待处理变动，返回其序号"""
+        with self._buffer_lock:
+            self._seq += 1
+            self._buffer.append((self._seq, path, library_id, update_type, time.time()))
+            return self._seq
+
+    def last_seq(self):
+        """返回最后一条记录的序号"""
+        return self._seq
+
+    def flush(self):
+        """批量提交缓冲区中的记录（组提交）"""
+        now = time.time()
+        heartbeat = now - self._last_heartbeat >= self.HEARTBEAT_SECONDS
+        # 持有 _db_lock 时才取出缓冲区，acknowledge() 拿到锁时，之前取出的批次都已写入
+        with self._db_lock:
+            with self._buffer_lock:
+                batch, self._buffer = self._buffer, []
+            if not batch and not heartbeat:
+                return
+            try:
+                with self._db:
+                    if batch:
+                        self._db.executemany("INSERT OR REPLACE INTO changes VALUES (?, ?, ?, ?, ?)", batch)
+                    if heartbeat:
+                        self._db.execute("INSERT OR REPLACE INTO meta VALUES ('heartbeat', ?)", (str(now),))
+                if heartbeat:
+                    self._last_heartbeat = now
+            except sqlite3.Error as e:
+                logger.error(f"🔴 写入变动日志失败: {e}")
+                with self._buffer_lock:
+                    self._buffer = batch + self._buffer
+
+    def acknowledge(self, library_ids, up_to_seq):
+        """Emby 请求成功后删除对应媒体库中序号不超过 up_to_seq 的记录"""
+        if not library_ids:
+            return
+        library_ids = set(library_ids)
+        with self._db_lock:
+            # 尚未写入的已确认记录直接丢弃，其余记录都已写入数据库，删除不会被之后的批量提交覆盖
+            with self._buffer_lock:
+                self._buffer = [record for record in self._buffer
+                                if record[2] not in library_ids or record[0] > up_to_seq]
+            try:
+                with self._db:
+                    self._db.executemany("DELETE FROM changes WHERE library_id = ? AND seq <= ?",
+                                         [(library_id, up_to_seq) for library_id in library_ids])
+            except sqlite3.Error as e:
+                logger.error(f"🔴 清理变动日志失败: {e}")
+
+    def pending(self):
+        """返回所有未完成的记录 [(路径, 媒体库ID, 更新类型)]"""
+        with self._db_lock:
+            return self._db.execute("SELECT path, library_id, update_type FROM changes ORDER BY seq").fetchall()
+
+    def last_heartbeat(self):
+        """返回上次运行时最后写入的心跳时间，首次运行时返回 None"""
+        with self._db_lock:
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'heartbeat'").fetchone()
+        return float(row[0]) if row else None
+
+    def clean_shutdown(self):
+        """上次运行是否正常退出（stop() 写入的标记）"""
+        with self._db_lock:
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'clean_shutdown'").fetchone()
+        return row is not None and row[0] == "1"
+
+    def _set_clean_shutdown(self, clean):
+        with self._db_lock:
+            try:
+                with self._db:
+                    self._db.execute("INSERT OR REPLACE INTO meta VALUES ('clean_shutdown', ?)",
+                                     ("1" if clean else "0",))
+            except sqlite3.Error as e:
+                logger.error(f"🔴 写入变动日志失败: {e}")
+
+    def _run(self):
+        while not self._stop_event.wait(JOURNAL_COMMIT_INTERVAL_SECONDS):
+            self.flush()
+
+    def start(self):
+        """启动批量提交线程"""
+        self._set_clean_shutdown(False)
+        self._thread = threading.Thread(target=self._run, name="ChangeJournal", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止提交线程，写入剩余记录和心跳"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._last_heartbeat = 0.0
+        self.flush()
+        self._set_clean_shutdown(True)
+        with self._db_lock:
+            self._db.close()
+
+change_journal = None  # 在 main() 中根据 JOURNAL_PATH 初始化
+
+def queue_recovered_change(path, library_id, update_type, journal=True):
+    """
+    将恢复的变动直接加入扫描队列（不发送文件变动通知）
+    :param library_id: 媒体库ID，未匹配时为 FULL_SCAN_MARKER
+    :param journal: 是否写入变动日志（从日志重放的记录无需重复写入）
+    """
+    with log_lock:
+        scan_requests.add(library_id)
+        if library_id != FULL_SCAN_MARKER:
+            scan_paths[library_id][path] = update_type
+        scan_scheduler.note_change(library_id, time.time())
+        if journal and change_journal:
+            change_journal.record(path, library_id, update_type)
+
+def replay_journal():
+    """启动时将变动日志中未完成的记录重新加入扫描队列"""
+    entries = change_journal.pending()
+    for path, library_id, update_type in entries:
+        queue_recovered_change(path, library_id, update_type, journal=False)
+    if entries:
+        logger.info(f"🟠 已从变动日志恢复 {len(entries)} 条未完成的扫描请求")
+
+def reconcile_changes_since(since, roots, is_video_file):
+    """
+    检查停机期间（since 之后）发生变动的目录，并加入扫描队列。
+    mtime/ctime 晚于 since 的子目录整体更新（同时覆盖新增和删除），不再深入；
+    媒体库根目录有变动时只更新其中的新条目，避免整库扫描。未变化的目录只做递归。
+    """
+    start = time.time()
+    found = 0
+
+    def queue(path, update_type):
+        queue_recovered_change(path, path_lookup.library_for(path) or FULL_SCAN_MARKER, update_type)
+
+    for root in roots:
+        stack = [root]
+        while stack:
+            directory = stack.pop()
+            try:
+                st = os.stat(directory)
+                changed = max(st.st_mtime, st.st_ctime) > since
+                if changed and directory != root:
+                    queue(directory, "Modified")
+                    found += 1
+                    continue
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                        if is_dir and path_filter.is_ignored_dir(entry.path):
+                            continue
+                        if changed:
+                            est = entry.stat(follow_symlinks=False)
+                            if max(est.st_mtime, est.st_ctime) > since and (is_dir or is_video_file(entry.path)):
+                                queue(entry.path, "Modified" if is_dir else "Created")
+                                found += 1
+                                continue
+                        if is_dir:
+                            stack.append(entry.path)
+            except OSError as e:
+                logger.warning(f"⚠️ 检查目录失败【{directory}】: {e}")
+    logger.info(f"🟢 停机期间变动检查完成，发现 {found} 处变动，耗时 {time.time() - start:.1f} 秒")
+
+class PendingChange:
+    """等待稳定的文件变动"""
+    __slots__ = ('event_type', 'first_seen', 'stable_since', 'size', 'mtime', 'needs_stat')
+
+    def __init__(self, event_type, now, needs_stat=True):
+        self.event_type = event_type
+        self.first_seen = now
+        self.stable_since = now
+        self.size = None
+        self.mtime = None
+        self.needs_stat = needs_stat
+
+class EventCoalescer:
+    """
+    事件合并器：位于 watchdog 回调与扫描队列之间。
+    按路径去重，将 创建->移动->重命名 链合并为最终目标路径，
+    并在文件大小和修改时间稳定 FILE_STABLE_SECONDS 秒后才提交。
+    watchdog 回调中只做字典操作，文件状态检查在独立的定时线程中完成。
+    """
+
+    def __init__(self, emit, path_filter):
+        """
+        :param emit: 提交变动的回调，参数为 (路径, 事件类型)
+        :param path_filter: 判断路径是否需要稳定检测的函数，不需要的路径直接提交
+        """
+        self._emit = emit
+        self._path_filter = path_filter
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def submit(self, path, event_type):
+        """提交创建类事件，等待文件稳定"""
+        if not self._path_filter(path):
+            self._emit(path, event_type)
+            return
+        now = time.time()
+        with self._lock:
+            entry = self._pending.get(path)
+            if entry is None or not entry.needs_stat:
+                self._pending[path] = PendingChange(event_type, now)
+            else:
+                entry.stable_since = now
+
+    def submit_removal(self, path, event_type):
+        """
+        提交删除类事件（删除、移动源）
+        如果路径仍在等待稳定（如临时文件被创建后又删除），则两者互相抵消。
+        """
+        if not self._path_filter(path):
+            self._emit(path, event_type)
+            return
+        with self._lock:
+            entry = self._pending.pop(path, None)
+            if entry is not None and entry.needs_stat:
+                return
+            self._pending[path] = PendingChange(event_type, time.time(), needs_stat=False)
+
+    def submit_move(self, src_path, dest_path):
+        """提交移动/重命名事件，未稳定的源路径直接合并到目标路径"""
+        now = time.time()
+        with self._lock:
+            entry = self._pending.get(src_path)
+            if entry is not None and entry.needs_stat:
+                del self._pending[src_path]
+                entry.stable_since = now
+                entry.size = entry.mtime = None
+                if self._path_filter(dest_path):
+                    self._pending[dest_path] = entry
+                return
+        if self._path_filter(src_path):
+            self.submit_removal(src_path, "移动(源)")
+        if self._path_filter(dest_path):
+            self.submit(dest_path, "移动(目标)")
+
+    def _collect_ready(self):
+        """检查所有等待中的路径，返回已稳定的 (路径, 事件类型) 列表"""
+        now = time.time()
+        with self._lock:
+            candidates = list(self._pending.items())
+
+        ready = []
+        gone = []
+        for path, entry in candidates:
+            if not entry.needs_stat:
+                ready.append((path, entry))
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                # 文件已不存在（临时文件），丢弃
+                gone.append((path, entry))
+                continue
+            if (st.st_size, st.st_mtime) != (entry.size, entry.mtime):
+                entry.size, entry.mtime = st.st_size, st.st_mtime
+                entry.stable_since = now
+            if (now - entry.stable_since >= FILE_STABLE_SECONDS
+                    or now - entry.first_seen >= FILE_STABLE_MAX_WAIT_SECONDS):
+                ready.append((path, entry))
+
+        result = []
+        with self._lock:
+            # 检查期间路径可能已被新事件替换，只移除本次检查过的条目
+            for path, entry in gone:
+                if self._pending.get(path) is entry:
+                    del self._pending[path]
+            for path, entry in ready:
+                if self._pending.get(path) is entry:
+                    del self._pending[path]
+                    result.append((path, entry.event_type))
+        return result
+
+    def flush(self):
+        """检查并提交所有已稳定的变动"""
+        for path, event_type in self._collect_ready():
+            try:
+                self._emit(path, event_type)
+            except Exception as e:
+                logger.error(f"🔴 提交文件变动时出错: {str(e)}")
+                logger.error(traceback.format_exc())
+
+    def _run(self):
+        while not self._stop_event.wait(FILE_STABLE_CHECK_INTERVAL_SECONDS):
+            self.flush()
+
+    def start(self):
+        """启动定时检查线程"""
+        self._thread = threading.Thread(target=self._run, name="EventCoalescer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止定时检查线程"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+class DirectoryScanner:
+    """
+    目录事件处理：整个文件夹被移入或创建时，在独立线程中遍历其子树（跳过忽略目录，
+    最多 DIRECTORY_SCAN_MAX_ENTRIES 个条目），找出其中的视频文件用于通知计数。
+    子树中最新的修改时间早于 FILE_STABLE_SECONDS 秒后，才作为一个文件夹级别的变动提交。
+    """
+
+    def __init__(self, emit, is_video_file):
+        """
+        :param emit: 提交变动的回调，参数为 (文件夹路径, 事件类型, 视频文件路径列表, 移动前的文件夹路径)
+        :param is_video_file: 判断文件是否需要处理的函数
+        """
+        self._emit = emit
+        self._is_video_file = is_video_file
+        self._pending = {}
+        self._sources = {}  # 移动目标文件夹 -> 移动前的文件夹路径
+        self._moved_sources = []  # 随上级文件夹一起提交的子文件夹移动前的路径，单独作为移动源提交
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def submit(self, path, event_type, src_path=None):
+        """
+        提交文件夹事件，由后台线程遍历；移动事件同时记录移动前的路径。
+        上级文件夹正在等待遍历时，子文件夹随上级一起提交，不再单独遍历和计数
+        """
+        with self._lock:
+            if self._covered(path):
+                if src_path:
+                    self._moved_sources.append(src_path)
+                return
+            prefix = path.rstrip('/') + '/'
+            for pending_path in [pending_path for pending_path in self._pending if pending_path.startswith(prefix)]:
+                del self._pending[pending_path]
+                if pending_path in self._sources:
+                    self._moved_sources.append(self._sources.pop(pending_path))
+            self._pending[path] = PendingChange(event_type, time.time())
+            if src_path:
+                self._sources[path] = src_path
+        self._wakeup.set()
+
+    def _covered(self, path):
+        # 调用方需持有 self._lock
+        parent = os.path.dirname(path)
+        while parent and parent != os.path.dirname(parent):
+            if parent in self._pending:
+                return True
+            parent = os.path.dirname(parent)
+        return False
+
+    def covers(self, path):
+        """路径是否位于等待遍历的文件夹中（其中的视频文件随文件夹一起提交和计数）"""
+        with self._lock:
+            return bool(self._pending) and self._covered(path)
+
+    def _scan(self, path):
+        """
+        遍历文件夹子树
+        :return: (视频文件路径列表, 最新修改时间)，文件夹已不存在时返回 (None, None)
+        """
+        files = []
+        newest = 0.0
+        visited = 0
+        stack = [path]
+        while stack:
+            current = stack.pop()
+            try:
+                with os.scandir(current) as entries:
+                    for entry in entries:
+                        visited += 1
+                        if visited > DIRECTORY_SCAN_MAX_ENTRIES:
+                            logger.warning(f"⚠️ 文件夹【{path}】条目超过 {DIRECTORY_SCAN_MAX_ENTRIES} 个，"
+                                           f"只统计前 {DIRECTORY_SCAN_MAX_ENTRIES} 个")
+                            return files, newest
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                if entry.name not in path_filter.ignored_dir_names:
+                                    stack.append(entry.path)
+                            elif self._is_video_file(entry.path):
+                                files.append(entry.path)
+                                newest = max(newest, entry.stat(follow_symlinks=False).st_mtime)
+                        except OSError:
+                            continue
+            except OSError:
+                if current == path:
+                    return None, None
+        return files, newest
+
+    def _collect_ready(self):
+        """遍历所有等待中的文件夹，返回已稳定的 (文件夹路径, 事件类型, 视频文件列表, 移动前的路径) 列表"""
+        now = time.time()
+        with self._lock:
+            candidates = list(self._pending.items())
+
+        checked = []
+        for path, entry in candidates:
+            files, newest = self._scan(path)
+            if not files:
+                # 文件夹已不存在或其中没有视频文件（如新建的空文件夹，之后的文件事件会单独处理）
+                checked.append((path, entry, None))
+            elif (now - newest >= FILE_STABLE_SECONDS
+                    or now - entry.first_seen >= FILE_STABLE_MAX_WAIT_SECONDS):
+                checked.append((path, entry, sorted(files)))
+
+        result = []
+        with self._lock:
+            # 遍历期间文件夹可能有新事件，只移除本次检查过的条目
+            for path, entry, files in checked:
+                if self._pending.get(path) is not entry:
+                    continue
+                del self._pending[path]
+                src_path = self._sources.pop(path, None)
+                if files:
+                    result.append((path, entry.event_type, files, src_path))
+        return result
+
+    def flush(self):
+        """遍历并提交所有已稳定的文件夹"""
+        with self._lock:
+            moved_sources, self._moved_sources = self._moved_sources, []
+        ready = [(path, "移动(源)", [], None) for path in moved_sources] + self._collect_ready()
+        for path, event_type, files, src_path in ready:
+            try:
+                self._emit(path, event_type, files, src_path)
+            except Exception as e:
+                logger.error(f"🔴 提交文件夹变动时出错: {str(e)}")
+                logger.error(traceback.format_exc())
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self._wakeup.wait(FILE_STABLE_CHECK_INTERVAL_SECONDS)
+            self._wakeup.clear()
+            if self._pending or self._moved_sources:
+                self.flush()
+
+    def start(self):
+        """启动遍历线程"""
+        self._thread = threading.Thread(target=self._run, name="DirectoryScanner", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止遍历线程"""
+        self._stop_event.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+
 class VideoChangeHandler(FileSystemEventHandler):
     """文件系统事件处理器"""
+    def __init__(self):
+        super().__init__()
+        # 启用稳定检测时，事件先进入合并器，稳定后再加入扫描队列
+        self.coalescer = None
+        if FILE_STABLE_SECONDS > 0:
+            self.coalescer = EventCoalescer(self._commit_change, self._is_video_file)
+        # 文件夹事件在独立线程中遍历，提交为一个文件夹级别的变动
+        self.directory_scanner = DirectoryScanner(self._queue_directory_change, self._is_video_file)
+
     def _is_video_file(self, path):
-        """检查文件是否为指定的视频格式"""
-        return path.lower().endswith(VIDEO_EXTENSIONS)
+        """检查文件是否需要处理（视频格式且未被忽略规则排除）"""
+        return path_filter.matches(path)
+
+    def _commit_change(self, path, event_type):
+        """将合并后的变动提交到对应队列"""
+        if event_type == "删除" and not EMBY_SEND_DELETIONS:
+            self._record_deletion(path)
+        else:
+            self._queue_scan_request(path, event_type)
 
     def _queue_scan_request(self, path, event_type):
         """根据文件路径，将对应的扫描请求加入队列，并记录变动信息"""
         if not self._is_video_file(path):
-            logger.info("⚪️ 检测到非视频文件变动，忽略处理")
-            logger.info(f"⚪️ 路径:【{path}】")
+            path_filter.count_ignored(path_filter.reject_reason(path))
             return
 
-        matched_library_id = None
-        # 从最长的路径开始匹配，避免子目录匹配错误
-        sorted_paths = sorted(MONITORED_FOLDERS_TO_LIBRARY_ID_MAP.keys(), key=len, reverse=True)
-
-        for folder_path in sorted_paths:
-            if path.startswith(folder_path):
-                matched_library_id = MONITORED_FOLDERS_TO_LIBRARY_ID_MAP[folder_path]
-                break
+        # 按路径分量做最长前缀匹配，避免子目录或同名前缀匹配错误
+        matched_library_id = path_lookup.library_for(path)
+        if event_type == "删除" and not matched_library_id:
+            # 未匹配到媒体库的删除不值得触发全库扫描
+            self._record_deletion(path)
+            return
         
+        # 锁内只做队列操作，日志输出放在锁外
         with log_lock:
             # 记录文件变动信息
-            file_changes.append({
-                "path": path,
-                "event_type": event_type,
-                "library_id": matched_library_id or "未知"
-            })
+            file_changes.add(event_type, matched_library_id or "未知", path)
             
             if matched_library_id:
-                # 获取媒体库名称
-                library_name = LIBRARY_ID_TO_NAME.get(matched_library_id, f"未知({matched_library_id})")
-                logger.info("🟠 检测到有文件变动")
-                logger.info(f"🟠 路径:【{path}】")
-                logger.info(f"🟠 Emby【{library_name}媒体库】已加入到队列")
                 scan_requests.add(matched_library_id)
+                # 记录变动路径，用于路径精确更新
+                scan_paths[matched_library_id][path] = EVENT_TYPE_TO_UPDATE_TYPE.get(event_type, "Modified")
             else:
-                logger.info("🟠 检测到有文件变动")
-                logger.info(f"🟠 路径:【{path}】")
-                logger.info("🟠 未匹配到媒体库编号，将全库扫描")
                 scan_requests.add(FULL_SCAN_MARKER)
+            scan_scheduler.note_change(matched_library_id or FULL_SCAN_MARKER, time.time())
+            if change_journal:
+                change_journal.record(path, matched_library_id or FULL_SCAN_MARKER,
+                                      EVENT_TYPE_TO_UPDATE_TYPE.get(event_type, "Modified"))
             
             # 添加到通知队列
-            notification_queue.append({
-                "path": path,
-                "event_type": event_type,
-                "library_id": matched_library_id or "未知"
-            })
-            
-            logger.info(f"🟠 已添加到通知队列，当前队列大小: {len(notification_queue)}")
+            notification_queue.add(event_type, matched_library_id or "未知", path)
+            queue_size = len(notification_queue)
+        metrics.inc("embyfmb_events_total",
+                    (event_type, library_display_name(matched_library_id or FULL_SCAN_MARKER)))
+        
+        event_logger.info("🟠 检测到有文件变动")
+        event_logger.info(f"🟠 路径:【{path}】")
+        if matched_library_id:
+            # 获取媒体库名称
+            library_name = LIBRARY_ID_TO_NAME.get(matched_library_id, f"未知({matched_library_id})")
+            event_logger.info(f"🟠 Emby【{library_name}媒体库】已加入到队列")
+        else:
+            event_logger.info("🟠 未匹配到媒体库编号，将全库扫描")
+        event_logger.info(f"🟠 已添加到通知队列，当前队列大小: {queue_size}")
+
+    def _queue_directory_change(self, path, event_type, video_files, src_path=None):
+        """
+        将整个文件夹作为一个路径更新加入队列，文件夹中的视频文件逐个计入通知
+        :param src_path: 文件夹移动前的路径，同时作为一个文件夹更新加入队列
+        """
+        if src_path:
+            self._queue_directory_change(src_path, "移动(源)", [])
+        matched_library_id = path_lookup.library_for(path)
+        update_type = EVENT_TYPE_TO_UPDATE_TYPE.get(event_type, "Modified")
+        
+        with log_lock:
+            if video_files:
+                file_changes.add_many(event_type, matched_library_id or "未知", video_files)
+            if matched_library_id:
+                scan_requests.add(matched_library_id)
+                scan_paths[matched_library_id][path] = update_type
+            else:
+                scan_requests.add(FULL_SCAN_MARKER)
+            scan_scheduler.note_change(matched_library_id or FULL_SCAN_MARKER, time.time())
+            if change_journal:
+                change_journal.record(path, matched_library_id or FULL_SCAN_MARKER, update_type)
+            if video_files:
+                notification_queue.add_many(event_type, matched_library_id or "未知", video_files)
+            queue_size = len(notification_queue)
+        metrics.inc("embyfmb_events_total",
+                    (event_type, library_display_name(matched_library_id or FULL_SCAN_MARKER)), max(len(video_files), 1))
+        
+        if video_files:
+            event_logger.info(f"🟠 文件夹【{path}】已作为一个路径更新加入队列，其中有 {len(video_files)} 个视频文件")
+        else:
+            event_logger.info(f"🟠 文件夹【{path}】已作为一个路径更新加入队列")
+        if matched_library_id:
+            library_name = LIBRARY_ID_TO_NAME.get(matched_library_id, f"未知({matched_library_id})")
+            event_logger.info(f"🟠 Emby【{library_name}媒体库】已加入到队列（文件夹更新）")
+        else:
+            event_logger.info("🟠 未匹配到媒体库编号，将全库扫描")
+        event_logger.info(f"🟠 已添加到通知队列，当前队列大小: {queue_size}")
+
+    def _accept_directory(self, path):
+        """文件夹事件是否需要处理（不在忽略目录中）"""
+        if path_filter.is_ignored_dir(path):
+            path_filter.count_ignored("忽略目录")
+            return False
+        return True
+
+    def _record_deletion(self, path):
+        """记录删除事件但不触发扫描"""
+        with log_lock:
+            file_changes.add("删除", "不扫描", path)
+        metrics.inc("embyfmb_events_total", ("删除", "不扫描"))
 
+    @measure_latency(handler_latency)
     def on_created(self, event):
-        if not event.is_directory:
-            logger.info("🟠 检测到有文件创建")
-            logger.info(f"🟠 路径: {event.src_path}")
-            self._queue_scan_request(event.src_path, "创建")
+        # 文件夹移入或创建时 watchdog 会为其中已有的内容补发合成事件，这些内容由文件夹更新统一处理
+        if getattr(event, "is_synthetic", False):
+            return
+        if event.is_directory:
+            if self._accept_directory(event.src_path):
+                event_logger.info(f"🟠 检测到有文件夹创建: {event.src_path}")
+                self.directory_scanner.submit(event.src_path, "创建")
+            return
+        # 逐个拷贝进新文件夹的文件（如 SMB 拷贝）会产生真实的文件事件，由文件夹遍历统一计数，避免重复
+        if self.directory_scanner.covers(event.src_path):
+            return
+        if path_filter.accept(event.src_path):
+            event_logger.info("🟠 检测到有文件创建")
+            event_logger.info(f"🟠 路径: {event.src_path}")
+            if self.coalescer is not None:
+                self.coalescer.submit(event.src_path, "创建")
+            else:
+                self._queue_scan_request(event.src_path, "创建")
 
+    @measure_latency(handler_latency)
     def on_deleted(self, event):
-        if not event.is_directory:
-            logger.info("⚪️ 检测到有文件删除")
-            logger.info(f"⚪️ 路径: {event.src_path}")
-            logger.info("⚪️ 当前设置为不刷新或非视频文件")
-            # 记录删除事件但不触发扫描
-            with log_lock:
-                file_changes.append({
-                    "path": event.src_path,
-                    "event_type": "删除",
-                    "library_id": "不扫描"
-                })
+        if event.is_directory:
+            # 文件夹被删除或移出监控范围，作为一个文件夹删除更新发送
+            if (EMBY_SEND_DELETIONS and self._accept_directory(event.src_path)
+                    and path_lookup.library_for(event.src_path)):
+                event_logger.info(f"⚪️ 检测到有文件夹删除: {event.src_path}")
+                self._queue_directory_change(event.src_path, "删除", [event.src_path])
+            return
+        # 新文件夹提交前其中被删除的文件，Emby 从未见过，无需更新
+        if self.directory_scanner.covers(event.src_path):
+            return
+        if path_filter.accept(event.src_path):
+            event_logger.info("⚪️ 检测到有文件删除")
+            event_logger.info(f"⚪️ 路径: {event.src_path}")
+            if not EMBY_SEND_DELETIONS:
+                event_logger.info("⚪️ 当前设置为删除不刷新")
+            if self.coalescer is not None:
+                self.coalescer.submit_removal(event.src_path, "删除")
+            else:
+                self._commit_change(event.src_path, "删除")
 
+    @measure_latency(handler_latency)
     def on_moved(self, event):
-        if not event.is_directory:
-            logger.info("🟠 检测到有文件移动/重命名")
-            logger.info(f"🟠 从 {event.src_path}")
-            logger.info(f"🟠 到 {event.dest_path}")
+        if getattr(event, "is_synthetic", False):
+            return
+        if event.is_directory:
+            self._on_directory_moved(event)
+            return
+        if self.directory_scanner.covers(event.dest_path):
+            # 移入（或在其中重命名，如 .part 改为 .mkv）等待遍历的文件夹，目标随文件夹一起提交，只处理源路径
+            if not self.directory_scanner.covers(event.src_path) and path_filter.accept(event.src_path):
+                event_logger.info(f"🟠 检测到有文件移入新文件夹: {event.src_path}")
+                if self.coalescer is not None:
+                    self.coalescer.submit_removal(event.src_path, "移动(源)")
+                else:
+                    self._queue_scan_request(event.src_path, "移动(源)")
+            return
+        if path_filter.accept(event.dest_path, event.src_path):
+            event_logger.info("🟠 检测到有文件移动/重命名")
+            event_logger.info(f"🟠 从 {event.src_path}")
+            event_logger.info(f"🟠 到 {event.dest_path}")
             # 移动/重命名事件，源和目标路径都可能触发扫描
-            self._queue_scan_request(event.src_path, "移动(源)")
-            self._queue_scan_request(event.dest_path, "移动(目标)")
+            if self.coalescer is not None:
+                self.coalescer.submit_move(event.src_path, event.dest_path)
+            else:
+                # 被排除的一侧（如下载器的 .part 临时文件）不加入队列
+                if self._is_video_file(event.src_path):
+                    self._queue_scan_request(event.src_path, "移动(源)")
+                if self._is_video_file(event.dest_path):
+                    self._queue_scan_request(event.dest_path, "移动(目标)")
+
+    def _on_directory_moved(self, event):
+        """文件夹移动/重命名：目标文件夹由后台线程遍历，源文件夹随目标一起作为路径更新提交"""
+        src_accepted = not path_filter.is_ignored_dir(event.src_path)
+        if path_filter.is_ignored_dir(event.dest_path):
+            # 移入回收站等忽略目录，相当于从媒体库中移除
+            path_filter.count_ignored("忽略目录")
+            if src_accepted:
+                event_logger.info(f"🟠 检测到有文件夹移出: {event.src_path}")
+                self._queue_directory_change(event.src_path, "移动(源)", [])
+            return
+        event_logger.info("🟠 检测到有文件夹移动/重命名")
+        event_logger.info(f"🟠 从 {event.src_path}")
+        event_logger.info(f"🟠 到 {event.dest_path}")
+        self.directory_scanner.submit(event.dest_path, "移动(目标)", event.src_path if src_accepted else None)
+
+def process_scan_cycle(libraries=None):
+    """
+    处理一个扫描周期：在锁内取出待处理的请求，在锁外发送网络请求
+    :param libraries: 只处理这些媒体库的请求（自适应调度）。为 None 时处理全部请求并清空变动记录。
+    """
+    global scan_requests, scan_paths, file_changes
+
+    # Emby 正在扫描和未到重试时间的媒体库暂缓处理，请求保留在队列中继续合并（代理不直接请求 Emby，由汇总端跟踪）
+    agent = CLUSTER_MODE == "agent"
+    held = set()
+    if libraries is None:
+        now = time.time()
+        with log_lock:
+            candidates = set(scan_requests)
+        held = scan_retry.held_libraries(candidates, now)
+        if EMBY_SCAN_TRACKING and not agent:
+            scan_tracker.poll(now, needed=bool(candidates))
+            held |= scan_tracker.held_libraries(candidates, now)
+
+    # 原子地交换待处理集合，文件事件回调无需等待网络请求
+    with log_lock:
+        if libraries is None and not held:
+            pending_libraries, scan_requests = scan_requests, set()
+            pending_paths, scan_paths = scan_paths, defaultdict(dict)
+        else:
+            pending_libraries = scan_requests - held if libraries is None else scan_requests & libraries
+            scan_requests -= pending_libraries
+            pending_paths = {lib: scan_paths.pop(lib) for lib in pending_libraries if lib in scan_paths}
+        if libraries is None:
+            pending_changes, file_changes = file_changes, ChangeAggregate(sample_size=0)
+        else:
+            pending_changes = None
+        journal_seq = change_journal.last_seq() if change_journal else 0
+        unscanned_since = scan_scheduler.take_unscanned_since(pending_libraries)
+
+    if pending_changes is not None and not pending_libraries and not pending_changes:
+        logger.info("⚪️ 此周期内未监测到视频文件变动。")
+        return
+
+    # 处理扫描请求
+    if pending_libraries:
+        # 获取媒体库名称列表
+        lib_names = []
+        for lib_id in pending_libraries:
+            if lib_id == FULL_SCAN_MARKER:
+                lib_names.append("全库扫描")
+            else:
+                lib_name = LIBRARY_ID_TO_NAME.get(lib_id, f"未知({lib_id})")
+                lib_names.append(lib_name)
+        
+        logger.info("🟠 检测到有文件变动")
+        logger.info(f"🟠 待扫描处理媒体库:【{', '.join(lib_names)}】")
+
+        if agent:
+            results = forward_scan_requests(pending_libraries, pending_paths)
+        else:
+            results = dispatch_scan_requests(pending_libraries, pending_paths)
+        # 暂时性失败放回队列按退避间隔重试；被拒绝或无法映射的请求重试也不会成功，放弃并从变动日志中确认
+        failed = {library_id for library_id, result in results.items() if "失败" in result}
+        dropped = {library_id for library_id, result in results.items() if "放弃" in result}
+        succeeded = set(results) - failed - dropped
+        if FULL_SCAN_MARKER in failed:
+            failed = pending_libraries
+        elif FULL_SCAN_MARKER in dropped:
+            dropped = pending_libraries
+        # 上一次已经失败且本周期仍然失败的媒体库不重复通知
+        failing_before = scan_retry.failing()
+        scan_retry.clear((pending_libraries | set(results)) - failed)
+        if failed:
+            requeue_scan_requests(failed, pending_paths)
+        if dropped:
+            names = [library_display_name(library_id) for library_id in dropped]
+            logger.warning(f"⚠️ 以下媒体库的请求被拒绝或路径无法映射，已放弃且不再重试:【{', '.join(names)}】")
+        now = time.time()
+        for library_id, result in results.items():
+            outcome = ("failure" if library_id in failed else "dropped" if library_id in dropped else
+                       "blocked" if "拦截" in result else "success")
+            metrics.inc("embyfmb_scans_total", (library_display_name(library_id), outcome))
+        # 全库扫描成功时，本周期取出的所有媒体库都已扫描
+        for library_id in pending_libraries if FULL_SCAN_MARKER in succeeded else succeeded:
+            if library_id in unscanned_since:
+                metrics.observe("embyfmb_change_to_scan_seconds", now - unscanned_since[library_id],
+                                (library_display_name(library_id),))
+        if EMBY_SCAN_TRACKING and not agent:
+            scan_tracker.mark_started(succeeded, time.time())
+        if change_journal:
+            # 全库扫描成功时，本周期取出的所有媒体库请求都已完成
+            change_journal.acknowledge(pending_libraries if FULL_SCAN_MARKER in succeeded else succeeded | dropped,
+                                       journal_seq)
+
+        # 扫描完成后发送汇总通知
+        # 代理的转发结果只写日志，通知由汇总端发送
+        lines = ["🎬 Emby 服务器操作记录", ""]
+        for library_id, result in results.items():
+            icon = "🔴" if "失败" in result or "放弃" in result else "⚠️" if "拦截" in result else "🟢"
+            if library_id == FULL_SCAN_MARKER:
+                lines.append(f"{icon} {result}")
+            else:
+                library_name = LIBRARY_ID_TO_NAME.get(library_id, f"未知({library_id})")
+                lines.append(f"{icon} 【{library_name}媒体库】{result}")
+        if not results:
+            lines.append("⚪️ 未触发刷新扫描（仅记录变动）")
+        lines.append("")
+        
+        if agent:
+            for line in lines[2:-1]:
+                logger.info(line)
+        elif results and set(results) <= failed and failed <= failing_before:
+            logger.info("⚪️ 重试仍然失败，与上次结果相同，不重复发送通知")
+        else:
+            send_telegram_notification("\n".join(lines))
+
+    if pending_changes is not None:
+        logger.info("🟢 扫描队列和变动记录已清空")
+        logger.info("🟢 继续进行下一个扫描周期...")
+
+def requeue_scan_requests(library_ids, pending_paths):
+    """将暂时性失败的扫描请求放回队列，按退避间隔重试（期间的新变动优先）"""
+    delay = scan_retry.record_failure(library_ids, time.time())
+    with log_lock:
+        for library_id in library_ids:
+            scan_requests.add(library_id)
+            paths = pending_paths.get(library_id)
+            if paths:
+                merged = dict(paths)
+                merged.update(scan_paths.get(library_id, {}))
+                scan_paths[library_id] = merged
+            scan_scheduler.note_change(library_id, time.time())
+    names = ["全部媒体库" if library_id == FULL_SCAN_MARKER else
+             LIBRARY_ID_TO_NAME.get(library_id, f"未知({library_id})") for library_id in library_ids]
+    logger.warning(f"⚠️ 以下媒体库的请求发送失败，已放回队列，{delay:.0f} 秒后重试:【{', '.join(names)}】")
+
+def run_scan_loop():
+    """扫描主循环：自适应调度时每秒检查到期的媒体库，否则按固定周期扫描"""
+    if SCAN_DEBOUNCE_SECONDS <= 0:
+        while True:
+            time.sleep(SCAN_INTERVAL_SECONDS)
+            process_scan_cycle()
+            log_performance_stats()
+
+    global file_changes
+    last_report = time.time()
+    while True:
+        time.sleep(1)
+        now = time.time()
+        with log_lock:
+            due_libraries = scan_scheduler.due(now)
+        due_libraries -= scan_retry.held_libraries(due_libraries, now)
+
+        # Emby 正在扫描的媒体库暂缓发送，变动继续在队列中合并，扫描结束后一次性发送
+        if EMBY_SCAN_TRACKING:
+            scan_tracker.poll(now, needed=bool(due_libraries))
+            due_libraries -= scan_tracker.held_libraries(due_libraries, now)
+
+        if due_libraries:
+            with log_lock:
+                # 全库扫描会覆盖所有媒体库，一并取出其他待扫描的媒体库
+                if FULL_SCAN_MARKER in due_libraries:
+                    due_libraries |= scan_scheduler.due(now, everything=True)
+                scan_scheduler.mark_scanned(due_libraries, now)
+            process_scan_cycle(due_libraries)
+
+        # 按 SCAN_INTERVAL_SECONDS 周期清理变动记录并输出统计
+        if now - last_report >= SCAN_INTERVAL_SECONDS:
+            last_report = now
+            with log_lock:
+                pending_changes, file_changes = file_changes, ChangeAggregate(sample_size=0)
+            if not pending_changes:
+                logger.info("⚪️ 此周期内未监测到视频文件变动。")
+            else:
+                logger.info(f"📊 此周期内共监测到 {pending_changes.total} 个视频文件变动")
+            log_performance_stats()
+
+class SnapshotPoller:
+    """
+    增量快照轮询：为 inotify 无法感知远端变动的挂载点检测文件变动。
+    索引中保存每个目录的 mtime 和条目列表，只有 mtime 变化的目录才会重新列出，
+    目录的 stat 和 scandir 由线程池并行完成，差异以 watchdog 事件的形式交给 VideoChangeHandler。
+    """
+
+    def __init__(self, handler, roots):
+        self._handler = handler
+        self._roots = list(roots)
+        self._root_index = PathPrefixIndex({root: True for root in self._roots})
+        self._roots_lock = threading.Lock()
+        self._removed_roots = []  # 等待在轮询线程中移除的根目录
+        self._index = {}  # 目录路径 -> [mtime_ns, {文件名: inode}, {子目录名: inode}]
+        self._resume = []  # 上次轮询因超出时间预算未检查的目录 [(路径, 是否为基线扫描)]
+        self._dirty = False
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._executor = None
+
+    def _in_roots(self, path):
+        return self._root_index.longest_match(path)[0] is not None
+
+    def add_root(self, path):
+        """运行中追加轮询的根目录（如超出 inotify 监控预算的子树），下次轮询时建立基线"""
+        with self._roots_lock:
+            if path in self._removed_roots:
+                self._removed_roots.remove(path)
+            if path in self._roots:
+                return
+            self._root_index.add(path, True)
+            self._roots = self._roots + [path]
+        if self._thread is None:
+            self.start()
+
+    def remove_root(self, path):
+        """停止轮询某个根目录（如已被删除的目录），在下次轮询前从根目录和索引中移除"""
+        with self._roots_lock:
+            if path in self._roots and path not in self._removed_roots:
+                self._removed_roots.append(path)
+
+    def _apply_removed_roots(self):
+        with self._roots_lock:
+            removed, self._removed_roots = self._removed_roots, []
+            self._roots = [root for root in self._roots if root not in removed]
+            self._root_index = PathPrefixIndex({root: True for root in self._roots})
+        index = {path: entry for path, entry in self._index.items() if self._in_roots(path)}
+        if len(index) != len(self._index):
+            self._index = index
+            self._dirty = True
+        self._resume = [item for item in self._resume if self._in_roots(item[0])]
+
+    def load_index(self):
+        """加载持久化的目录索引"""
+        try:
+            with open(POLLING_INDEX_PATH, encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ 轮询索引读取失败，将重新建立: {e}")
+            return
+        self._index = {path: entry for path, entry in data.get("index", {}).items() if self._in_roots(path)}
+        logger.info(f"🟢 已加载轮询索引，共 {len(self._index)} 个目录")
+
+    def save_index(self):
+        """原子地写入目录索引"""
+        if not self._dirty:
+            return
+        tmp_path = POLLING_INDEX_PATH + ".tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"version": 1, "index": self._index}, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_path, POLLING_INDEX_PATH)
+            self._dirty = False
+        except OSError as e:
+            logger.error(f"🔴 轮询索引保存失败: {e}")
+
+    @staticmethod
+    def _list_dir(path, known_mtime):
+        """
+        在工作线程中检查目录
+        :return: (mtime_ns, 文件, 子目录)。mtime 未变化时文件和子目录为 None，目录不存在时全部为 None
+        """
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            if mtime == known_mtime:
+                return mtime, None, None
+            files, dirs = {}, {}
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name not in path_filter.ignored_dir_names:
+                                dirs[entry.name] = entry.inode()
+                        else:
+                            files[entry.name] = entry.inode()
+                    except OSError:
+                        continue
+            return mtime, files, dirs
+        except OSError:
+            return None, None, None
+
+    def _forget_subtree(self, path, deleted, dir_events):
+        """目录被删除时，从索引中移除整个子树并记录其中的文件删除"""
+        stack = [path]
+        while stack:
+            current = stack.pop()
+            entry = self._index.pop(current, None)
+            if entry is None:
+                continue
+            self._dirty = True
+            for name, inode in entry[1].items():
+                deleted.append((os.path.join(current, name), inode))
+            for name in entry[2]:
+                stack.append(os.path.join(current, name))
+        dir_events.append(DirDeletedEvent(path))
+
+    def poll_once(self):
+        """执行一次增量轮询，返回本次检查的目录数"""
+        deadline = time.monotonic() + POLLING_BUDGET_SECONDS
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=POLLING_WORKERS, thread_name_prefix="SnapshotPoller")
+        if self._removed_roots:
+            self._apply_removed_roots()
+        if self._resume:
+            frontier, self._resume = self._resume, []
+        else:
+            # 没有索引的根目录先建立基线，不产生事件
+            frontier = [(root, root not in self._index) for root in self._roots if os.path.isdir(root)]
+        created, deleted, dir_events = [], [], []
+        checked = listed = 0
+        batch_size = POLLING_WORKERS * 16
 
-# 在 main() 前调用
+        while frontier:
+            if time.monotonic() > deadline or self._stop_event.is_set():
+                self._resume = frontier
+                break
+            batch, frontier = frontier[:batch_size], frontier[batch_size:]
+            known = [self._index.get(path) for path, _ in batch]
+            results = self._executor.map(
+                self._list_dir, [path for path, _ in batch], [entry[0] if entry else None for entry in known])
+
+            for (path, baseline), entry, (mtime, files, dirs) in zip(batch, known, results):
+                checked += 1
+                if mtime is None:
+                    # 目录已不存在，由上级目录的差异处理
+                    continue
+                if files is None:
+                    frontier.extend((os.path.join(path, name), baseline) for name in entry[2])
+                    continue
+
+                listed += 1
+                old_files, old_dirs = (entry[1], entry[2]) if entry else ({}, {})
+                self._index[path] = [mtime, files, dirs]
+                self._dirty = True
+                for name, inode in dirs.items():
+                    child = os.path.join(path, name)
+                    if name not in old_dirs and not baseline:
+                        # 新文件夹整体作为一个文件夹事件处理，其中的文件只加入索引，不再逐个产生事件
+                        dir_events.append(DirCreatedEvent(child))
+                        frontier.append((child, True))
+                        continue
+                    frontier.append((child, baseline))
+                for name in old_dirs:
+                    if name not in dirs:
+                        self._forget_subtree(os.path.join(path, name), deleted, dir_events)
+                if baseline:
+                    continue
+                for name, inode in files.items():
+                    if name not in old_files:
+                        created.append((os.path.join(path, name), inode))
+                for name, inode in old_files.items():
+                    if name not in files:
+                        deleted.append((os.path.join(path, name), inode))
+
+        self._dispatch(created, deleted, dir_events)
+        if created or deleted or self._resume:
+            logger.info(f"🔍 轮询完成: 检查 {checked} 个目录，重新列出 {listed} 个，"
+                        f"新增 {len(created)} 个文件，删除 {len(deleted)} 个文件")
+        if self._resume:
+            logger.warning(f"⚠️ 轮询超出 {POLLING_BUDGET_SECONDS} 秒时间预算，剩余 {len(self._resume)} 个目录下次继续")
+        self.save_index()
+        return checked
+
+    def _dispatch(self, created, deleted, dir_events):
+        """按 inode 将删除和新增配对为移动事件，并交给事件处理器"""
+        created_by_inode = {inode: path for path, inode in created if inode}
+        moved_dest = set()
+        events = list(dir_events)
+        for src_path, inode in deleted:
+            dest_path = created_by_inode.pop(inode, None) if inode else None
+            if dest_path:
+                moved_dest.add(dest_path)
+                events.append(FileMovedEvent(src_path, dest_path))
+            else:
+                events.append(FileDeletedEvent(src_path))
+        for path, _ in created:
+            if path not in moved_dest:
+                events.append(FileCreatedEvent(path))
+        for event in events:
+            try:
+                self._handler.dispatch(event)
+            except Exception as e:
+                logger.error(f"🔴 处理轮询事件时出错: {str(e)}")
+                logger.error(traceback.format_exc())
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.poll_once()
+            except Exception as e:
+                logger.error(f"🔴 轮询监控发生错误: {str(e)}")
+                logger.error(traceback.format_exc())
+            self._stop_event.wait(POLLING_INTERVAL_SECONDS)
+
+    def start(self):
+        """加载索引并启动轮询线程"""
+        self.load_index()
+        self._thread = threading.Thread(target=self._run, name="SnapshotPoller", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止轮询线程并保存索引"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._executor is not None:
+            self._executor.shutdown()
+        self.save_index()
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """/metrics 接口"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != "/metrics":
+            self.send_error(404)
+            return
+        payload = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+def start_metrics_server(observer, event_handler, poller):
+    """注册实时指标并在后台线程中启动 /metrics 接口"""
+    metrics.gauge("embyfmb_scan_requests_pending", "等待发送扫描的媒体库数", lambda: len(scan_requests))
+    metrics.gauge("embyfmb_scan_paths_pending", "等待发送的路径更新数",
+                  lambda: sum(len(paths) for paths in list(scan_paths.values())))
+    metrics.gauge("embyfmb_notification_queue_changes", "等待通知的文件变动数", lambda: notification_queue.total)
+    metrics.gauge("embyfmb_telegram_outbox_messages", "等待发送的 Telegram 消息数", telegram_sender.pending)
+    metrics.gauge("embyfmb_observer_queue_depth", "watchdog 事件队列中尚未处理的事件数（持续增长说明处理跟不上）",
+                  lambda: observer.event_queue.qsize())
+    metrics.gauge("embyfmb_directory_scanner_pending", "等待遍历的文件夹数", lambda: len(event_handler.directory_scanner))
+    if event_handler.coalescer is not None:
+        metrics.gauge("embyfmb_stability_pending", "等待文件稳定的路径数", lambda: len(event_handler.coalescer))
+    if Inotify is not None:
+        metrics.gauge("embyfmb_inotify_watches", "已添加的 inotify 监控数", lambda: FilteredInotify.watch_count)
+        metrics.gauge("embyfmb_inotify_cold_dirs", "超出 inotify 监控预算、改为轮询的目录数",
+                      lambda: len(FilteredInotify.cold_dirs))
+    metrics.gauge("embyfmb_log_dropped", "因日志队列已满丢弃的日志数",
+                  lambda: log_queue_handler.dropped if log_queue_handler is not None else 0)
+    if poller:
+        metrics.gauge("embyfmb_polling_resume_dirs", "轮询因超出时间预算留到下次检查的目录数", lambda: len(poller._resume))
+
+    server = ThreadingHTTPServer((METRICS_BIND_ADDRESS, METRICS_PORT), MetricsRequestHandler)
+    server.daemon_threads = True
+    metrics.enabled = True
+    threading.Thread(target=server.serve_forever, name="Metrics", daemon=True).start()
+    logger.info(f"🟢 监控指标接口已启动: http://{METRICS_BIND_ADDRESS}:{METRICS_PORT}/metrics")
+    return server
+
+def receive_agent_changes(payload):
+    """
+    汇总端：把代理转发的扫描请求和变动汇总加入本机队列，由本机的扫描调度和通知线程统一处理。
+    不同主机转发的相同容器路径在队列中只保留一条。内容不合法时抛出 ValueError/TypeError，队列保持不变。
+    :return: (路径更新数量, 文件变动数量)
+    """
+    if not isinstance(payload, dict):
+        raise TypeError("请求体必须是 JSON 对象")
+    # 先完整校验并转换，再加锁修改队列，避免部分写入
+    updates = {}
+    for library_id, paths in (payload.get("updates") or {}).items():
+        library_id = str(library_id)
+        if library_id == FULL_SCAN_MARKER:
+            updates[library_id] = {}
+            continue
+        if not isinstance(paths, dict):
+            raise TypeError(f"媒体库 {library_id} 的路径更新必须是对象")
+        library_paths = {}
+        for container_path, update_type in paths.items():
+            if not container_path.startswith('/') or update_type not in ("Created", "Modified", "Deleted"):
+                raise ValueError(f"无效的路径更新: {container_path} {update_type}")
+            library_paths[REMOTE_PATH_PREFIX + container_path] = update_type
+        updates[library_id] = library_paths
+    roots = {}
+    for library_id, library_roots in (payload.get("roots") or {}).items():
+        if not isinstance(library_roots, list) or not all(isinstance(root, str) for root in library_roots):
+            raise TypeError(f"媒体库 {library_id} 的根目录必须是字符串列表")
+        roots[str(library_id)] = library_roots
+    changes = ChangeAggregate.from_groups(payload.get("changes") or [])
+
+    now = time.time()
+    path_count = 0
+    with log_lock:
+        for library_id, paths in updates.items():
+            scan_requests.add(library_id)
+            if library_id != FULL_SCAN_MARKER:
+                scan_paths[library_id].update(paths)
+                if change_journal:
+                    for path, update_type in paths.items():
+                        change_journal.record(path, library_id, update_type)
+                path_count += len(paths)
+            scan_scheduler.note_change(library_id, now)
+        for library_id, library_roots in roots.items():
+            agent_library_roots[library_id].update(library_roots)
+        if changes:
+            file_changes.merge(changes)
+            notification_queue.merge(changes)
+    return path_count, changes.total
+
+class AggregatorRequestHandler(BaseHTTPRequestHandler):
+    """汇总端接收代理转发变动的接口: POST /api/changes"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if self.path.split('?')[0] != "/api/changes":
+            self.send_error(404)
+            return
+        token = self.headers.get('X-EmbyFMB-Token') or ""
+        if not CLUSTER_TOKEN or not hmac.compare_digest(token.encode(), CLUSTER_TOKEN.encode()):
+            self.send_error(403)
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            payload = json.loads(self.rfile.read(length))
+            path_count, change_count = receive_agent_changes(payload)
+        except (ValueError, TypeError, AttributeError) as e:
+            logger.warning(f"⚠️ 无法解析代理转发的变动: {e}")
+            self.send_error(400)
+            return
+        self.send_response(204)
+        self.end_headers()
+        agent = payload.get("agent") or self.client_address[0]
+        if path_count or "updates" in payload:
+            logger.info(f"🟠 收到代理【{agent}】转发的扫描请求，共 {path_count} 个路径更新")
+        if change_count:
+            logger.info(f"🟠 收到代理【{agent}】转发的 {change_count} 个文件变动")
+
+def start_aggregator_server():
+    """在后台线程中启动汇总端接口"""
+    server = ThreadingHTTPServer((AGGREGATOR_BIND_ADDRESS, AGGREGATOR_PORT), AggregatorRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="Aggregator", daemon=True).start()
+    logger.info(f"🟢 汇总端已启动，正在接收代理转发的变动: http://{AGGREGATOR_BIND_ADDRESS}:{AGGREGATOR_PORT}/api/changes")
+    return server
+
+class ConfigReloader:
+    """
+    从外部 JSON 配置文件加载配置，收到 SIGHUP 或文件被修改时重新加载。
+    RELOADABLE_CONFIG_NAMES 中的配置项直接替换模块中的值，其余配置项的修改只提示需要重启。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._defaults = {name: globals()[name] for name in CONFIG_NAMES}
+        self.values = dict(self._defaults)  # 当前生效的配置（默认值 + 配置文件）
+        self.overridden = set()  # 配置文件中设置的配置项
+        self._signature = None
+        self._on_reload = None
+        self._reload_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _file_signature(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _coerce(self, name, value):
+        """按默认值的类型转换配置文件中的值，类型不符时返回 (False, None)"""
+        default = self._defaults[name]
+        if isinstance(default, tuple) and isinstance(value, list):
+            return True, tuple(value)
+        if isinstance(default, bool) or isinstance(value, bool):
+            return isinstance(default, bool) and isinstance(value, bool), value
+        if isinstance(default, (int, float)) and isinstance(value, (int, float)):
+            return value >= CONFIG_MINIMUMS.get(name, value), value
+        return isinstance(value, type(default)), value
+
+    def read(self):
+        """读取配置文件，返回 {配置项: 值}；文件不存在时返回空字典，格式错误时返回 None"""
+        self._signature = self._file_signature()
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.error(f"🔴 配置文件读取失败: {e}")
+            return None
+        if not isinstance(data, dict):
+            logger.error("🔴 配置文件格式错误，最外层应为 JSON 对象")
+            return None
+        overrides = {}
+        for name, value in data.items():
+            if name not in CONFIG_NAMES:
+                logger.warning(f"⚠️ 配置文件中的未知配置项 {name} 已忽略")
+                continue
+            ok, value = self._coerce(name, value)
+            if not ok and name in CONFIG_MINIMUMS:
+                logger.warning(f"⚠️ 配置项 {name} 应为不小于 {CONFIG_MINIMUMS[name]} 的数字，已忽略")
+                continue
+            if not ok:
+                logger.warning(f"⚠️ 配置项 {name} 的类型应为 {type(self._defaults[name]).__name__}，已忽略")
+                continue
+            overrides[name] = value
+        return overrides
+
+    def load(self):
+        """启动时加载配置文件，返回被覆盖的配置项集合"""
+        if not self.path:
+            return set()
+        overrides = self.read()
+        if not overrides:
+            return set()
+        for name, value in overrides.items():
+            globals()[name] = value
+        self.values.update(overrides)
+        self.overridden = set(overrides)
+        return self.overridden
+
+    def reload(self):
+        """重新加载配置文件，立即生效的配置项直接替换，返回已替换的配置项集合"""
+        overrides = self.read()
+        if overrides is None:
+            logger.error("🔴 配置文件有误，继续使用当前配置")
+            return set()
+        values = dict(self._defaults)
+        values.update(overrides)
+        applied, restart = set(), set()
+        for name in CONFIG_NAMES:
+            if values[name] == self.values[name]:
+                continue
+            toggled = name in RESTART_ON_TOGGLE_CONFIG_NAMES and (values[name] > 0) != (self.values[name] > 0)
+            if name in RELOADABLE_CONFIG_NAMES and not toggled:
+                globals()[name] = values[name]
+                self.values[name] = values[name]
+                applied.add(name)
+            else:
+                restart.add(name)
+        self.overridden = set(overrides)
+        if applied:
+            logger.info(f"🟢 配置已重新加载，已生效: {', '.join(sorted(applied))}")
+        if restart:
+            logger.warning(f"⚠️ 以下配置项需要重启后生效: {', '.join(sorted(restart))}")
+        if not applied and not restart:
+            logger.info("🟢 配置文件已重新加载，没有变化")
+        if applied and self._on_reload:
+            self._on_reload(applied)
+        return applied
+
+    def request_reload(self, *args):
+        """请求重新加载（可直接用作 SIGHUP 信号处理函数）"""
+        self._reload_event.set()
+
+    def _run(self):
+        interval = CONFIG_CHECK_INTERVAL_SECONDS or None
+        while True:
+            requested = self._reload_event.wait(interval)
+            if self._stop_event.is_set():
+                return
+            self._reload_event.clear()
+            if requested:
+                logger.info("🟣 收到重新加载配置的请求")
+            elif self._file_signature() == self._signature:
+                continue
+            try:
+                self.reload()
+            except Exception as e:
+                logger.error(f"🔴 重新加载配置时发生错误: {e}")
+                logger.error(traceback.format_exc())
+
+    def start(self, on_reload=None):
+        """
+        启动后台线程
+        :param on_reload: 配置重新加载后的回调，参数为已替换的配置项集合
+        """
+        self._on_reload = on_reload
+        self._signature = self._file_signature()
+        self._thread = threading.Thread(target=self._run, name="ConfigReloader", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._reload_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+config_reloader = ConfigReloader(CONFIG_FILE_PATH)
+
+# 变化后需要重建路径过滤器 / 路径查询表的配置项
+PATH_FILTER_CONFIG_NAMES = frozenset({"VIDEO_EXTENSIONS", "IGNORED_DIR_NAMES", "INCLUDE_PATTERNS", "EXCLUDE_PATTERNS"})
+PATH_LOOKUP_CONFIG_NAMES = frozenset({"NAS_TO_CONTAINER_PATH_MAP", "MONITORED_FOLDERS_TO_LIBRARY_ID_MAP",
+                                      "LIBRARY_ID_TO_NAME", "LIBRARY_PATH_REWRITE_RULES"})
+
+def apply_config_changes(changed, library_discovery=None):
+    """
+    根据变化的配置项重建路径过滤器和路径查询表，新的对象整体替换旧对象，已在队列中的变动不受影响
+    :return: 路径查询表是否被替换
+    """
+    global path_filter, path_lookup
+    if changed & PATH_FILTER_CONFIG_NAMES:
+        old_filter = path_filter
+        path_filter = PathFilter(IGNORED_DIR_NAMES, INCLUDE_PATTERNS, EXCLUDE_PATTERNS, VIDEO_EXTENSIONS)
+        # 保留本统计周期内的忽略计数
+        for reason, count in old_filter.snapshot(reset=True).items():
+            path_filter._counts[reason] += count
+    if not changed & PATH_LOOKUP_CONFIG_NAMES:
+        return False
+    if library_discovery:
+        library_discovery.configure()
+        library_discovery.apply()
+    else:
+        path_lookup = PathLookup(MONITORED_FOLDERS_TO_LIBRARY_ID_MAP, NAS_TO_CONTAINER_PATH_MAP)
+    return True
+
+# 多个线程（配置重新加载、媒体库自动发现）都可能调整监控
+watch_lock = threading.Lock()
+
+def reschedule_watches(observer, event_handler, watches, lookup):
+    """
+    按路径查询表调整监控：为新增的根目录添加监控，移除不再配置的根目录的监控，其余监控保持不动。
+    轮询目录和已被其他根目录包含的子目录不单独监控。
+    :param watches: 根目录 -> ObservedWatch，原地更新
+    """
+    with watch_lock:
+        wanted = []
+        for path in sorted(lookup.folders):
+            if path in POLLING_FOLDERS:
+                continue
+            if any(path.startswith(root.rstrip('/') + '/') for root in wanted):
+                continue
+            wanted.append(path)
+        for path in [path for path in watches if path not in wanted]:
+            observer.unschedule(watches.pop(path))
+            logger.info(f"⚪️ 已停止监控: {path}")
+        for path in wanted:
+            if path in watches:
+                continue
+            if not os.path.isdir(path):
+                logger.error("⚠️ 配置的路径不存在或不是目录")
+                logger.error(f"⚠️ 路径: {path}")
+                continue
+            try:
+                watches[path] = observer.schedule(event_handler, path, recursive=True)
+            except OSError as e:
+                # 运行中添加监控时才会遍历目录树，失败（如超出 max_user_instances）时保留其余监控
+                logger.error(f"🔴 无法监控 {path}: {e}")
+                continue
+            if observer.is_alive():
+                logger.info(f"🟢 已开始监控: {path}")
+    return watches
+
+# 单实例锁文件，在 main() 前检查
 LOCK_FILE = "/tmp/EmbyFMB.lock"
-if not single_instance_lock(LOCK_FILE):
-    logger.error("🔴 另一个实例正在运行，退出")
-    sys.exit(1)
 
 def main():
     """主函数"""
-    global notification_thread_running
+    global notification_thread_running, change_journal
     
     try:
+        startup_time = phase_time = time.monotonic()
+        startup_phases = []
+
+        def end_phase(name):
+            nonlocal phase_time
+            now = time.monotonic()
+            startup_phases.append(f"{name} {now - phase_time:.2f} 秒")
+            phase_time = now
+
         logger.info("🔸🔸🔸🔸🔸EmbyFMB🔸🔸🔸🔸🔸")
         logger.info("⚠️ 正在启动EmbyFMB监测系统")
-        logger.info(f"⚠️ 当前设置 {SCAN_INTERVAL_SECONDS} 秒为一循环周期。")
-        logger.info("⚠️ 非视频文件变动将被忽略并记录")
+        if SCAN_DEBOUNCE_SECONDS > 0:
+            logger.info(f"⚠️ 自适应扫描: 媒体库最后一次变动 {SCAN_DEBOUNCE_SECONDS} 秒后扫描，"
+                        f"最长等待 {SCAN_MAX_LATENCY_SECONDS} 秒，同一媒体库最小间隔 {SCAN_MIN_INTERVAL_SECONDS} 秒。")
+        else:
+            logger.info(f"⚠️ 当前设置 {SCAN_INTERVAL_SECONDS} 秒为一循环周期。")
+        logger.info("⚠️ 非视频文件变动将被忽略并计数")
+        logger.info(f"⚠️ 忽略的目录: {', '.join(IGNORED_DIR_NAMES)}")
         logger.info("⚠️ 视频文件变动会发送 TG BOT 通知")
         logger.info(f"⚠️ TG BOT 通知延迟时间: {NOTIFICATION_WINDOW_SECONDS} 秒")
+        if EMBY_UPDATE_MODE == "path":
+            logger.info(f"⚠️ Emby 更新模式: 路径精确更新（每批最多 {PATH_UPDATE_CHUNK_SIZE} 个路径）")
+        else:
+            logger.info("⚠️ Emby 更新模式: 媒体库扫描")
+        for name, minimum in CONFIG_MINIMUMS.items():
+            if globals()[name] < minimum:
+                logger.error(f"🔴 配置项 {name} 不能小于 {minimum}，当前为 {globals()[name]}")
+                logger.error("🔴 脚本将退出")
+                sys.exit(1)
+        if CLUSTER_MODE in ("agent", "aggregator") and not CLUSTER_TOKEN:
+            logger.error(f"🔴 {CLUSTER_MODE} 模式必须设置 CLUSTER_TOKEN，否则局域网内任何主机都可以向汇总端发送删除更新")
+            logger.error("🔴 脚本将退出")
+            sys.exit(1)
+        if CLUSTER_MODE == "agent":
+            logger.info(f"⚠️ 代理模式【{agent_name()}】: 变动转发到汇总端 {AGGREGATOR_URL}，由汇总端扫描和通知")
+        elif CLUSTER_MODE == "aggregator":
+            logger.info("⚠️ 汇总端模式: 接收各代理转发的变动，统一调度扫描和发送通知")
+
+        # 配置文件已在初始化日志前加载，这里按其中的配置重建路径过滤器和路径查询表
+        if config_reloader.overridden:
+            logger.info(f"🟢 已加载配置文件 {CONFIG_FILE_PATH}，覆盖 {len(config_reloader.overridden)} 个配置项")
+            apply_config_changes(config_reloader.overridden)
+            create_emby_clients()
+
+        event_handler = VideoChangeHandler()
+        observer = create_observer()
+        watches = {}
+
+        # 从 Emby 自动发现媒体库，后台刷新时按新的映射调整监控
+        library_discovery = None
+        if EMBY_LIBRARY_DISCOVERY:
+            def on_libraries_changed(old_lookup, lookup):
+                # 启动阶段由下方统一添加监控
+                if observer.is_alive():
+                    reschedule_watches(observer, event_handler, watches, lookup)
+
+            library_discovery = LibraryDiscovery(on_update=on_libraries_changed)
+            library_discovery.load()
+
         logger.info("⚠️ 正在监控以下文件夹和媒体库:")
-        for path in MONITORED_FOLDERS_TO_LIBRARY_ID_MAP.keys():
+        for path, library_id in path_lookup.folders.items():
             # 获取媒体库名称
-            library_id = MONITORED_FOLDERS_TO_LIBRARY_ID_MAP[path]
             library_name = LIBRARY_ID_TO_NAME.get(library_id, f"未知({library_id})")
             logger.info(f"📂 - {path}")
             logger.info(f"└ 🎞️ - {library_name}媒体库")
+        end_phase("加载配置和媒体库")
 
-        event_handler = VideoChangeHandler()
-        observer = Observer()
+        # 打开变动日志，恢复上次未完成的扫描请求
+        reconcile_since = None
+        if JOURNAL_PATH:
+            change_journal = ChangeJournal(JOURNAL_PATH)
+            if change_journal.clean_shutdown():
+                logger.info("🟢 上次为正常退出，跳过停机期间的变动检查")
+            else:
+                reconcile_since = change_journal.last_heartbeat()
+            replay_journal()
+            change_journal.start()
+            end_phase("恢复变动日志")
 
-        for path in MONITORED_FOLDERS_TO_LIBRARY_ID_MAP.keys():
+        polling_roots = []
+        for path in path_lookup.folders:
+            if path not in POLLING_FOLDERS:
+                continue
             if not os.path.isdir(path):
                 logger.error("⚠️ 配置的路径不存在或不是目录")
                 logger.error(f"⚠️ 路径: {path}")
                 continue
-            observer.schedule(event_handler, path, recursive=True)
+            polling_roots.append(path)
+        reschedule_watches(observer, event_handler, watches, path_lookup)
 
         logger.info("🔸🔸🔸🔸🔸详细日志🔸🔸🔸🔸🔸")
         observer.start()
+        end_phase(f"添加 {len(watches)} 个目录的监控")
         logger.info("🟢 服务已启动，正在监听指定文件夹")
+
+        # 网络挂载点、无法添加监控的根目录和超出 inotify 监控预算的子树使用增量快照轮询
+        if Inotify is not None:
+            logger.info(f"🟢 inotify 监控目录数: {FilteredInotify.watch_count}（预算 {FilteredInotify.watch_budget}，"
+                        f"内核上限 {inotify_watch_limit() or '未知'}），跳过忽略目录: {FilteredInotify.skipped_count}")
+            for path in observer.failed_watches:
+                watches.pop(path, None)
+                polling_roots.append(path)
+            if FilteredInotify.cold_dirs:
+                logger.warning(f"⚠️ {len(FilteredInotify.cold_dirs)} 个目录超出 inotify 监控预算，改为轮询，"
+                               f"可调大 INOTIFY_WATCH_BUDGET 或内核参数 fs.inotify.max_user_watches")
+                polling_roots.extend(sorted(FilteredInotify.cold_dirs))
+        poller = None
+        if polling_roots:
+            poller = SnapshotPoller(event_handler, polling_roots)
+
+        # 启动文件稳定检测线程
+        if event_handler.coalescer is not None:
+            event_handler.coalescer.start()
+            logger.info(f"🟢 文件稳定检测已启动，文件稳定 {FILE_STABLE_SECONDS} 秒后加入队列")
+        event_handler.directory_scanner.start()
+
+        if poller:
+            poller.start()
+            logger.info(f"🟢 轮询监控已启动，每 {POLLING_INTERVAL_SECONDS} 秒检查 {len(polling_roots)} 个目录")
+
+        if Inotify is not None:
+            # 运行中新建的目录超出预算时同样改为轮询，需要时才创建轮询线程
+            poller_lock = threading.Lock()
+
+            def poll_cold_dir(path):
+                nonlocal poller
+                with poller_lock:
+                    if poller is None:
+                        poller = SnapshotPoller(event_handler, [])
+                    poller.add_root(path)
+                logger.info(f"🟠 超出 inotify 监控预算，改为轮询: {path}")
+
+            def forget_cold_dir(path):
+                with poller_lock:
+                    if poller is not None:
+                        poller.remove_root(path)
+                logger.info(f"⚪️ 目录已删除或移走，停止轮询: {path}")
+
+            FilteredInotify.on_cold_dir = poll_cold_dir
+            FilteredInotify.on_cold_dir_removed = forget_cold_dir
+            with FilteredInotify._lock:
+                missed = FilteredInotify.cold_dirs.difference(polling_roots)
+            for path in missed:
+                poll_cold_dir(path)
+
+        if library_discovery:
+            library_discovery.start()
+
+        # 配置重新加载：映射表变化时只调整受影响的监控
+        if CONFIG_FILE_PATH:
+            def on_config_reloaded(changed):
+                if apply_config_changes(changed, library_discovery):
+                    reschedule_watches(observer, event_handler, watches, path_lookup)
+
+            config_reloader.start(on_reload=on_config_reloaded)
+            signal.signal(signal.SIGHUP, config_reloader.request_reload)
+            logger.info(f"🟢 配置文件: {CONFIG_FILE_PATH}（发送 SIGHUP 或修改文件后自动重新加载）")
+
+        if METRICS_PORT:
+            try:
+                start_metrics_server(observer, event_handler, poller)
+            except OSError as e:
+                logger.error(f"🔴 监控指标接口启动失败: {e}")
+
+        if CLUSTER_MODE == "aggregator":
+            # 汇总端接口启动失败时无法接收代理的变动，直接退出
+            start_aggregator_server()
+
+        # 在后台检查停机期间发生变动的目录（轮询目录由其自身的索引处理）
+        if reconcile_since is not None:
+            watched_roots = list(watches)
+            logger.info(f"🟣 正在检查 {time.strftime('%m-%d %H:%M:%S', time.localtime(reconcile_since))} 之后的文件变动")
+            threading.Thread(target=reconcile_changes_since, name="Reconcile", daemon=True,
+                             args=(reconcile_since - ChangeJournal.HEARTBEAT_SECONDS, watched_roots,
+                                   event_handler._is_video_file)).start()
         
         # 启动通知工作线程
         notification_thread = threading.Thread(target=notification_worker)
         notification_thread.daemon = True
         notification_thread.start()
         logger.info("🟢 通知工作线程已启动")
+        end_phase("启动后台线程")
+        logger.info(f"📊 启动耗时: {'，'.join(startup_phases)}，共 {time.monotonic() - startup_time:.2f} 秒")
 
         try:
-            while True:
-                time.sleep(SCAN_INTERVAL_SECONDS)
-                
-                with log_lock:
-                    if not scan_requests and not file_changes:
-                        logger.info("⚪️ 此周期内未监测到视频文件变动。")
-                        continue
-
-                    # 处理扫描请求
-                    if scan_requests:
-                        # 获取媒体库名称列表
-                        lib_names = []
-                        for lib_id in scan_requests:
-                            if lib_id == FULL_SCAN_MARKER:
-                                lib_names.append("全库扫描")
-                            else:
-                                lib_name = LIBRARY_ID_TO_NAME.get(lib_id, f"未知({lib_id})")
-                                lib_names.append(lib_name)
-                        
-                        logger.info("🟠 检测到有文件变动")
-                        logger.info(f"🟠 待扫描处理媒体库:【{', '.join(lib_names)}】")
-
-                        # 优先级判断：如果全库扫描在请求中，则只执行全库扫描
-                        if FULL_SCAN_MARKER in scan_requests:
-                            logger.info("🟣 检测到【全部媒体库】扫描请求")
-                            logger.info("🟣 将优先执行并忽略其他扫描。")
-                            trigger_emby_scan()
-                        else:
-                            logger.info("🟣 正在对【特定媒体库】发送扫描请求")
-                            for library_id in list(scan_requests):
-                                trigger_emby_scan(library_id)
-                        
-                        # 扫描完成后发送汇总通知
-                        message = "🎬 Emby 服务器操作记录\n\n"
-                        if FULL_SCAN_MARKER in scan_requests:
-                            message += "🟢 已触发【全部媒体库】扫描\n"
-                        elif scan_requests:
-                            for library_id in scan_requests:
-                                library_name = LIBRARY_ID_TO_NAME.get(library_id, f"未知({library_id})")
-                                message += f"🟢 【{library_name}媒体库】已完成刷新\n"
-                        else:
-                            message += "⚪️ 未触发刷新扫描（仅记录变动）\n"
-                        
-                        send_telegram_notification(message)
-                    
-                    # 清空本次周期的请求和变动记录
-                    scan_requests.clear()
-                    file_changes.clear()
-                    logger.info("🟢 扫描队列和变动记录已清空")
-                    logger.info("🟢 继续进行下一个扫描周期...")
+            run_scan_loop()
 
         except KeyboardInterrupt:
             logger.warning("🔴 接收到停止信号，正在关闭脚本...")
@@ -502,8 +3905,20 @@ def main():
         finally:
             # 停止通知线程
             notification_thread_running = False
+            telegram_sender.stop()
             observer.stop()
             observer.join()
+            if poller:
+                poller.stop()
+            if event_handler.coalescer is not None:
+                event_handler.coalescer.stop()
+            event_handler.directory_scanner.stop()
+            if library_discovery:
+                library_discovery.stop()
+            if CONFIG_FILE_PATH:
+                config_reloader.stop()
+            if change_journal:
+                change_journal.stop()
             logger.info("🔴 文件监测系统已停止。脚本已关闭。")
     
     except Exception as e:
@@ -514,6 +3929,21 @@ def main():
         sys.exit(1)
 
 if __name__ == "__main__":
+    # 先加载外部配置文件，日志相关的配置项也可以写在配置文件中
+    config_reloader.load()
+
+    # 初始化日志（仅在直接运行脚本时配置，便于基准测试等脚本导入本模块）
+    try:
+        setup_logging()
+        logger.info("🟢 日志系统初始化成功")
+    except Exception as e:
+        print(f"🔴 日志系统初始化失败: {str(e)}")
+        sys.exit(1)
+
+    if not single_instance_lock(LOCK_FILE):
+        logger.error("🔴 另一个实例正在运行，退出")
+        sys.exit(1)
+
     try:
         main()
     except Exception as e:
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 变动汇总内存基准测试
+# 模拟大批量导入时的文件事件，对比旧版“每个事件一个字典追加到列表”与 ChangeAggregate 的内存峰值、
+# 写入耗时和构建通知消息的耗时。
+# 用法: python3 benchmarks/bench_change_store.py --events 1000000
+
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import EmbyFMB  # noqa: E402
+
+EVENT_TYPES = ("创建", "创建", "创建", "移动(目标)", "删除")
+
+
+def generate_events(count, libraries):
+    """生成 (变动类型, 媒体库ID, 路径)，路径每次新建，与真实事件一样各不相同"""
+    for i in range(count):
+        library_id = libraries[i % len(libraries)]
+        yield (EVENT_TYPES[i % len(EVENT_TYPES)], library_id,
+               f"/volume1/Video/媒体库{library_id}/剧集{i // 1000}/Season 1/剧集{i // 1000} S01E{i % 1000:03d}.mkv")
+
+
+def legacy_message(changes):
+    """旧版实现：每次发送前在列表上重新分组"""
+    grouped = defaultdict(lambda: defaultdict(list))
+    for change in changes:
+        grouped[change['event_type']][change['library_id']].append(os.path.basename(change['path']))
+    return sum(len(filenames) for libraries in grouped.values() for filenames in libraries.values())
+
+
+def measure(label, store, add, build, events):
+    tracemalloc.start()
+    start = time.perf_counter()
+    for event in events:
+        add(store, event)
+    add_seconds = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    start = time.perf_counter()
+    build(store)
+    build_seconds = time.perf_counter() - start
+    print(f"[{label}] 内存占用: {current / 1024 / 1024:.1f} MB (峰值 {peak / 1024 / 1024:.1f} MB)")
+    print(f"[{label}] 写入耗时: {add_seconds:.2f} 秒, 构建通知耗时: {build_seconds * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="变动汇总内存基准测试")
+    parser.add_argument("--events", type=int, default=1000000, help="模拟的事件数量")
+    parser.add_argument("--libraries", type=int, default=4, help="媒体库数量")
+    args = parser.parse_args()
+    libraries = [str(i) for i in range(args.libraries)]
+
+    def legacy_add(store, event):
+        event_type, library_id, path = event
+        store.append({"path": path, "event_type": event_type, "library_id": library_id})
+
+    measure("legacy", [], legacy_add, legacy_message, generate_events(args.events, libraries))
+
+    aggregate = EmbyFMB.ChangeAggregate()
+    measure("aggregate", aggregate, lambda store, event: store.add(*event), EmbyFMB.build_notification_message,
+            generate_events(args.events, libraries))
+    print(f"[aggregate] 汇总事件数: {aggregate.total}, 丢弃的文件名样本: {aggregate.dropped}")
+
+
+if __name__ == "__main__":
+    main()
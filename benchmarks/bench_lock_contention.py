@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 全局锁竞争基准测试
+# 多个线程持续产生文件事件，同时扫描周期向一个有延迟的本地 Emby 桩服务发送请求。
+# 对比旧版（持锁发送网络请求）与当前实现（锁外发送）的锁持有时间和事件处理延迟。
+# 用法: python3 benchmarks/bench_lock_contention.py --latency 0.5 --duration 5
+
+import os
+import sys
+import time
+import argparse
+import threading
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import EmbyFMB  # noqa: E402
+from stub_server import StubServer  # noqa: E402
+
+
+def legacy_cycle():
+    """旧版实现：在持有全局锁期间发送 Emby 请求"""
+    with EmbyFMB.log_lock:
+        if EmbyFMB.scan_requests:
+            EmbyFMB.dispatch_scan_requests(set(EmbyFMB.scan_requests), EmbyFMB.scan_paths)
+        EmbyFMB.scan_requests.clear()
+        EmbyFMB.scan_paths.clear()
+        EmbyFMB.file_changes = EmbyFMB.ChangeAggregate(sample_size=0)
+        EmbyFMB.notification_queue = EmbyFMB.ChangeAggregate()
+
+
+def current_cycle():
+    """当前实现：锁内交换队列，锁外发送请求"""
+    EmbyFMB.process_scan_cycle()
+    with EmbyFMB.log_lock:
+        EmbyFMB.notification_queue = EmbyFMB.ChangeAggregate()
+
+
+def reset_state():
+    EmbyFMB.scan_requests = set()
+    EmbyFMB.scan_paths = defaultdict(dict)
+    EmbyFMB.file_changes = EmbyFMB.ChangeAggregate(sample_size=0)
+    EmbyFMB.notification_queue = EmbyFMB.ChangeAggregate()
+    EmbyFMB.log_lock.wait_stats.snapshot(reset=True)
+    EmbyFMB.log_lock.hold_stats.snapshot(reset=True)
+    EmbyFMB.handler_latency.snapshot(reset=True)
+
+
+def run(mode, producers, duration, cycle_interval):
+    reset_state()
+    cycle = legacy_cycle if mode == "legacy" else current_cycle
+    handler = EmbyFMB.VideoChangeHandler()
+    roots = list(EmbyFMB.MONITORED_FOLDERS_TO_LIBRARY_ID_MAP)
+    stop = threading.Event()
+
+    def produce(worker_id):
+        i = 0
+        while not stop.is_set():
+            root = roots[i % len(roots)]
+            handler._queue_scan_request(f"{root}/bench{worker_id}/第{i}集.mkv", "创建")
+            i += 1
+
+    def cycles():
+        while not stop.wait(cycle_interval):
+            cycle()
+
+    threads = [threading.Thread(target=produce, args=(n,)) for n in range(producers)]
+    threads.append(threading.Thread(target=cycles))
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    events, event_avg, event_max = EmbyFMB.handler_latency.snapshot()
+    _, hold_avg, hold_max = EmbyFMB.log_lock.hold_stats.snapshot()
+    _, wait_avg, wait_max = EmbyFMB.log_lock.wait_stats.snapshot()
+    print(f"[{mode}] 事件数: {events} ({events / duration:.0f} 次/秒)")
+    print(f"[{mode}] 事件处理延迟: 平均 {event_avg * 1000:.3f} ms, 最大 {event_max * 1000:.1f} ms")
+    print(f"[{mode}] 锁等待: 平均 {wait_avg * 1000:.3f} ms, 最大 {wait_max * 1000:.1f} ms")
+    print(f"[{mode}] 锁持有: 平均 {hold_avg * 1000:.3f} ms, 最大 {hold_max * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="全局锁竞争基准测试")
+    parser.add_argument("--latency", type=float, default=0.5, help="Emby 桩服务响应延迟（秒）")
+    parser.add_argument("--duration", type=float, default=5.0, help="每种模式的运行时长（秒）")
+    parser.add_argument("--producers", type=int, default=4, help="产生事件的线程数")
+    parser.add_argument("--cycle-interval", type=float, default=1.0, help="扫描周期间隔（秒）")
+    args = parser.parse_args()
+
+    stub = StubServer(latency=args.latency).start()
+    EmbyFMB.EMBY_SERVER_URL = stub.url
+    EmbyFMB.TELEGRAM_BOT_TOKEN = ""
+    try:
+        for mode in ("legacy", "current"):
+            run(mode, args.producers, args.duration, args.cycle_interval)
+    finally:
+        stub.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 路径前缀索引微基准测试
+# 对比旧版“每次事件按长度排序 + 线性 startswith 扫描”与 PathPrefixIndex 的查询耗时。
+# 用法: python3 benchmarks/bench_path_index.py --roots 20000 --paths 100000
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import EmbyFMB  # noqa: E402
+
+
+def build_roots(count, rng):
+    """生成指定数量的媒体库根目录及其媒体库ID"""
+    roots = {}
+    for i in range(count):
+        volume = rng.randint(1, 8)
+        roots[f"/volume{volume}/Video/分类{i % 97}/媒体库{i}"] = str(i % 500)
+    return roots
+
+
+def build_paths(roots, count, rng):
+    """在随机根目录下生成合成的视频文件路径，其中一部分是未配置的同名前缀目录"""
+    root_list = list(roots)
+    paths = []
+    for i in range(count):
+        root = rng.choice(root_list)
+        if i % 10 == 0:
+            # 同名前缀目录（如 电影 与 电影2），不应匹配到任何媒体库
+            root = root + "2"
+        depth = rng.randint(1, 4)
+        subdirs = "/".join(f"季{rng.randint(1, 20)}" for _ in range(depth))
+        paths.append(f"{root}/{subdirs}/第{i}集.mkv")
+    return paths
+
+
+def legacy_lookup(mapping, path):
+    """旧版实现：每次事件重新排序并线性匹配"""
+    for folder_path in sorted(mapping.keys(), key=len, reverse=True):
+        if path.startswith(folder_path):
+            return mapping[folder_path]
+    return None
+
+
+def run(root_count, path_count, legacy_sample, seed):
+    rng = random.Random(seed)
+    roots = build_roots(root_count, rng)
+    paths = build_paths(roots, path_count, rng)
+
+    start = time.perf_counter()
+    index = EmbyFMB.PathPrefixIndex(roots)
+    build_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matched = 0
+    for path in paths:
+        if index.longest_match(path)[1] is not None:
+            matched += 1
+    index_seconds = time.perf_counter() - start
+
+    # 旧版实现非常慢，只取样本估算
+    sample = paths[:legacy_sample]
+    start = time.perf_counter()
+    legacy_mismatches = 0
+    for path in sample:
+        if legacy_lookup(roots, path) != index.longest_match(path)[1]:
+            legacy_mismatches += 1
+    legacy_seconds = time.perf_counter() - start
+
+    index_us = index_seconds / len(paths) * 1e6
+    legacy_us = legacy_seconds / max(len(sample), 1) * 1e6
+    print(f"根目录数量: {len(index)}")
+    print(f"索引构建耗时: {build_seconds * 1000:.1f} ms")
+    print(f"索引查询: {len(paths)} 条路径, 平均 {index_us:.2f} µs/次, 命中 {matched}")
+    print(f"旧版查询: {len(sample)} 条样本, 平均 {legacy_us:.2f} µs/次")
+    print(f"加速比: {legacy_us / index_us:.0f}x")
+    print(f"旧版同名前缀误匹配: {legacy_mismatches} / {len(sample)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PathPrefixIndex 微基准测试")
+    parser.add_argument("--roots", type=int, default=20000, help="配置的根目录数量")
+    parser.add_argument("--paths", type=int, default=100000, help="查询的合成路径数量")
+    parser.add_argument("--legacy-sample", type=int, default=200, help="旧版实现的采样数量")
+    parser.add_argument("--seed", type=int, default=42, help="随机数种子")
+    args = parser.parse_args()
+    run(args.roots, args.paths, args.legacy_sample, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 增量快照轮询基准测试
+# 在临时目录中生成大量文件，测量建立基线、无变动轮询和少量变动轮询的耗时。
+# 用法: python3 benchmarks/bench_snapshot_poller.py --files 500000 --per-dir 50
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import EmbyFMB  # noqa: E402
+from watchdog.events import FileSystemEventHandler  # noqa: E402
+
+
+class CountingHandler(FileSystemEventHandler):
+    """统计收到的事件类型"""
+
+    def __init__(self):
+        super().__init__()
+        self.counts = Counter()
+
+    def on_any_event(self, event):
+        self.counts[event.event_type] += 1
+
+
+def build_tree(root, files, per_dir):
+    """生成 剧集/季/文件 三层目录结构"""
+    created = 0
+    show = 0
+    while created < files:
+        for season in range(10):
+            directory = os.path.join(root, f"剧集{show}", f"Season {season}")
+            os.makedirs(directory, exist_ok=True)
+            for episode in range(min(per_dir, files - created)):
+                open(os.path.join(directory, f"E{episode:03d}.mkv"), 'w').close()
+                created += 1
+            if created >= files:
+                break
+        show += 1
+    return show
+
+
+def timed_poll(poller, label):
+    start = time.perf_counter()
+    checked = poller.poll_once()
+    seconds = time.perf_counter() - start
+    print(f"{label}: 检查 {checked} 个目录, 耗时 {seconds:.2f} 秒")
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="增量快照轮询基准测试")
+    parser.add_argument("--files", type=int, default=500000, help="生成的文件数量")
+    parser.add_argument("--per-dir", type=int, default=50, help="每个目录中的文件数量")
+    parser.add_argument("--workers", type=int, default=8, help="并行列目录的线程数")
+    parser.add_argument("--budget", type=float, default=30.0, help="单次轮询时间预算（秒）")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="embyfmb_poll_")
+    root = os.path.join(workdir, "电视剧")
+    try:
+        start = time.perf_counter()
+        shows = build_tree(root, args.files, args.per_dir)
+        print(f"生成 {args.files} 个文件（{shows} 部剧集），耗时 {time.perf_counter() - start:.1f} 秒")
+
+        EmbyFMB.POLLING_WORKERS = args.workers
+        EmbyFMB.POLLING_BUDGET_SECONDS = args.budget
+        EmbyFMB.POLLING_INDEX_PATH = os.path.join(workdir, "index.json")
+        handler = CountingHandler()
+        poller = EmbyFMB.SnapshotPoller(handler, [root])
+        poller.load_index()
+
+        timed_poll(poller, "建立基线")
+        while poller._resume:
+            timed_poll(poller, "继续建立基线")
+        timed_poll(poller, "无变动轮询")
+
+        # 少量变动：新增一集、重命名一集、删除一集、移入一个新季
+        time.sleep(0.01)
+        open(os.path.join(root, "剧集0", "Season 0", "新增.mkv"), 'w').close()
+        os.rename(os.path.join(root, "剧集1", "Season 0", "E000.mkv"),
+                  os.path.join(root, "剧集1", "Season 0", "E000.renamed.mkv"))
+        os.remove(os.path.join(root, "剧集2", "Season 0", "E000.mkv"))
+        new_season = os.path.join(root, "剧集3", "Season 99")
+        os.makedirs(new_season)
+        for episode in range(5):
+            open(os.path.join(new_season, f"E{episode:03d}.mkv"), 'w').close()
+        timed_poll(poller, "少量变动轮询")
+        print(f"事件统计: {dict(handler.counts)}")
+        print(f"索引文件大小: {os.path.getsize(EmbyFMB.POLLING_INDEX_PATH) / 1024 / 1024:.1f} MB")
+        poller.stop()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 端到端吞吐量和延迟基准测试
+# 在临时目录中生成文件系统负载（批量拷贝、重命名链、深层目录移入、临时文件抖动），
+# 通过真实的 watchdog Observer 和 VideoChangeHandler 处理，Emby 和 Telegram 由本地桩服务模拟。
+# 输出 JSON 格式的结果（事件处理速度、从文件变动到 Emby 收到更新的延迟、锁竞争、内存占用、inotify 监控数），
+# 便于跟踪性能回归。
+# 用法: python3 benchmarks/bench_suite.py --files 2000 --output result.json
+
+import os
+import sys
+import json
+import time
+import shutil
+import bisect
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import EmbyFMB  # noqa: E402
+from stub_server import StubServer  # noqa: E402
+
+LIBRARY_ID = "999"
+CONTAINER_ROOT = "/data/tv"
+
+
+class CountingHandler(EmbyFMB.VideoChangeHandler):
+    """统计 Observer 分发的事件数和分发时间"""
+
+    def __init__(self):
+        super().__init__()
+        self.events = 0
+        self.first_event = None
+        self.last_event = None
+
+    def dispatch(self, event):
+        now = time.perf_counter()
+        if self.first_event is None:
+            self.first_event = now
+        self.last_event = now
+        self.events += 1
+        super().dispatch(event)
+
+    def reset(self):
+        self.events = 0
+        self.first_event = self.last_event = None
+
+
+def write_file(path, size, chunk=64 * 1024):
+    """分块写入文件，模拟拷贝过程"""
+    data = b"\0" * min(size, chunk)
+    with open(path, "wb") as f:
+        written = 0
+        while written < size:
+            f.write(data[:size - written])
+            written += len(data)
+
+
+# --- 负载生成：返回 {NAS路径: 文件最终完成的时间}，期望 Emby 收到覆盖这些路径的更新 ---
+
+def workload_bulk_copy(base, staging, args):
+    """批量拷贝：逐个写入新文件，每 50 个文件一个季目录"""
+    expected = {}
+    for i in range(args.files):
+        directory = os.path.join(base, f"剧集{i // 500}", f"Season {i // 50 % 10 + 1}")
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"剧集{i // 500} E{i:05d}.mkv")
+        write_file(path, args.file_size)
+        expected[path] = time.time()
+    return expected
+
+
+def workload_rename_chain(base, staging, args):
+    """下载器重命名链：.part -> .!qb -> 最终文件名"""
+    expected = {}
+    os.makedirs(base, exist_ok=True)
+    for i in range(args.files):
+        path = os.path.join(base, f"电影{i:05d}.mkv")
+        write_file(path + ".part", args.file_size)
+        os.rename(path + ".part", path + ".!qb")
+        os.rename(path + ".!qb", path)
+        expected[path] = time.time()
+    return expected
+
+
+def workload_deep_tree(base, staging, args):
+    """深层目录：在监控范围外生成多层目录树，再整体移入"""
+    tree = os.path.join(staging, "合集")
+    files = []
+    for i in range(args.files):
+        parts = [f"层{level}-{(i >> level) % 4}" for level in range(args.depth)]
+        directory = os.path.join(tree, *parts)
+        os.makedirs(directory, exist_ok=True)
+        name = f"E{i:05d}.mkv"
+        write_file(os.path.join(directory, name), args.file_size)
+        files.append(os.path.join(*parts, name))
+    os.makedirs(base, exist_ok=True)
+    os.rename(tree, os.path.join(base, "合集"))
+    now = time.time()
+    return {os.path.join(base, "合集", relative): now for relative in files}
+
+
+def workload_temp_churn(base, staging, args):
+    """临时文件抖动：反复创建和删除临时文件、元数据文件和很快被删除的视频文件，不应触发任何 Emby 更新"""
+    os.makedirs(base, exist_ok=True)
+    suffixes = (".mkv.part", ".tmp", ".nfo", ".jpg", ".mkv")
+    for i in range(args.files):
+        path = os.path.join(base, f"临时{i:05d}{suffixes[i % len(suffixes)]}")
+        write_file(path, min(args.file_size, 4096))
+        os.remove(path)
+    return {}
+
+
+WORKLOADS = {
+    "bulk_copy": workload_bulk_copy,
+    "rename_chain": workload_rename_chain,
+    "deep_tree": workload_deep_tree,
+    "temp_churn": workload_temp_churn,
+}
+
+
+class CoverageTracker:
+    """根据桩服务收到的请求，计算每个期望路径第一次被 Emby 更新覆盖（路径本身或上级文件夹）的时间"""
+
+    def __init__(self, stub, expected):
+        self._stub = stub
+        self._expected = {EmbyFMB.path_lookup.to_container(path): done for path, done in expected.items()}
+        self._keys = sorted(self._expected)
+        self.covered = {}
+        self.unexpected = 0
+        self._seen = 0
+
+    def update(self, prefix):
+        requests = self._stub.received()
+        for received_at, path, body in requests[self._seen:]:
+            kind = StubServer.kind(path)
+            if kind == "refresh":
+                for key in self._keys:
+                    self.covered.setdefault(key, received_at)
+            if kind != "media_updated":
+                continue
+            for update in json.loads(body).get("Updates", []):
+                self._cover(update["Path"], received_at, prefix)
+        self._seen = len(requests)
+        return len(self.covered) >= len(self._keys)
+
+    def _cover(self, path, received_at, prefix):
+        matched = False
+        start = bisect.bisect_left(self._keys, path)
+        for key in self._keys[start:]:
+            if key != path and not key.startswith(path.rstrip("/") + "/"):
+                break
+            self.covered.setdefault(key, received_at)
+            matched = True
+        if path == CONTAINER_ROOT:
+            # 回退为媒体库根目录扫描
+            for key in self._keys:
+                self.covered.setdefault(key, received_at)
+            matched = True
+        if not matched and path.startswith(prefix):
+            self.unexpected += 1
+
+    def latencies(self):
+        return sorted(self.covered[key] - self._expected[key] for key in self.covered)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return round(values[min(int(len(values) * fraction), len(values) - 1)], 3)
+
+
+def rss_mb():
+    """当前常驻内存（MB）"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def wait_idle(handler, observer, timeout):
+    """等待事件队列、稳定检测、文件夹遍历和扫描队列全部清空"""
+    deadline = time.time() + timeout
+    while True:
+        with EmbyFMB.log_lock:
+            pending = len(EmbyFMB.scan_requests)
+        if (not pending and observer.event_queue.empty() and not len(handler.directory_scanner)
+                and not (handler.coalescer is not None and len(handler.coalescer))):
+            return True
+        if time.time() >= deadline:
+            return False
+        time.sleep(0.2)
+
+
+def run_workload(name, handler, observer, stub, root, staging, args):
+    # 负载目录提前创建，避免其自身的创建事件影响结果
+    base = os.path.join(root, name)
+    os.makedirs(base, exist_ok=True)
+    wait_idle(handler, observer, args.timeout)
+    time.sleep(args.settle)
+    handler.reset()
+    stub.clear()
+    EmbyFMB.log_lock.wait_stats.snapshot(reset=True)
+    EmbyFMB.log_lock.hold_stats.snapshot(reset=True)
+    EmbyFMB.handler_latency.snapshot(reset=True)
+    watches_before = EmbyFMB.FilteredInotify.watch_count if EmbyFMB.Inotify is not None else None
+
+    start = time.perf_counter()
+    expected = WORKLOADS[name](base, staging, args)
+    generate_seconds = time.perf_counter() - start
+
+    # 等待所有期望路径被 Emby 更新覆盖；没有期望路径时等待稳定检测和调度全部完成
+    tracker = CoverageTracker(stub, expected)
+    prefix = EmbyFMB.path_lookup.to_container(base)
+    max_queue = 0
+    deadline = time.time() + args.timeout
+    while time.time() < deadline:
+        max_queue = max(max_queue, observer.event_queue.qsize())
+        if expected and tracker.update(prefix):
+            break
+        if not expected and time.perf_counter() - start > generate_seconds + args.stable_seconds + 3 \
+                and wait_idle(handler, observer, 0):
+            break
+        time.sleep(0.1)
+    tracker.update(prefix)
+
+    latencies = tracker.latencies()
+    event_seconds = (handler.last_event - handler.first_event) if handler.events > 1 else 0
+    lock_count, wait_avg, wait_max = EmbyFMB.log_lock.wait_stats.snapshot(reset=True)
+    _, hold_avg, hold_max = EmbyFMB.log_lock.hold_stats.snapshot(reset=True)
+    handled, handler_avg, handler_max = EmbyFMB.handler_latency.snapshot(reset=True)
+    updates = stub.received("media_updated")
+    return {
+        "workload": name,
+        "files": args.files,
+        "generate_seconds": round(generate_seconds, 3),
+        "events": handler.events,
+        "events_per_second": round(handler.events / event_seconds) if event_seconds else None,
+        "observer_queue_max": max_queue,
+        "expected_paths": len(expected),
+        "covered_paths": len(tracker.covered),
+        "unexpected_updates": tracker.unexpected,
+        "change_to_scan_seconds": {
+            "p50": percentile(latencies, 0.5),
+            "p95": percentile(latencies, 0.95),
+            "max": round(latencies[-1], 3) if latencies else None,
+        },
+        "lock": {
+            "acquisitions": lock_count,
+            "wait_avg_ms": round(wait_avg * 1000, 4),
+            "wait_max_ms": round(wait_max * 1000, 3),
+            "hold_avg_ms": round(hold_avg * 1000, 4),
+            "hold_max_ms": round(hold_max * 1000, 3),
+        },
+        "handler": {
+            "calls": handled,
+            "avg_ms": round(handler_avg * 1000, 4),
+            "max_ms": round(handler_max * 1000, 3),
+        },
+        "emby_requests": len(updates) + len(stub.received("refresh")),
+        "emby_paths": sum(len(json.loads(body).get("Updates", [])) for _, _, body in updates),
+        "telegram_messages": len(stub.received("telegram")),
+        "rss_mb": rss_mb(),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "inotify_watches_added": (EmbyFMB.FilteredInotify.watch_count - watches_before
+                                  if watches_before is not None else None),
+    }
+
+
+def configure(args, stub, root):
+    """把 EmbyFMB 的配置指向桩服务和临时目录，并缩短各类等待时间"""
+    EmbyFMB.path_lookup = EmbyFMB.PathLookup({root: LIBRARY_ID}, {root: CONTAINER_ROOT})
+    EmbyFMB.EMBY_SERVER_URL = stub.url
+    EmbyFMB.TELEGRAM_API_URL = stub.url
+    EmbyFMB.TELEGRAM_BOT_TOKEN = "bench"
+    EmbyFMB.TELEGRAM_CHAT_ID = "1"
+    EmbyFMB.TELEGRAM_MESSAGES_PER_MINUTE = args.telegram_per_minute
+    EmbyFMB.NOTIFICATION_WINDOW_SECONDS = 1
+    EmbyFMB.EMBY_SCAN_TRACKING = False
+    EmbyFMB.HTTP_RETRY_BACKOFF_SECONDS = 0.1
+    EmbyFMB.FILE_STABLE_SECONDS = args.stable_seconds
+    EmbyFMB.FILE_STABLE_CHECK_INTERVAL_SECONDS = 0.5
+    EmbyFMB.SCAN_DEBOUNCE_SECONDS = args.debounce
+    EmbyFMB.SCAN_MAX_LATENCY_SECONDS = max(args.debounce * 10, 10)
+    EmbyFMB.SCAN_MIN_INTERVAL_SECONDS = 0
+    EmbyFMB.SCAN_INTERVAL_SECONDS = 3600
+
+    log = logging.getLogger("EmbyFMB")
+    log.propagate = False
+    if args.verbose:
+        log.setLevel(logging.INFO)
+        log.addHandler(logging.StreamHandler())
+    else:
+        log.addHandler(logging.NullHandler())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="端到端吞吐量和延迟基准测试")
+    parser.add_argument("--workloads", default=",".join(WORKLOADS), help="逗号分隔的负载名称")
+    parser.add_argument("--files", type=int, default=1000, help="每种负载的文件数量")
+    parser.add_argument("--file-size", type=int, default=64 * 1024, help="每个文件的大小（字节）")
+    parser.add_argument("--depth", type=int, default=6, help="deep_tree 负载的目录层数")
+    parser.add_argument("--latency", type=float, default=0.05, help="桩服务响应延迟（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="桩服务错误率（Emby 返回 503，Telegram 返回 429）")
+    parser.add_argument("--stable-seconds", type=float, default=1.0, help="文件稳定检测时长（秒）")
+    parser.add_argument("--debounce", type=float, default=1.0, help="扫描防抖时间（秒）")
+    parser.add_argument("--telegram-per-minute", type=int, default=600, help="Telegram 每分钟发送上限")
+    parser.add_argument("--settle", type=float, default=1.0, help="每种负载开始前的等待时间（秒）")
+    parser.add_argument("--timeout", type=float, default=120.0, help="每种负载的最长等待时间（秒）")
+    parser.add_argument("--output", help="结果 JSON 文件路径，不指定时输出到标准输出")
+    parser.add_argument("--verbose", action="store_true", help="输出 EmbyFMB 的运行日志")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="embyfmb_bench_")
+    root = os.path.join(workdir, "电视剧")
+    staging = os.path.join(workdir, "staging")
+    os.makedirs(root)
+    os.makedirs(staging)
+    stub = StubServer(latency=args.latency, error_rate=args.error_rate).start()
+    configure(args, stub, root)
+
+    handler = CountingHandler()
+    observer = EmbyFMB.create_observer()
+    results = []
+    try:
+        observer.schedule(handler, root, recursive=True)
+        observer.start()
+        if handler.coalescer is not None:
+            handler.coalescer.start()
+        handler.directory_scanner.start()
+        threading.Thread(target=EmbyFMB.run_scan_loop, daemon=True).start()
+        threading.Thread(target=EmbyFMB.notification_worker, daemon=True).start()
+
+        for name in args.workloads.split(","):
+            results.append(run_workload(name.strip(), handler, observer, stub, root, staging, args))
+    finally:
+        EmbyFMB.notification_thread_running = False
+        observer.stop()
+        observer.join()
+        if handler.coalescer is not None:
+            handler.coalescer.stop()
+        handler.directory_scanner.stop()
+        stub.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "observer": type(observer).__name__,
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
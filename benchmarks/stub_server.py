@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 本地 HTTP 桩服务，模拟 Emby API（/Library/Media/Updated、/Library/Refresh 等）和
+# Telegram sendMessage 的响应，可配置响应延迟和错误率，供基准测试使用。
+
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubServer:
+    """
+    在后台线程中运行的本地桩服务，记录收到的请求 (时间, 路径, 请求体)。
+    Emby 请求出错时返回 503；Telegram 请求出错时返回 429 和 retry_after，模拟限速。
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0, telegram_latency=None, telegram_error_rate=None,
+                 retry_after=1):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.telegram_latency = latency if telegram_latency is None else telegram_latency
+        self.telegram_error_rate = error_rate if telegram_error_rate is None else telegram_error_rate
+        self.retry_after = retry_after
+        self.requests = []
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @staticmethod
+    def kind(path):
+        """请求类型：media_updated、refresh、telegram 或 other"""
+        if path.endswith("/sendMessage"):
+            return "telegram"
+        if path.startswith("/emby/Library/Media/Updated"):
+            return "media_updated"
+        if path.startswith("/emby/Library/Refresh"):
+            return "refresh"
+        return "other"
+
+    def received(self, kind=None):
+        """返回已成功处理的请求列表，可按类型过滤"""
+        with self._lock:
+            return [request for request in self.requests if kind is None or self.kind(request[1]) == kind]
+
+    def clear(self):
+        with self._lock:
+            self.requests.clear()
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status, payload):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                telegram = stub.kind(self.path) == "telegram"
+                latency = stub.telegram_latency if telegram else stub.latency
+                if latency:
+                    time.sleep(latency)
+                with stub._lock:
+                    failed = stub._rng.random() < (stub.telegram_error_rate if telegram else stub.error_rate)
+                    if not failed:
+                        stub.requests.append((time.time(), self.path, body))
+                if telegram:
+                    if failed:
+                        self._send_json(429, {"ok": False, "error_code": 429,
+                                              "parameters": {"retry_after": stub.retry_after}})
+                    else:
+                        self._send_json(200, {"ok": True, "result": {}})
+                    return
+                if failed:
+                    self.send_response(503)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(204)
+                self.end_headers()
+
+            def do_GET(self):
+                payload = json.dumps([]).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()